@@ -1,4 +1,5 @@
 import os
+import sys
 import re
 import shutil
 import subprocess
@@ -6,13 +7,37 @@ import uuid
 import zipfile
 import json
 import threading
-import queue
 import time
+import math
 import signal
 import logging
-from flask import Flask, request, jsonify, send_from_directory, render_template, session, redirect, url_for, Response
+import mimetypes
+import hashlib
+import socket
+import select
+import secrets
+import ipaddress
+import hmac
+import sqlite3
+import multiprocessing
+import asyncio
+import io
+import base64
+import copy
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+import urllib.request
+import urllib.error
+from flask import Flask, request, jsonify, send_file, render_template, session, redirect, url_for, Response
+from werkzeug.wsgi import ClosingIterator, FileWrapper
 import yt_dlp
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:     # Windows: job folder owner files exist but their owner can't be checked
+    fcntl = None
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -32,14 +57,2365 @@ app.config['SECRET_KEY'] = 'your-very-secret-and-random-key-12345'
 ADMIN_USERNAME = 'admin'
 ADMIN_PASSWORD = 'password'
 
-# Track active downloads
-active_downloads = {}
+# --- Download scheduler configuration ---
+MAX_ACTIVE_DOWNLOADS = int(os.environ.get('ANYVIDOW_MAX_ACTIVE_DOWNLOADS', 6))    # global cap on running downloads
+MAX_DOWNLOADS_PER_HOST = int(os.environ.get('ANYVIDOW_MAX_PER_HOST', 3))          # default cap per site
+# Per-site overrides, e.g. ANYVIDOW_HOST_LIMITS="youtube.com=4,instagram.com=1"
+HOST_DOWNLOAD_LIMITS = {
+    host.strip(): int(limit)
+    for host, _, limit in (item.partition('=') for item in os.environ.get('ANYVIDOW_HOST_LIMITS', '').split(',') if '=' in item)
+}
+HOST_ALIASES = {'youtu.be': 'youtube.com'}
+# Lower runs first; single videos are not stuck behind long playlists
+SINGLE_DOWNLOAD_PRIORITY = 0
+PLAYLIST_ENTRY_PRIORITY = 10
+# How long /download waits on an identical running download before fetching the file itself
+FLIGHT_WAIT_TIMEOUT = float(os.environ.get('ANYVIDOW_FLIGHT_WAIT_TIMEOUT', 1800))
 
+# --- SSE progress configuration ---
+SSE_MAX_EVENTS_PER_SEC = float(os.environ.get('ANYVIDOW_SSE_MAX_RATE', 4))        # progress updates per job per second
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('ANYVIDOW_SSE_HEARTBEAT', 15))      # seconds between keep-alive comments
+QUEUE_POSITION_INTERVAL = 2.0                                                      # seconds between queue position checks
 
-# ============================================================================== 
+# --- Metadata cache configuration ---
+CACHE_FOLDER = os.path.join(os.getcwd(), 'cache')
+INFO_CACHE_TTL = int(os.environ.get('ANYVIDOW_INFO_CACHE_TTL', 900))          # seconds
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get('ANYVIDOW_INFO_CACHE_SIZE', 256))
+INFO_CACHE_ON_DISK = os.environ.get('ANYVIDOW_INFO_CACHE_DISK', '0') == '1'
+# /api/fetch_info_batch: extractions run on one shared pool, so many batches can't flood yt-dlp
+INFO_BATCH_WORKERS = int(os.environ.get('ANYVIDOW_INFO_BATCH_WORKERS', 8))
+INFO_BATCH_MAX_URLS = int(os.environ.get('ANYVIDOW_INFO_BATCH_MAX', 100))
+
+# --- Serving mode ---
+# 'asgi': progress streams and file transfers run as coroutines (see AsgiServer); needs uvicorn
+SERVER_MODE = os.environ.get('ANYVIDOW_SERVER', 'wsgi')
+ASGI_THREADS = int(os.environ.get('ANYVIDOW_ASGI_THREADS', 32))     # thread pool for Flask routes and file reads
+ASGI_CHUNK_SIZE = 256 * 1024
+
+# --- Job queue and worker processes ---
+# With the queue, web requests only enqueue downloads; worker processes (`python app.py worker`) run them
+# >0: the web server also starts this many detached workers (one per core by default in ASGI mode)
+WORKER_PROCESSES = int(os.environ.get('ANYVIDOW_WORKERS', (os.cpu_count() or 1) if SERVER_MODE == 'asgi' else 0))
+JOB_QUEUE_ENABLED = os.environ.get('ANYVIDOW_JOB_QUEUE', '0') == '1' or WORKER_PROCESSES > 0 or SERVER_MODE == 'asgi'
+WORKER_JOBS = int(os.environ.get('ANYVIDOW_WORKER_JOBS', 2))      # jobs one worker process runs at once
+JOB_QUEUE_PATH = os.path.join(CACHE_FOLDER, 'jobs.sqlite3')
+JOB_POLL_INTERVAL = 0.25
+# /download holds the request this long for its queued job, then answers 202 with the job's progress stream
+JOB_WAIT_TIMEOUT = float(os.environ.get('ANYVIDOW_JOB_WAIT_TIMEOUT', 300))
+WORKER_HEARTBEAT_INTERVAL = 1     # also how fast cancel requests reach running jobs
+WORKER_STALE_AFTER = 30
+JOB_MAX_ATTEMPTS = int(os.environ.get('ANYVIDOW_JOB_MAX_ATTEMPTS', 3))   # runs per job before a crashing one is failed
+# 'web' serves HTTP and owns disk cleanup; 'worker' only runs queued jobs
+PROCESS_ROLE = 'worker' if __name__ == '__main__' and sys.argv[1:2] == ['worker'] else os.environ.get('ANYVIDOW_ROLE', 'web')
+
+# --- Download cache configuration ---
+DOWNLOAD_CACHE_ENABLED = os.environ.get('ANYVIDOW_DOWNLOAD_CACHE', '1') == '1'
+DOWNLOAD_CACHE_MAX_BYTES = int(float(os.environ.get('ANYVIDOW_DOWNLOAD_CACHE_GB', 5)) * 1024 ** 3)
+DOWNLOAD_CACHE_POLICY = os.environ.get('ANYVIDOW_DOWNLOAD_CACHE_POLICY', 'lru')      # 'lru' or 'lfu'
+
+# --- Thumbnail proxy configuration (/thumb/<key>, cached under ./cache/thumbs) ---
+THUMB_CACHE_MAX_BYTES = int(float(os.environ.get('ANYVIDOW_THUMB_CACHE_MB', 200)) * 1024 ** 2)
+THUMB_MAX_SOURCE_BYTES = 5 * 1024 * 1024         # bigger images are not proxied
+THUMB_WIDTHS = (160, 320, 480, 640, 1280)         # ?w= is rounded up to one of these
+THUMB_FETCH_TIMEOUT = 10
+THUMB_MAX_AGE = 365 * 24 * 3600                   # variants never change for a given key
+THUMB_EXTENSIONS = ('.jpg', '.png', '.webp', '.gif', '.avif')
+THUMB_SECRET = os.environ.get('ANYVIDOW_THUMB_SECRET')     # signs /thumb keys; generated into ./cache/thumb.key when unset
+THUMB_KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,4096}\.[0-9a-f]{16}')
+
+# --- Finished artifact lifetime ---
+ARTIFACT_GRACE_SECONDS = int(os.environ.get('ANYVIDOW_ARTIFACT_GRACE', 900))   # kept this long after the last transfer ends, for resumes
+ARTIFACT_MAX_AGE = int(os.environ.get('ANYVIDOW_ARTIFACT_MAX_AGE', 6 * 3600))    # hard limit for any job, finished or not
+DOWNLOAD_QUOTA_BYTES = int(float(os.environ.get('ANYVIDOW_DOWNLOAD_QUOTA_GB', 20)) * 1024 ** 3)
+ORPHAN_MIN_AGE = 300        # unowned files younger than this may belong to a job being set up
+OWNER_FILE = '.owner'       # every process using a job folder holds a shared flock on this file
+JANITOR_INTERVAL = 30
+
+# --- Streaming download configuration (`stream=1` on /download) ---
+PIPE_MERGE_SUPPORTED = os.name == 'posix'     # ffmpeg reads the audio pipe through an inherited fd
+PIPE_CHUNK_SIZE = 64 * 1024
+PIPE_MERGE_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+# --- Playlist download configuration ---
+PLAYLIST_CONCURRENCY = int(os.environ.get('ANYVIDOW_PLAYLIST_CONCURRENCY', 4))   # default per-job worker count
+MAX_PLAYLIST_CONCURRENCY = 8
+# 'stream' builds the ZIP on the fly in /download_zip; 'file' appends entries to an on-disk archive as they finish
+PLAYLIST_ZIP_MODE = os.environ.get('ANYVIDOW_PLAYLIST_ZIP', 'stream')
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+PARTIAL_DOWNLOAD_SUFFIXES = ('.part', '.ytdl', '.temp')
+MEDIA_EXTENSIONS = {'.mp4', '.m4a', '.m4v', '.webm', '.mkv', '.mov', '.mp3', '.ogg', '.opus', '.flv', '.3gp', '.aac', '.jpg', '.jpeg', '.png', '.webp'}
+
+# --- Metrics ---
+METRICS_TOKEN = os.environ.get('ANYVIDOW_METRICS_TOKEN')     # when set, /metrics requires `Authorization: Bearer <token>`
+# OTLP/HTTP traces endpoint of a local collector, e.g. http://localhost:4318/v1/traces; job timelines are only logged when unset
+TIMELINE_OTLP_ENDPOINT = os.environ.get('ANYVIDOW_OTLP_ENDPOINT')
+TIMELINE_OTLP_TIMEOUT = 2
+
+
+# ==============================================================================
+# METRICS (Prometheus text exposition, no external dependency)
+# ==============================================================================
+
+def format_sample(value):
+    """Prometheus number formatting: integers without a fraction, floats in full precision."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Metric:
+    """Base for labelled metrics; each label combination is one series."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        metrics.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._series.items()]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A gauge set directly, or read from `func` (returning a number) at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), func=None):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def samples(self):
+        if self.func:
+            return [(self.name, '', self.func())]
+        return super().samples()
+
+class CounterFunc(Gauge):
+    """A counter kept elsewhere (e.g. cache hit totals), read at scrape time."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, func):
+        super().__init__(name, help_text, func=func)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series['counts']):
+                    out.append((f"{self.name}_bucket", self._labels(key, [('le', format_sample(bound))]), count))
+                out.append((f"{self.name}_bucket", self._labels(key, [('le', '+Inf')]), series['count']))
+                out.append((f"{self.name}_sum", self._labels(key), series['sum']))
+                out.append((f"{self.name}_count", self._labels(key), series['count']))
+        return out
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {format_sample(value)}" for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+BYTE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 10, 50, 100, 250, 500, 1024, 2048, 5120))
+RATE_BUCKETS = tuple(kb * 1024 for kb in (100, 250, 500, 1024, 2048, 5120, 10240, 25600, 51200))
+
+INFO_REUSE = Counter('anyvidow_download_info_reuse_total', 'Downloads started from the cached preview info (hit) or a fresh extraction (miss).', ('result',))
+EXTRACTIONS = Counter('anyvidow_extractions_total', 'yt-dlp metadata extractions by extractor and result.', ('extractor', 'result'))
+EXTRACTION_SECONDS = Histogram('anyvidow_extraction_seconds', 'Time spent in yt-dlp metadata extraction.', ('extractor',),
+                               buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 30, 60))
+JOB_BYTES = Histogram('anyvidow_job_bytes', 'Bytes produced per finished download job.', ('kind',), buckets=BYTE_BUCKETS)
+JOB_THROUGHPUT = Histogram('anyvidow_job_throughput_bytes_per_second', 'Average download throughput per finished job.', ('kind',), buckets=RATE_BUCKETS)
+DOWNLOADED_BYTES = Counter('anyvidow_downloaded_bytes_total', 'Bytes produced by finished download jobs.', ('kind',))
+MERGES = Counter('anyvidow_merges_total', 'Video/audio merges by strategy, container and result.', ('strategy', 'container', 'result'))
+MERGE_SECONDS = Histogram('anyvidow_merge_seconds', 'Time per video/audio merge.', ('strategy', 'container'))
+ZIP_BUILD_SECONDS = Histogram('anyvidow_zip_build_seconds', 'Time to build a playlist archive.', ('mode',))
+SSE_CONNECTIONS = Gauge('anyvidow_sse_connections', 'Open Server-Sent Events progress streams.')
+SSE_CONNECTIONS.set(0)
+ACTIVE_JOBS = Gauge('anyvidow_downloads_active', 'Downloads currently holding a scheduler slot.', func=lambda: scheduler.stats()['active'])
+QUEUED_JOBS = Gauge('anyvidow_downloads_queued', 'Downloads waiting for a scheduler slot.', func=lambda: scheduler.stats()['queued'])
+DISK_USAGE = Gauge('anyvidow_download_folder_bytes', 'Disk usage of the downloads folder (as of the last janitor run).', func=lambda: janitor.disk_usage)
+RECLAIMED_BYTES = CounterFunc('anyvidow_janitor_reclaimed_bytes_total', 'Bytes deleted by the janitor.', lambda: janitor.reclaimed_bytes)
+CACHE_HITS = CounterFunc('anyvidow_download_cache_hits_total', 'Download cache hits.', lambda: download_cache.hits if download_cache else 0)
+CACHE_MISSES = CounterFunc('anyvidow_download_cache_misses_total', 'Download cache misses.', lambda: download_cache.misses if download_cache else 0)
+QUEUED_JOBS_STORE = Gauge('anyvidow_job_queue_queued', 'Jobs waiting in the job queue for a worker process.',
+                          func=lambda: job_queue.stats()['jobs'].get('queued', 0) if job_queue else 0)
+LIVE_WORKERS = Gauge('anyvidow_workers', 'Worker processes with a recent heartbeat.', func=lambda: job_queue.live_workers() if job_queue else 0)
+THUMB_HITS = CounterFunc('anyvidow_thumbnail_cache_hits_total', 'Thumbnail cache hits.', lambda: thumb_cache.hits)
+THUMB_MISSES = CounterFunc('anyvidow_thumbnail_cache_misses_total', 'Thumbnail cache misses.', lambda: thumb_cache.misses)
+INFO_CACHE_HITS = CounterFunc('anyvidow_info_cache_hits_total', 'Metadata cache hits.', lambda: info_cache.hits)
+INFO_CACHE_MISSES = CounterFunc('anyvidow_info_cache_misses_total', 'Metadata cache misses.', lambda: info_cache.misses)
+INFO_CACHE_EVICTIONS = CounterFunc('anyvidow_info_cache_evictions_total', 'Metadata cache entries evicted by the size limit.', lambda: info_cache.evictions)
+INFO_CACHE_ENTRIES = Gauge('anyvidow_info_cache_entries', 'Entries held in the in-memory metadata cache.', func=lambda: info_cache.stats()['entries'])
+COALESCED = CounterFunc('anyvidow_coalesced_requests_total', 'Requests that joined an identical in-flight job.', lambda: flights.coalesced)
+
+def observe_job(kind, nbytes, seconds):
+    """Records size and average throughput of a finished download."""
+    JOB_BYTES.observe(nbytes, kind=kind)
+    DOWNLOADED_BYTES.inc(nbytes, kind=kind)
+    if seconds > 0:
+        JOB_THROUGHPUT.observe(nbytes / seconds, kind=kind)
+
+def timed(chunks, histogram, **labels):
+    """Yields from `chunks`, observing the time until the consumer is done into `histogram`."""
+    with histogram.time(**labels):
+        yield from chunks
+
+def count_sse(chunks):
+    """Wraps an SSE generator so open streams show up in SSE_CONNECTIONS."""
+    SSE_CONNECTIONS.inc()
+    try:
+        yield from chunks
+    finally:
+        SSE_CONNECTIONS.dec()
+
+# ==============================================================================
+# JOB TIMELINES (where the time of one download went)
+# ==============================================================================
+
+class JobTimeline:
+    """
+    Phase timeline of one job. Phases record start/end offsets (seconds since the
+    job started) plus attributes such as bytes or the merge strategy; phases may
+    overlap (e.g. concurrent video and audio fetches).
+    """
+
+    def __init__(self, job_id, kind, **attrs):
+        self.job_id = job_id
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._t0 = time.monotonic()
+        self.phases = []
+        self.status = None
+        self._lock = threading.Lock()
+
+    def _offset(self):
+        return round(time.monotonic() - self._t0, 3)
+
+    @contextmanager
+    def phase(self, name, **attrs):
+        """Times the enclosed block; yields the phase dict so callers can add attributes."""
+        span = {'name': name, 'start': self._offset(), 'end': None, **attrs}
+        with self._lock:
+            self.phases.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = str(e)[:200]
+            raise
+        finally:
+            span['end'] = self._offset()
+
+    def annotate(self, name, **attrs):
+        """Adds attributes to the most recent phase called `name`."""
+        with self._lock:
+            for span in reversed(self.phases):
+                if span['name'] == name:
+                    span.update(attrs)
+                    return
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.job_id,
+                'kind': self.kind,
+                'status': self.status,
+                'started_at': round(self.started_at, 3),
+                'total': self._offset(),
+                **self.attrs,
+                'phases': [dict(span) for span in self.phases],
+            }
+
+    def finish(self, status):
+        """Closes the timeline once: logs it as one JSON line and exports it if configured."""
+        with self._lock:
+            if self.status:
+                return None
+            self.status = status
+        data = self.to_dict()
+        logger.info(f"Job timeline: {json.dumps(data)}")
+        if TIMELINE_OTLP_ENDPOINT:
+            threading.Thread(target=export_timeline, args=(data,), daemon=True).start()
+        return data
+
+def otlp_attributes(attrs):
+    """OTLP/JSON key-value list for the scalar entries of `attrs`."""
+    out = []
+    for key, value in attrs.items():
+        if isinstance(value, bool):
+            out.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            out.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            out.append({'key': key, 'value': {'doubleValue': value}})
+        elif value is not None:
+            out.append({'key': key, 'value': {'stringValue': str(value)}})
+    return out
+
+def export_timeline(data):
+    """Sends a finished timeline to an OTLP/HTTP collector as one trace: a root span per job, a child per phase."""
+    trace_id = uuid.uuid4().hex
+    root_id = uuid.uuid4().hex[:16]
+    start_ns = int(data['started_at'] * 1e9)
+    to_ns = lambda offset: str(start_ns + int(offset * 1e9))
+    job_attrs = {k: v for k, v in data.items() if k not in ('phases', 'started_at', 'total')}
+    spans = [{
+        'traceId': trace_id, 'spanId': root_id, 'name': f"{data['kind']} download", 'kind': 1,
+        'startTimeUnixNano': to_ns(0), 'endTimeUnixNano': to_ns(data['total']),
+        'attributes': otlp_attributes(job_attrs),
+        'status': {'code': 1 if data['status'] == 'ready' else 2},
+    }]
+    for phase in data['phases']:
+        attrs = {k: v for k, v in phase.items() if k not in ('name', 'start', 'end')}
+        spans.append({
+            'traceId': trace_id, 'spanId': uuid.uuid4().hex[:16], 'parentSpanId': root_id,
+            'name': phase['name'], 'kind': 1,
+            'startTimeUnixNano': to_ns(phase['start']), 'endTimeUnixNano': to_ns(phase['end'] if phase['end'] is not None else data['total']),
+            'attributes': otlp_attributes(attrs),
+            'status': {'code': 2, 'message': phase['error']} if 'error' in phase else {'code': 0},
+        })
+    payload = {'resourceSpans': [{
+        'resource': {'attributes': otlp_attributes({'service.name': 'anyvidow'})},
+        'scopeSpans': [{'scope': {'name': 'anyvidow.timeline'}, 'spans': spans}],
+    }]}
+    req = urllib.request.Request(TIMELINE_OTLP_ENDPOINT, data=json.dumps(payload).encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with urllib.request.urlopen(req, timeout=TIMELINE_OTLP_TIMEOUT) as resp:
+            resp.read()
+    except Exception as e:
+        logger.warning(f"Timeline export to {TIMELINE_OTLP_ENDPOINT} failed: {e}")
+
+
+# ==============================================================================
+# METADATA CACHE
+# ==============================================================================
+
+def normalize_url(url):
+    """Normalizes a URL so equivalent links share one cache key."""
+    url = (url or '').strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+class InfoCache:
+    """
+    Thread-safe TTL + LRU cache for yt-dlp info dicts.
+
+    Entries are keyed by (normalized URL, quick_fetch). When a disk folder is
+    given, entries are also written there as JSON so they survive restarts.
+    """
+
+    def __init__(self, ttl, max_entries, disk_folder=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_folder = disk_folder
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (stored_at, info)
+        self._lock = threading.Lock()
+        if disk_folder:
+            os.makedirs(disk_folder, exist_ok=True)
+
+    @staticmethod
+    def make_key(url, quick_fetch):
+        return f"{'flat' if quick_fetch else 'full'}:{normalize_url(url)}"
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _load_from_disk(self, key):
+        if not self.disk_folder:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                stored_at, info = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if time.time() - stored_at > self.ttl:
+            try: os.remove(path)
+            except OSError: pass
+            return None
+        return stored_at, info
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry and time.time() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            entry = self._load_from_disk(key)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, url, quick_fetch=False):
+        """Returns a cached info dict or None. A full entry also satisfies a quick lookup."""
+        keys = [self.make_key(url, quick_fetch)]
+        if quick_fetch:
+            keys.append(self.make_key(url, False))
+        with self._lock:
+            for key in keys:
+                info = self._lookup(key)
+                if info is not None:
+                    self.hits += 1
+                    return info
+            self.misses += 1
+            return None
+
+    def put(self, url, quick_fetch, info):
+        key = self.make_key(url, quick_fetch)
+        entry = (time.time(), info)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        if self.disk_folder:
+            tmp_path = self._disk_path(key) + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as fh:
+                    json.dump(entry, fh)
+                os.replace(tmp_path, self._disk_path(key))
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning(f"Info cache disk write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / total) if total else 0.0,
+            }
+
+info_cache = InfoCache(
+    INFO_CACHE_TTL,
+    INFO_CACHE_MAX_ENTRIES,
+    disk_folder=os.path.join(CACHE_FOLDER, 'info') if INFO_CACHE_ON_DISK else None,
+)
+
+
+# ==============================================================================
+# FORMAT INDEX (one parsed table of a video's formats)
+# ==============================================================================
+# yt-dlp codec strings (e.g. 'avc1.640028', 'mp4a.40.2') -> the ffprobe names used by REMUX_CONTAINERS
+VIDEO_CODEC_PREFIXES = (('avc', 'h264'), ('h264', 'h264'), ('hev', 'hevc'), ('hvc', 'hevc'), ('h265', 'hevc'),
+                        ('vp09', 'vp9'), ('vp9', 'vp9'), ('vp8', 'vp8'), ('av01', 'av1'), ('av1', 'av1'), ('mp4v', 'mpeg4'))
+AUDIO_CODEC_PREFIXES = (('mp4a', 'aac'), ('aac', 'aac'), ('opus', 'opus'), ('vorbis', 'vorbis'), ('mp3', 'mp3'),
+                        ('ac-3', 'ac3'), ('ac3', 'ac3'), ('ec-3', 'eac3'), ('eac3', 'eac3'), ('flac', 'flac'), ('alac', 'alac'))
+HEIGHT_IN_NOTE = re.compile(r'(\d{3,4})p')
+
+FormatRow = namedtuple('FormatRow', 'format_id kind height fps vcodec acodec tbr abr size ext note position')
+
+def codec_family(codec, prefixes):
+    """Normalised codec name of a yt-dlp codec string ('none' for a missing stream, None if unknown)."""
+    if not codec or codec == 'none':
+        return codec or None
+    codec = codec.lower()
+    return next((name for prefix, name in prefixes if codec.startswith(prefix)), codec.split('.')[0])
+
+class FormatIndex:
+    """
+    Every format of one video parsed once into a row (FormatRow): kind ('video_only',
+    'combined' or 'audio'), height, fps, codec families, bitrates in kbit/s and size in
+    bytes (exact, approximate or estimated from bitrate and duration; 0 if unknown).
+
+    Rankings are computed up front, best first: `videos` by height, fps, then bitrate,
+    `audios` by bitrate, with yt-dlp's own order breaking ties. The UI listing, the audio
+    pick and the playlist format choice are all queries on the same table.
+    """
+
+    def __init__(self, formats, duration=None):
+        rows = []
+        for position, f in enumerate(formats or []):
+            vcodec = codec_family(f.get('vcodec'), VIDEO_CODEC_PREFIXES)
+            acodec = codec_family(f.get('acodec'), AUDIO_CODEC_PREFIXES)
+            if vcodec != 'none':
+                kind = 'video_only' if acodec == 'none' else 'combined'
+            elif acodec != 'none':
+                kind = 'audio'
+            else:
+                continue    # storyboards and other image-only formats
+            note = f.get('format_note') or ''
+            height = f.get('height') or 0
+            if not height and kind != 'audio':
+                match = HEIGHT_IN_NOTE.search(note)
+                height = int(match.group(1)) if match else 0
+            tbr = f.get('tbr') or (f.get('vbr') or 0) + (f.get('abr') or 0)
+            abr = f.get('abr') or (tbr if kind == 'audio' else 0)
+            size = f.get('filesize') or f.get('filesize_approx') or (int(tbr * 125 * duration) if tbr and duration else 0)
+            rows.append(FormatRow(f.get('format_id'), kind, height, round(f.get('fps') or 0), vcodec, acodec,
+                                  tbr, abr, size, f.get('ext'), note, position))
+        self.rows = rows
+        self._by_id = {row.format_id: row for row in rows}
+        self.videos = sorted((r for r in rows if r.kind != 'audio'), key=lambda r: (r.height, r.fps, r.tbr, r.position), reverse=True)
+        self.audios = sorted((r for r in rows if r.kind == 'audio'), key=lambda r: (r.abr, r.position), reverse=True)
+
+    def get(self, format_id):
+        return self._by_id.get(format_id)
+
+    @staticmethod
+    def _prefer(rows, field, codec):
+        """Rows in `codec`, or all rows when none are (codecs are preferences, not requirements)."""
+        if not codec:
+            return rows
+        return [r for r in rows if getattr(r, field) == codec] or rows
+
+    def best_audio(self, acodec=None, max_bytes=None):
+        """Best audio-only format (preferring `acodec`), else the best combined one; None if nothing fits."""
+        candidates = self._prefer(self.audios, 'acodec', acodec) or [r for r in self.videos if r.kind == 'combined']
+        return next((r for r in candidates if not max_bytes or r.size <= max_bytes), None)
+
+    def pick(self, max_height=None, vcodec=None, acodec=None, max_bytes=None):
+        """
+        Best (video, audio) pair for a query like "best <=1080p h264 + best opus under 200 MB".
+        `audio` is None for a combined format and `video` is None for audio-only sources.
+        Without any format under `max_height` the lowest known resolution is used. Formats of
+        unknown size pass `max_bytes`. Returns None if nothing fits.
+        """
+        if not self.videos:
+            audio = self.best_audio(acodec, max_bytes)
+            return (None, audio) if audio else None
+        videos = self.videos
+        if max_height:
+            lowest = min((r.height for r in videos if r.height), default=0)
+            videos = [r for r in videos if r.height and r.height <= max_height] or [r for r in videos if r.height == lowest]
+        audios = self._prefer(self.audios, 'acodec', acodec)
+        for video in self._prefer(videos, 'vcodec', vcodec):
+            if video.kind == 'combined':
+                if not max_bytes or video.size <= max_bytes:
+                    return video, None
+                continue
+            budget = max_bytes - video.size if max_bytes else None
+            if budget is not None and budget <= 0:
+                continue
+            audio = next((a for a in audios if budget is None or a.size <= budget), None)
+            if audio:
+                return video, audio
+        return None
+
+    def listing(self):
+        """
+        (video formats, audio formats) for the single video view, best first. Formats are
+        only merged when resolution, fps, codec and type all match (the best bitrate stays).
+        """
+        def size_str(row):
+            return f"{row.size / 1024 / 1024:.2f} MB" if row.size else "N/A"
+
+        video_formats, seen = [], set()
+        for r in self.videos:
+            if (r.height, r.fps, r.vcodec, r.kind) in seen:
+                continue
+            seen.add((r.height, r.fps, r.vcodec, r.kind))
+            resolution = f"{r.height}p{r.fps if r.fps > 30 else ''}" if r.height else (r.note or 'N/A')
+            video_formats.append({'format_id': r.format_id, 'resolution': resolution, 'ext': r.ext, 'filesize': size_str(r), 'type': r.kind,
+                                  'height': r.height, 'fps': r.fps, 'vcodec': r.vcodec, 'acodec': r.acodec if r.kind == 'combined' else None, 'filesize_bytes': r.size})
+        audio_formats, seen = [], set()
+        for r in self.audios:
+            if (r.acodec, round(r.abr)) in seen:
+                continue
+            seen.add((r.acodec, round(r.abr)))
+            quality = f"{round(r.abr)}k" if r.abr else (r.note or 'N/A')
+            audio_formats.append({'format_id': r.format_id, 'quality': quality, 'ext': r.ext, 'filesize': size_str(r), 'type': 'audio',
+                                  'acodec': r.acodec, 'abr': r.abr, 'filesize_bytes': r.size})
+        return video_formats, audio_formats
+
+_format_indexes = OrderedDict()     # id(info) -> (info, FormatIndex); info_cache hands out the same dicts
+_format_indexes_lock = threading.Lock()
+
+def format_index(info):
+    """The FormatIndex of an info dict, built once for as long as the dict stays in use."""
+    key = id(info)
+    with _format_indexes_lock:
+        entry = _format_indexes.get(key)
+        if entry and entry[0] is info:
+            _format_indexes.move_to_end(key)
+            return entry[1]
+    index = FormatIndex((info or {}).get('formats'), (info or {}).get('duration'))
+    with _format_indexes_lock:
+        # Holding the dict keeps its id from being reused by another one
+        _format_indexes[key] = (info, index)
+        while len(_format_indexes) > INFO_CACHE_MAX_ENTRIES:
+            _format_indexes.popitem(last=False)
+    return index
+
+def format_selector(max_height=None, vcodec=None, acodec=None, max_bytes=None):
+    """A yt-dlp `format` option that picks each video's formats with FormatIndex.pick()."""
+    def select(ctx):
+        formats = {f['format_id']: f for f in ctx['formats']}
+        picked = FormatIndex(ctx['formats']).pick(max_height, vcodec, acodec, max_bytes)
+        if not picked:
+            return      # yt-dlp reports "Requested format is not available"
+        video, audio = picked
+        if video and audio:
+            video_format, audio_format = formats[video.format_id], formats[audio.format_id]
+            yield {
+                'format_id': f"{video.format_id}+{audio.format_id}",
+                'ext': remux_container(video.vcodec, audio.acodec),
+                'requested_formats': [video_format, audio_format],
+                'protocol': f"{video_format.get('protocol', 'https')}+{audio_format.get('protocol', 'https')}",
+            }
+        else:
+            yield formats[(video or audio).format_id]
+    return select
+
+
+# ==============================================================================
+# DOWNLOAD SCHEDULER
+# ==============================================================================
+
+def host_key(url):
+    """Groups URLs by site so per-host limits apply across mirrors (www., m., youtu.be)."""
+    try:
+        host = (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return HOST_ALIASES.get(host, host)
+
+class DownloadCancelled(yt_dlp.DownloadError):
+    """Raised inside download threads when the user cancels the job."""
+
+class DownloadJob:
+    """Tracking record for one download job (single video or whole playlist)."""
+
+    def __init__(self, job_id, kind):
+        self.job_id = job_id
+        self.kind = kind
+        self.cancelled = False
+        self.created_at = time.time()
+
+class SlotTicket:
+    """A request for one download slot, waiting in or admitted from the queue."""
+
+    def __init__(self, job_id, host, priority, seq):
+        self.job_id = job_id
+        self.host = host
+        self.priority = priority
+        self.seq = seq
+        self.admitted = False
+
+class DownloadScheduler:
+    """
+    Central admission control for all yt-dlp/ffmpeg work.
+
+    Every download takes a slot before touching the network. At most
+    `max_active` slots run at once, and at most `per_host` (or the override
+    in `host_limits`) per site. Waiting tickets are served by (priority, FIFO);
+    a ticket blocked only by its host cap does not hold up tickets for other hosts.
+    """
+
+    def __init__(self, max_active, per_host, host_limits=None):
+        self.max_active = max_active
+        self.per_host = per_host
+        self.host_limits = host_limits or {}
+        self.jobs = {}
+        self._waiting = []          # kept sorted by (priority, seq)
+        self._active = []
+        self._active_per_host = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    # --- Job tracking ---
+    def register(self, job_id, kind='single'):
+        with self._cond:
+            job = self.jobs[job_id] = DownloadJob(job_id, kind)
+            return job
+
+    def unregister(self, job_id):
+        with self._cond:
+            self.jobs.pop(job_id, None)
+            self._cond.notify_all()
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if not job:
+                return False
+            job.cancelled = True
+            self._cond.notify_all()
+            return True
+
+    def is_cancelled(self, job_id):
+        """True once a job is cancelled. Unregistered jobs count as cancelled so stray worker threads stop."""
+        job = self.jobs.get(job_id)
+        return job is None or job.cancelled
+
+    # --- Slot admission ---
+    def _host_limit(self, host):
+        return self.host_limits.get(host, self.per_host)
+
+    def _admit(self):
+        """Admits waiting tickets while capacity remains. Caller holds the lock."""
+        for ticket in list(self._waiting):
+            if len(self._active) >= self.max_active:
+                break
+            if self._active_per_host.get(ticket.host, 0) >= self._host_limit(ticket.host):
+                continue
+            self._waiting.remove(ticket)
+            self._active.append(ticket)
+            self._active_per_host[ticket.host] = self._active_per_host.get(ticket.host, 0) + 1
+            ticket.admitted = True
+        self._cond.notify_all()
+
+    def enqueue(self, job_id, url, priority=0):
+        """Queues a slot request and returns its ticket (possibly already admitted)."""
+        with self._cond:
+            self._seq += 1
+            ticket = SlotTicket(job_id, host_key(url), priority, self._seq)
+            self._waiting.append(ticket)
+            self._waiting.sort(key=lambda t: (t.priority, t.seq))
+            self._admit()
+            return ticket
+
+    def wait(self, ticket, timeout=None):
+        """Blocks until the ticket is admitted, its job is cancelled, or timeout. Returns ticket.admitted."""
+        with self._cond:
+            self._cond.wait_for(lambda: ticket.admitted or self.is_cancelled(ticket.job_id), timeout)
+            return ticket.admitted
+
+    def position(self, ticket):
+        """1-based queue position, or 0 once admitted."""
+        with self._cond:
+            if ticket.admitted:
+                return 0
+            try:
+                return self._waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def job_position(self, job_id):
+        """Queue position of a job's earliest waiting ticket, or 0 if none are waiting."""
+        with self._cond:
+            for i, ticket in enumerate(self._waiting):
+                if ticket.job_id == job_id:
+                    return i + 1
+            return 0
+
+    def release(self, ticket):
+        with self._cond:
+            if ticket.admitted:
+                self._active.remove(ticket)
+                self._active_per_host[ticket.host] -= 1
+                ticket.admitted = False
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._admit()
+
+    @contextmanager
+    def slot(self, job_id, url, priority=0):
+        """Blocking context manager for worker threads. Raises DownloadCancelled if the job is cancelled while waiting."""
+        ticket = self.enqueue(job_id, url, priority)
+        try:
+            while not self.wait(ticket, timeout=1.0):
+                if self.is_cancelled(job_id):
+                    raise DownloadCancelled("Download cancelled by user")
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self._cond:
+            return {'active': len(self._active), 'queued': len(self._waiting), 'jobs': len(self.jobs)}
+
+scheduler = DownloadScheduler(MAX_ACTIVE_DOWNLOADS, MAX_DOWNLOADS_PER_HOST, HOST_DOWNLOAD_LIMITS)
+
+
+# ==============================================================================
+# ARTIFACT REGISTRY
+# ==============================================================================
+
+def link_file(src, dst):
+    """Hard-links src to dst, copying when the filesystem can't link."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class Artifact:
+    """Output files of one job, all kept inside the job's own subdirectory."""
+
+    def __init__(self, job_id, directory):
+        self.job_id = job_id
+        self.dir = directory
+        self.files = {}             # role ('output', 'video', 'audio', ...) -> exact path
+        self.final_path = None
+        self.download_name = None
+        self.size = 0
+        self.state = 'pending'      # pending -> ready -> served
+        self.created_at = time.time()
+        self.expires_at = None      # set once ready; pushed back after every transfer
+        self.active = 0             # responses currently sending this artifact
+        self.etag = None
+        self.lock = threading.Lock()
+        self.on_remove = []         # callbacks run when the job is forgotten
+        self.on_idle = []           # one-shot callbacks run once no response is sending the artifact
+        self.materializing = False  # a streamed playlist ZIP is being written to a file
+        self._owner_fd = None
+
+    def claim(self):
+        """
+        Marks the folder as in use for the janitors of every process (web processes, workers,
+        the reloader): a shared flock on its owner file, dropped by the OS if this process dies.
+        """
+        if self._owner_fd is not None:
+            return
+        try:
+            fd = os.open(os.path.join(self.dir, OWNER_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            logger.warning(f"Could not claim {self.dir}: {e}")
+            return
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        self._owner_fd = fd
+
+    def release_claim(self):
+        fd, self._owner_fd = self._owner_fd, None
+        if fd is not None:
+            os.close(fd)    # closing the descriptor drops the lock
+
+    def record(self, role, path):
+        self.files[role] = path
+
+    def hook(self, role):
+        """A yt-dlp `post_hooks` callback that records the final file path under `role`."""
+        return lambda path: self.record(role, path)
+
+    def link(self, path, filename):
+        """Shares another job's finished file into this job's directory."""
+        dest = os.path.join(self.dir, filename)
+        link_file(path, dest)
+        return dest
+
+
+class ArtifactRegistry:
+    """
+    In-process index from job ID to its output files.
+
+    Paths come straight from yt-dlp post hooks (or from our own merge/zip
+    steps), so serving a file is a dict lookup instead of a scan of the
+    shared downloads folder.
+    """
+
+    def __init__(self, root, grace=ARTIFACT_GRACE_SECONDS):
+        self.root = root
+        self.grace = grace
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id):
+        directory = os.path.join(self.root, job_id)
+        os.makedirs(directory, exist_ok=True)
+        artifact = Artifact(job_id, directory)
+        artifact.claim()
+        with self._lock:
+            self._artifacts[job_id] = artifact
+        return artifact
+
+    def get(self, job_id):
+        with self._lock:
+            return self._artifacts.get(job_id)
+
+    def mark_ready(self, job_id, path, download_name=None):
+        artifact = self.get(job_id)
+        if artifact:
+            artifact.final_path = path
+            artifact.download_name = download_name or os.path.basename(path)
+            artifact.size = os.path.getsize(path) if os.path.isfile(path) else 0
+            artifact.state = 'ready'
+            artifact.expires_at = time.time() + self.grace
+        return artifact
+
+    def track(self, response, artifact, grace=None):
+        """
+        Keeps `artifact` alive while `response` is being sent, then for `grace`
+        seconds (default: the registry's grace window) so clients can resume.
+        """
+        with self._lock:
+            artifact.active += 1
+            artifact.state = 'served'
+
+        finished = []
+        def closed():
+            if finished:
+                return
+            finished.append(True)
+            with self._lock:
+                artifact.active -= 1
+                artifact.expires_at = time.time() + (self.grace if grace is None else grace)
+                idle, artifact.on_idle = (artifact.on_idle, []) if artifact.active == 0 else ([], artifact.on_idle)
+            for callback in idle:
+                callback()
+
+        response.call_on_close(closed)
+        if response.direct_passthrough:
+            # send_file bodies go to the server as-is, so the response's own close callbacks never fire
+            response.response = ClosingIterator(response.response, closed)
+        return response
+
+    def adopt(self, job_id, path, download_name, created_at, ready_at, on_remove=None):
+        """Registers a job another process finished (see JobQueue) as a ready artifact."""
+        artifact = Artifact(job_id, os.path.join(self.root, job_id))
+        artifact.created_at = created_at
+        with self._lock:
+            existing = self._artifacts.setdefault(job_id, artifact)
+        if existing is not artifact:
+            return existing
+        artifact.claim()
+        self.mark_ready(job_id, path, download_name)
+        artifact.expires_at = ready_at + self.grace
+        if on_remove:
+            artifact.on_remove.append(on_remove)
+        return artifact
+
+    def when_idle(self, artifact, callback):
+        """Runs `callback` now if no response is sending `artifact`, else once the last one closes."""
+        with self._lock:
+            if artifact.active:
+                artifact.on_idle.append(callback)
+                return
+        callback()
+
+    def detach(self, job_id):
+        """
+        Forgets a job but keeps its files; another process takes them over. The caller
+        releases the artifact's claim once that process can find the job.
+        """
+        with self._lock:
+            return self._artifacts.pop(job_id, None)
+
+    def all(self):
+        with self._lock:
+            return list(self._artifacts.values())
+
+    def remove(self, job_id):
+        """Forgets a job and deletes its subdirectory."""
+        with self._lock:
+            artifact = self._artifacts.pop(job_id, None)
+        if artifact:
+            artifact.release_claim()
+            shutil.rmtree(artifact.dir, ignore_errors=True)
+            for callback in artifact.on_remove:
+                callback()
+
+artifacts = ArtifactRegistry(DOWNLOAD_FOLDER)
+
+
+# ==============================================================================
+# JOB QUEUE (SQLite file shared by the web process and worker processes)
+# ==============================================================================
+
+JOB_TERMINAL_STATES = ('done', 'failed', 'cancelled')
+
+class JobQueue:
+    """
+    Durable local job queue; no broker process needed.
+
+    The web process enqueues jobs and tails their events. Worker processes claim
+    queued jobs, run them and append every SSE event they produce; a finished
+    job records its output so the web process can serve it. Jobs interrupted by
+    a worker stopping go back to the queue and resume from the files left in
+    their directory. Every thread gets its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT NOT NULL,            -- queued -> running -> done | failed | cancelled
+            worker TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, created_at);
+        CREATE TABLE IF NOT EXISTS job_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id);
+        CREATE TABLE IF NOT EXISTS workers (
+            id TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS job_entries (
+            job_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            state TEXT NOT NULL,            -- done | failed
+            PRIMARY KEY (job_id, idx)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._db()
+        # WAL: readers (the web process tailing events) never block the writing workers
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(self.SCHEMA)
+        if 'attempts' not in {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}:
+            db.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit; multi-statement changes use an explicit BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')     # durable across process crashes; enough under WAL
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _decode(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def _end(self, db, job_id, state, event=None):
+        """Moves a job to a terminal state, closing its event stream. Caller holds a transaction."""
+        if event:
+            db.execute('INSERT INTO job_events (job_id, data) VALUES (?, ?)', (job_id, f"data: {json.dumps(event)}\n\n"))
+            db.execute('INSERT INTO job_events (job_id, data) VALUES (?, ?)', (job_id, "data: [DONE]\n\n"))
+        db.execute('UPDATE jobs SET state = ?, finished_at = ? WHERE id = ?', (state, time.time(), job_id))
+
+    def _requeue(self, db, job_id, message, crashed=False):
+        """Puts an interrupted job back in the queue; only a `crashed` run counts as an attempt. Caller holds a transaction."""
+        db.execute('INSERT INTO job_events (job_id, data) VALUES (?, ?)',
+                   (job_id, f"data: {json.dumps({'status': 'queued', 'session_id': job_id, 'message': message})}\n\n"))
+        db.execute(f"UPDATE jobs SET state = 'queued', worker = NULL{'' if crashed else ', attempts = attempts - 1'} WHERE id = ?",
+                   (job_id,))
+
+    # --- Web process side ---
+    def enqueue(self, kind, params, priority=0):
+        job_id = str(uuid.uuid4())
+        self._db().execute(
+            'INSERT INTO jobs (id, kind, params, priority, state, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, kind, json.dumps(params), priority, 'queued', time.time()))
+        return job_id
+
+    def get(self, job_id):
+        return self._decode(self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def events(self, job_id, after=0):
+        return self._db().execute('SELECT id, data FROM job_events WHERE job_id = ? AND id > ? ORDER BY id',
+                                  (job_id, after)).fetchall()
+
+    def position(self, job_id):
+        """1-based position among queued jobs, or 0 once claimed."""
+        row = self._db().execute(
+            """SELECT COUNT(*) FROM jobs q, jobs j WHERE j.id = ? AND j.state = 'queued' AND q.state = 'queued'
+               AND (q.priority < j.priority OR (q.priority = j.priority AND q.created_at <= j.created_at))""",
+            (job_id,)).fetchone()
+        return row[0]
+
+    def request_cancel(self, job_id):
+        """Cancels a queued job at once; a running one is cancelled by its worker. False if unknown or over."""
+        with self._transaction() as db:
+            row = db.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not row or row['state'] in JOB_TERMINAL_STATES:
+                return False
+            if row['state'] == 'queued':
+                self._end(db, job_id, 'cancelled', {'status': 'cancelled', 'message': 'Download cancelled'})
+            else:
+                db.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+        return True
+
+    @staticmethod
+    def queued_event(job_id, position, workers):
+        message = f'Waiting in queue (position {position})...' if workers else 'Waiting for a worker process...'
+        return f"data: {json.dumps({'status': 'queued', 'position': position, 'session_id': job_id, 'message': message})}\n\n"
+
+    def follow(self, job_id, after=0):
+        """
+        SSE stream of a job's events after event `after` (from the first by default);
+        ends when the job is over and drained. Every event carries its `id:`, so a
+        client that lost the stream can reattach with Last-Event-ID.
+        """
+        last_id, last_sent, last_position = after, time.monotonic(), None
+        while True:
+            rows = self.events(job_id, last_id)
+            for row in rows:
+                last_id = row['id']
+                yield f"id: {last_id}\n{row['data']}"
+            if rows:
+                last_sent = time.monotonic()
+            job = self.get(job_id)
+            if not job:
+                return
+            if job['state'] in JOB_TERMINAL_STATES:
+                if not self.events(job_id, last_id):
+                    return
+                continue
+            if job['state'] == 'queued':
+                position = self.position(job_id)
+                if position != last_position:
+                    yield self.queued_event(job_id, position, self.live_workers())
+                    last_position, last_sent = position, time.monotonic()
+            if time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                yield SSE_HEARTBEAT
+                last_sent = time.monotonic()
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def wait(self, job_id, timeout=None, cancelled=None):
+        """
+        Blocks until the job is over and returns it. Gives up when `timeout` seconds pass
+        or `cancelled()` becomes true, returning the job as it is then (still queued or running).
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            job = self.get(job_id)
+            if not job or job['state'] in JOB_TERMINAL_STATES:
+                return job
+            if (deadline is not None and time.monotonic() >= deadline) or (cancelled and cancelled()):
+                return job
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def finished_jobs(self):
+        return [self._decode(row) for row in self._db().execute("SELECT * FROM jobs WHERE state = 'done'")]
+
+    def active_ids(self):
+        return {row[0] for row in self._db().execute("SELECT id FROM jobs WHERE state IN ('queued', 'running')")}
+
+    def active_jobs(self):
+        """(id, state) of every queued or running job, queued ones in the order workers take them."""
+        return [tuple(row) for row in self._db().execute(
+            "SELECT id, state FROM jobs WHERE state IN ('queued', 'running') ORDER BY priority, created_at")]
+
+    def last_event_id(self):
+        return self._db().execute('SELECT COALESCE(MAX(id), 0) FROM job_events').fetchone()[0]
+
+    def events_since(self, after):
+        """Events of all jobs after event `after`."""
+        return self._db().execute('SELECT id, job_id, data FROM job_events WHERE id > ? ORDER BY id', (after,)).fetchall()
+
+    def entries(self, job_id):
+        """Playlist entries the job already finished, as {index: (url, state)}."""
+        return {row['idx']: (row['url'], row['state']) for row in self._db().execute(
+            'SELECT idx, url, state FROM job_entries WHERE job_id = ?', (job_id,))}
+
+    def forget(self, job_id):
+        with self._transaction() as db:
+            db.execute('DELETE FROM job_events WHERE job_id = ?', (job_id,))
+            db.execute('DELETE FROM job_entries WHERE job_id = ?', (job_id,))
+            db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def stats(self):
+        counts = dict(self._db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return {'jobs': counts, 'workers': self.live_workers()}
+
+    # --- Worker process side ---
+    def claim(self, worker_id):
+        """Takes the next queued job for `worker_id`, or returns None."""
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority, created_at LIMIT 1").fetchone()
+            if not row:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                       (worker_id, time.time(), row['id']))
+        return dict(self._decode(row), state='running', worker=worker_id, attempts=row['attempts'] + 1)
+
+    def append_event(self, job_id, data):
+        self._db().execute('INSERT INTO job_events (job_id, data) VALUES (?, ?)', (job_id, data))
+
+    def record_entry(self, job_id, index, url, state):
+        """Remembers a finished playlist entry so a resumed job skips it (our download archive)."""
+        self._db().execute('INSERT OR REPLACE INTO job_entries (job_id, idx, url, state) VALUES (?, ?, ?, ?)',
+                           (job_id, index, url, state))
+
+    def forget_entry(self, job_id, index):
+        """Drops a finished mark whose files are gone, so the entry counts as pending again."""
+        self._db().execute('DELETE FROM job_entries WHERE job_id = ? AND idx = ?', (job_id, index))
+
+    def release(self, job_id):
+        """Hands a running job back to the queue when its worker shuts down; its files are kept to resume from."""
+        with self._transaction() as db:
+            row = db.execute('SELECT state, cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not row or row['state'] != 'running':
+                return
+            if row['cancel_requested']:
+                self._end(db, job_id, 'cancelled', {'status': 'cancelled', 'message': 'Download cancelled'})
+            else:
+                self._requeue(db, job_id, 'Worker restarting; the download will resume...')
+
+    def finish(self, job_id, state, result=None, event=None):
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET result = ? WHERE id = ?', (json.dumps(result) if result else None, job_id))
+            self._end(db, job_id, state, event)
+
+    def cancel_requests(self, worker_id):
+        return [row[0] for row in self._db().execute(
+            "SELECT id FROM jobs WHERE worker = ? AND state = 'running' AND cancel_requested = 1", (worker_id,))]
+
+    def heartbeat(self, worker_id):
+        self._db().execute('INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)', (worker_id, time.time()))
+
+    def remove_worker(self, worker_id):
+        self._db().execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+
+    def live_workers(self):
+        cutoff = time.time() - WORKER_STALE_AFTER
+        return self._db().execute('SELECT COUNT(*) FROM workers WHERE heartbeat > ?', (cutoff,)).fetchone()[0]
+
+    def reap_stale(self):
+        """Requeues running jobs whose worker stopped sending heartbeats; fails them after JOB_MAX_ATTEMPTS runs."""
+        cutoff = time.time() - WORKER_STALE_AFTER
+        with self._transaction() as db:
+            stale = db.execute(
+                """SELECT j.id, j.attempts, j.cancel_requested FROM jobs j LEFT JOIN workers w ON w.id = j.worker
+                   WHERE j.state = 'running' AND (w.heartbeat IS NULL OR w.heartbeat < ?)""", (cutoff,)).fetchall()
+            for row in stale:
+                if row['cancel_requested']:
+                    self._end(db, row['id'], 'cancelled', {'status': 'cancelled', 'message': 'Download cancelled'})
+                elif row['attempts'] >= JOB_MAX_ATTEMPTS:
+                    self._end(db, row['id'], 'failed', {'status': 'error', 'message': 'The worker running this download stopped.'})
+                else:
+                    self._requeue(db, row['id'], 'The worker running this download stopped; resuming...', crashed=True)
+            db.execute('DELETE FROM workers WHERE heartbeat < ?', (cutoff,))
+        for row in stale:
+            logger.warning(f"Job {row['id']} interrupted: its worker stopped (run {row['attempts']} of {JOB_MAX_ATTEMPTS})")
+
+job_queue = JobQueue(JOB_QUEUE_PATH) if JOB_QUEUE_ENABLED or PROCESS_ROLE == 'worker' else None
+
+def adopt_job(job):
+    """Registers the output of a job finished by a worker process with this process's artifact registry."""
+    result = (job or {}).get('result') or {}
+    path = result.get('final_path')
+    if not job or job['state'] != 'done' or not path or not os.path.exists(path):
+        return None
+    return artifacts.adopt(job['id'], path, result.get('download_name'), job['created_at'], job['finished_at'],
+                           on_remove=lambda: job_queue.forget(job['id']))
+
+def find_artifact(job_id):
+    """The artifact of `job_id`, whether this process or a worker process produced it."""
+    artifact = artifacts.get(job_id)
+    if artifact is None and job_queue:
+        artifact = adopt_job(job_queue.get(job_id))
+    return artifact
+
+
+# ==============================================================================
+# JANITOR (disk lifecycle of DOWNLOAD_FOLDER)
+# ==============================================================================
+
+def folder_owned(path):
+    """True if a live process holds a claim on the job folder `path` (see Artifact.claim)."""
+    owner = os.path.join(path, OWNER_FILE)
+    if not os.path.isfile(owner):
+        return False
+    if not fcntl:
+        return True
+    try:
+        fd = os.open(owner, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
+def folder_size(path):
+    """Bytes used by the files under `path` (or by `path` itself if it is a file)."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+class Janitor:
+    """
+    Single owner of disk cleanup for the downloads folder.
+
+    Each run expires finished artifacts past their grace window, cancels and
+    removes jobs older than `max_age`, deletes files no registered job owns,
+    and evicts the oldest finished artifacts while usage is above `quota_bytes`.
+    Artifacts that are being sent to a client are never touched. With a job
+    queue, jobs finished by worker processes are adopted into the registry and
+    folders of queued or running jobs are left alone.
+    """
+
+    def __init__(self, registry, quota_bytes, max_age, orphan_min_age=ORPHAN_MIN_AGE, jobs=None):
+        self.registry = registry
+        self.jobs = jobs
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.orphan_min_age = orphan_min_age
+        self.disk_usage = 0
+        self.reclaimed_bytes = 0
+        self.reclaimed_files = 0
+        self.last_run = None
+        self._lock = threading.Lock()
+
+    def _count(self, path):
+        files = 1 if os.path.isfile(path) else sum(len(names) for _, _, names in os.walk(path))
+        self.reclaimed_bytes += folder_size(path)
+        self.reclaimed_files += files
+
+    def _delete(self, path):
+        try:
+            self._count(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Janitor could not delete {path}: {e}")
+
+    def _reclaim(self, artifact, reason):
+        if artifact.state == 'pending':
+            scheduler.cancel(artifact.job_id)
+        if os.path.exists(artifact.dir):
+            self._count(artifact.dir)
+        self.registry.remove(artifact.job_id)
+        logger.info(f"Janitor removed job {artifact.job_id} ({reason})")
+
+    def _sync_queue(self):
+        """Adopts jobs finished by worker processes; returns the IDs of jobs still queued or running."""
+        if not self.jobs:
+            return set()
+        self.jobs.reap_stale()
+        for job in self.jobs.finished_jobs():
+            if not self.registry.get(job['id']) and not adopt_job(job):
+                self.jobs.forget(job['id'])     # its files are gone
+        return self.jobs.active_ids()
+
+    def remove_orphans(self, min_age, keep=()):
+        """
+        Deletes entries of the downloads folder that no job owns: neither registered here,
+        nor in `keep`, nor claimed by another live process (see Artifact.claim).
+        """
+        owned = {os.path.basename(a.dir) for a in self.registry.all()} | set(keep)
+        now = time.time()
+        for name in os.listdir(self.registry.root):
+            path = os.path.join(self.registry.root, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if name in owned or mtime > now - min_age:
+                    continue
+                # Without flock a claim can't be checked, so it only holds until the max age
+                if folder_owned(path) and (fcntl or mtime > now - self.max_age):
+                    continue
+            except OSError:
+                continue
+            logger.info(f"Janitor removing orphan {name}")
+            self._delete(path)
+
+    def startup(self, extra_folders=()):
+        """
+        Reclaims what a previous process left behind: unowned job folders and partial downloads.
+        Anything younger than orphan_min_age is spared; another web process may be creating it.
+        """
+        with self._lock:
+            self.remove_orphans(self.orphan_min_age, keep=self._sync_queue())
+            cutoff = time.time() - self.orphan_min_age
+            for folder in extra_folders:
+                for root, _, names in os.walk(folder):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        try:
+                            if not name.endswith(PARTIAL_DOWNLOAD_SUFFIXES) or os.path.getmtime(path) > cutoff:
+                                continue
+                        except OSError:
+                            continue
+                        self._delete(path)
+            self.disk_usage = folder_size(self.registry.root)
+        if self.reclaimed_bytes:
+            logger.info(f"Janitor reclaimed {self.reclaimed_bytes / 1024 / 1024:.1f} MB on startup")
+
+    def run(self):
+        with self._lock:
+            now = time.time()
+            active_jobs = self._sync_queue()
+            for artifact in self.registry.all():
+                if artifact.active:
+                    continue
+                if artifact.state != 'pending' and artifact.expires_at is not None and artifact.expires_at <= now:
+                    self._reclaim(artifact, 'grace window over')
+                elif now - artifact.created_at > self.max_age:
+                    self._reclaim(artifact, 'max age exceeded')
+
+            self.remove_orphans(self.orphan_min_age, keep=active_jobs)
+
+            self.disk_usage = folder_size(self.registry.root)
+            if self.disk_usage > self.quota_bytes:
+                finished = sorted((a for a in self.registry.all() if a.state != 'pending' and not a.active),
+                                  key=lambda a: a.expires_at or 0)
+                for artifact in finished:
+                    if self.disk_usage <= self.quota_bytes:
+                        break
+                    size = folder_size(artifact.dir)
+                    self._reclaim(artifact, 'over disk quota')
+                    self.disk_usage -= size
+            self.last_run = now
+
+    def start(self, interval=JANITOR_INTERVAL):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run()
+                except Exception as e:
+                    logger.error(f"Janitor run failed: {e}")
+        threading.Thread(target=loop, name='janitor', daemon=True).start()
+
+    def stats(self):
+        return {
+            'disk_usage_bytes': self.disk_usage,
+            'quota_bytes': self.quota_bytes,
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'reclaimed_files': self.reclaimed_files,
+            'artifacts': len(self.registry.all()),
+            'last_run': self.last_run,
+        }
+
+janitor = Janitor(artifacts, DOWNLOAD_QUOTA_BYTES, ARTIFACT_MAX_AGE, jobs=job_queue)
+
+janitor_started = False
+janitor_start_lock = threading.Lock()
+
+def start_janitor():
+    """
+    Starts this web process's janitor, once. Called by the entrypoints (RUN APPLICATION, the ASGI
+    lifespan) and the first request, never on import, so benchmarks and REPLs don't start one.
+    Worker processes leave the downloads folder to the web processes' janitors.
+    """
+    global janitor_started
+    with janitor_start_lock:
+        if janitor_started or PROCESS_ROLE != 'web':
+            return
+        janitor_started = True
+    janitor.startup(extra_folders=[CACHE_FOLDER])
+    janitor.start()
+
+
+# ==============================================================================
+# DOWNLOAD CACHE
+# ==============================================================================
+
+def identify_video(url):
+    """
+    Returns (extractor_key, video_id) for a URL, or None.
+
+    Uses cached metadata when available, otherwise matches the URL against
+    yt-dlp's extractors offline (no network request).
+    """
+    info = info_cache.get(url)
+    if info and info.get('id') and info.get('extractor_key') and info.get('_type', 'video') == 'video':
+        return info['extractor_key'], str(info['id'])
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        video_id = ie.get_temp_id(url)
+        return (ie.ie_key(), str(video_id)) if video_id else None
+    return None
+
+class DownloadCache:
+    """
+    Persistent cache of finished downloads keyed by (extractor, video id, format, merge mode).
+
+    Files live in `folder` with a small JSON index. The cache stays under
+    `max_bytes` by evicting least recently used ('lru') or least frequently
+    used ('lfu') entries. Entries with a positive reference count are being
+    served and are never evicted.
+    """
+
+    def __init__(self, folder, max_bytes, policy='lru'):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self._index_path = os.path.join(folder, 'index.json')
+        self._entries = {}      # key -> {'path', 'size', 'ext', 'last_used', 'uses'}
+        self._refs = {}
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(identity, format_id, file_type, audio_id=None, target_codec=None):
+        extractor, video_id = identity
+        merge_mode = f"merge+{audio_id}+{target_codec or 'copy'}" if file_type == 'video_only' else file_type
+        return f"{extractor}:{video_id}:{format_id}:{merge_mode}"
+
+    def _load(self):
+        """Merges the on-disk index into memory (worker processes share the cache folder)."""
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            entries = {}
+        for key, entry in entries.items():
+            if key not in self._entries and os.path.isfile(entry.get('path', '')):
+                self._entries[key] = entry
+
+    def _save(self):
+        tmp_path = self._index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                json.dump(self._entries, fh)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning(f"Download cache index write failed: {e}")
+
+    def total_bytes(self):
+        return sum(e['size'] for e in self._entries.values())
+
+    def acquire(self, key):
+        """Returns the cached path (holding a reference) or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self._load()
+            entry = self._entries.get(key)
+            if entry and not os.path.isfile(entry['path']):
+                del self._entries[key]
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_used'] = time.time()
+            entry['uses'] = entry.get('uses', 0) + 1
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._save()
+            return entry['path']
+
+    def release(self, key):
+        with self._lock:
+            if self._refs.get(key, 0) > 1:
+                self._refs[key] -= 1
+            else:
+                self._refs.pop(key, None)
+            self._evict()
+
+    def store(self, key, path):
+        """
+        Moves a finished file into the cache and returns its new path with a
+        reference held, or None (file left untouched) if it does not fit.
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return None
+        ext = os.path.splitext(path)[1]
+        cached_path = os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + ext)
+        with self._lock:
+            if key in self._entries and os.path.isfile(self._entries[key]['path']):
+                # Another job stored the same artifact first; keep that copy
+                os.remove(path)
+                cached_path = self._entries[key]['path']
+            else:
+                shutil.move(path, cached_path)
+                self._entries[key] = {'path': cached_path, 'size': size, 'ext': ext, 'last_used': time.time(), 'uses': 1}
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._evict()
+            self._save()
+        return cached_path
+
+    def _evict(self):
+        """Drops unreferenced entries until the cache fits its budget. Caller holds the lock."""
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            order = lambda k: (self._entries[k].get('uses', 0), self._entries[k]['last_used'])
+        else:
+            order = lambda k: self._entries[k]['last_used']
+        for key in sorted(self._entries, key=order):
+            if total <= self.max_bytes:
+                break
+            if self._refs.get(key):
+                continue
+            entry = self._entries.pop(key)
+            try: os.remove(entry['path'])
+            except OSError: pass
+            total -= entry['size']
+            logger.info(f"Evicted cached download {key} ({entry['size'] / 1024 / 1024:.1f} MB)")
+        self._save()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.total_bytes(), 'hits': self.hits, 'misses': self.misses, 'in_use': len(self._refs)}
+
+download_cache = DownloadCache(os.path.join(CACHE_FOLDER, 'media'), DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_POLICY) if DOWNLOAD_CACHE_ENABLED else None
+
+def download_cache_key(url, format_id, file_type, audio_id=None, target_codec=None):
+    """Cache key for a single download request, or None if caching is off or the video can't be identified."""
+    if not download_cache:
+        return None
+    identity = identify_video(url)
+    return DownloadCache.make_key(identity, format_id, file_type, audio_id, target_codec) if identity else None
+
+def claim_cached_download(artifact, cache_key):
+    """Returns the cached file for cache_key, referenced until the artifact is removed, or None."""
+    if not download_cache or not cache_key:
+        return None
+    path = download_cache.acquire(cache_key)
+    if path:
+        artifact.on_remove.append(lambda: download_cache.release(cache_key))
+    return path
+
+def cache_finished_download(artifact, cache_key, path):
+    """Moves a finished download into the cache and returns the path to serve from."""
+    if not download_cache or not cache_key:
+        return path
+    cached_path = download_cache.store(cache_key, path)
+    if not cached_path:
+        return path
+    artifact.on_remove.append(lambda: download_cache.release(cache_key))
+    return cached_path
+
+
+# ==============================================================================
+# THUMBNAIL PROXY
+# ==============================================================================
+class ThumbnailCache:
+    """
+    On-disk cache of proxied thumbnails and their resized/WebP variants, one file each.
+
+    A hit refreshes the file's mtime, so the least recently used files go first when the
+    folder grows past `max_bytes`. No index is kept; the folder itself is the state.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._bytes = sum(e.stat().st_size for e in os.scandir(folder) if e.is_file())
+
+    def get(self, name):
+        """Returns the path of a cached file (marking it as used) or None."""
+        path = os.path.join(self.folder, name)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def find(self, stem, extensions):
+        """Like get(), for a file stored under one of several extensions."""
+        for ext in extensions:
+            if os.path.isfile(os.path.join(self.folder, stem + ext)):
+                return self.get(stem + ext)
+        self.misses += 1
+        return None
+
+    def put(self, name, data):
+        path = os.path.join(self.folder, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+        return path
+
+    def _evict(self):
+        """Deletes least recently used files down to 90% of the budget. Caller holds the lock."""
+        files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try: os.remove(path)
+            except OSError: continue
+            total -= size
+        self._bytes = total
+
+    def stats(self):
+        return {'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+thumb_cache = ThumbnailCache(os.path.join(CACHE_FOLDER, 'thumbs'), THUMB_CACHE_MAX_BYTES)
+
+def load_thumb_secret():
+    """
+    The /thumb signing key: ANYVIDOW_THUMB_SECRET, else a random key created once per
+    deployment in ./cache, so every process and restart signs the same way.
+    """
+    if THUMB_SECRET:
+        return THUMB_SECRET.encode('utf-8')
+    path = os.path.join(CACHE_FOLDER, 'thumb.key')
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path, 'rb') as fh:
+                key = fh.read().strip()
+            if key:
+                return key
+            time.sleep(0.02)    # another process is writing it right now
+        raise RuntimeError(f"{path} is empty; delete it to generate a new thumbnail key")
+    key = secrets.token_hex(32).encode('ascii')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(key)
+    return key
+
+thumb_secret = load_thumb_secret()
+
+def sign_thumbnail(source):
+    return hmac.new(thumb_secret, source.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+def thumbnail_url(url, page=False):
+    """
+    Path of the /thumb proxy for a remote image URL. With `page`, the URL is a video page
+    whose thumbnail is looked up on first request. The key is signed, so the proxy only
+    fetches URLs this app handed out.
+    """
+    if not url or not url.startswith(('http://', 'https://')):
+        return None
+    source = ('p' if page else 'i') + url
+    token = base64.urlsafe_b64encode(source.encode('utf-8')).decode('ascii').rstrip('=')
+    return f"/thumb/{token}.{sign_thumbnail(source)}"
+
+def thumbnail_source(key):
+    """Returns (url, is_page) for a /thumb key, or None if it was not issued by thumbnail_url()."""
+    if not THUMB_KEY_PATTERN.fullmatch(key):
+        return None
+    token, _, signature = key.rpartition('.')
+    try:
+        source = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature.encode('ascii'), sign_thumbnail(source).encode('ascii')) or source[:1] not in ('i', 'p'):
+        return None
+    return source[1:], source[0] == 'p'
+
+def best_thumbnail(info):
+    """Thumbnail URL of an info dict, including flat playlist entries that only list `thumbnails`."""
+    if not info:
+        return None
+    if info.get('thumbnail'):
+        return info['thumbnail']
+    # yt-dlp orders thumbnails from worst to best
+    urls = [t.get('url') for t in info.get('thumbnails') or [] if t.get('url')]
+    return urls[-1] if urls else None
+
+def public_url(url):
+    """
+    True for an http(s) URL whose host only resolves to public addresses. The proxy never
+    fetches from loopback, private, link-local (cloud metadata) or other reserved ranges.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return False
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or None)}
+    except (OSError, UnicodeError, ValueError):
+        return False
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        ip = getattr(ip, 'ipv4_mapped', None) or ip
+        if not ip.is_global or ip.is_multicast:
+            return False
+    return bool(addresses)
+
+class PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects only to public addresses (see public_url)."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not public_url(newurl):
+            raise urllib.error.URLError(f"redirect to a non-public address refused: {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+remote_opener = urllib.request.build_opener(PublicRedirectHandler)
+
+def fetch_remote(url, limit):
+    """
+    GETs a public URL with the browser User-Agent. Returns (content type, body) or None if it
+    fails, exceeds `limit` or points (directly or by redirect) at a non-public address.
+    """
+    if not public_url(url):
+        logger.warning(f"Thumbnail fetch of {url} refused: not a public address")
+        return None
+    req = urllib.request.Request(url, headers={
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    })
+    try:
+        with remote_opener.open(req, timeout=THUMB_FETCH_TIMEOUT) as resp:
+            body = resp.read(limit + 1)
+            content_type = resp.headers.get_content_type()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Thumbnail fetch of {url} failed: {e}")
+        return None
+    return (content_type, body) if len(body) <= limit else None
+
+def resolve_page_thumbnail(page_url):
+    """
+    Thumbnail of a video page without a full extraction: a cached info dict if there is
+    one, otherwise the page's og:image tag.
+    """
+    cached = info_cache.get(page_url, quick_fetch=True)
+    if best_thumbnail(cached):
+        return best_thumbnail(cached)
+    fetched = fetch_remote(page_url, 1024 * 1024)
+    if not fetched:
+        return None
+    html = fetched[1].decode('utf-8', 'replace')
+    for tag in re.findall(r'<meta\b[^>]*>', html, re.I):
+        if re.search(r'(?:property|name)\s*=\s*["\'](?:og:image|twitter:image)["\']', tag, re.I):
+            match = re.search(r'content\s*=\s*["\']([^"\']+)', tag, re.I)
+            if match and match.group(1).startswith(('http://', 'https://')):
+                return match.group(1).replace('&amp;', '&')
+    return None
+
+def image_extension(data):
+    """File extension for image bytes, from their signature (CDNs often send a generic content type)."""
+    if data.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return '.gif'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return '.avif'
+    return None
+
+def load_thumbnail(digest, url, is_page):
+    """Path of the cached source image for a /thumb key, fetching it on a miss. None if unavailable."""
+    path = thumb_cache.find(f"{digest}.src", THUMB_EXTENSIONS)
+    if path:
+        return path
+
+    def fetch(flight):
+        image_url = resolve_page_thumbnail(url) if is_page else url
+        fetched = fetch_remote(image_url, THUMB_MAX_SOURCE_BYTES) if image_url else None
+        if not fetched:
+            return None
+        content_type, body = fetched
+        ext = image_extension(body)
+        if not ext:
+            logger.warning(f"Thumbnail {image_url} is not an image ({content_type})")
+            return None
+        return thumb_cache.put(f"{digest}.src{ext}", body)
+
+    # Many rows of the UI may ask for the same image at once; fetch it once
+    return flights.do(f"thumb:{digest}", fetch)
+
+def render_thumbnail(name, source_path, width, webp):
+    """
+    Renders a resized and/or WebP copy of a cached thumbnail with ffmpeg and caches it as `name`.
+    Falls back to the source image when ffmpeg is unavailable or fails.
+    """
+    cmd = ['ffmpeg', '-loglevel', 'error', '-i', source_path, '-frames:v', '1']
+    if width:
+        cmd += ['-vf', f"scale='min({width},iw)':-2"]
+    cmd += ['-c:v', 'libwebp', '-quality', '80', '-f', 'webp'] if webp else ['-q:v', '4', '-f', 'mjpeg']
+    try:
+        proc = subprocess.run(cmd + ['pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Thumbnail conversion failed: {e}")
+        return source_path
+    if proc.returncode != 0 or not proc.stdout:
+        logger.warning(f"Thumbnail conversion failed: {proc.stderr.decode('utf-8', 'replace')[:300]}")
+        return source_path
+    return thumb_cache.put(name, proc.stdout)
+
+
+# ==============================================================================
+# PROGRESS CHANNEL (push-based SSE progress)
+# ==============================================================================
+
+SSE_HEARTBEAT = ": keep-alive\n\n"
+
+class ProgressChannel:
+    """
+    Push-based progress channel between download threads and an SSE generator.
+
+    Hooks call publish() directly. Coalescable updates (byte progress) overwrite
+    each other so only the latest state is sent, at most `max_rate` per second;
+    ordered events (phase changes, per-entry results) are always delivered in order.
+    Consumers block in get() instead of sleep-polling.
+    """
+
+    def __init__(self, max_rate=SSE_MAX_EVENTS_PER_SEC):
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._ordered = deque()
+        self._latest = None
+        self._next_latest_at = 0.0
+        self._cond = threading.Condition()
+
+    def publish(self, event, coalesce=True):
+        with self._cond:
+            if coalesce:
+                self._latest = event
+            else:
+                self._ordered.append(event)
+            self._cond.notify_all()
+
+    def wake(self):
+        """Wakes a blocked consumer, e.g. when a worker thread exits."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _ready(self, now):
+        events = list(self._ordered)
+        self._ordered.clear()
+        if self._latest is not None and now >= self._next_latest_at:
+            events.append(self._latest)
+            self._latest = None
+            self._next_latest_at = now + self.min_interval
+        return events
+
+    def get(self, timeout, until=None):
+        """Blocks up to `timeout` seconds for events; returns early (possibly empty) once `until()` is true."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                events = self._ready(now)
+                if events or now >= deadline or (until and until()):
+                    return events
+                wait_for = deadline - now
+                if self._latest is not None:
+                    # A rate-limited update is pending; wake up when it may be sent
+                    wait_for = min(wait_for, self._next_latest_at - now)
+                self._cond.wait(max(wait_for, 0.001))
+
+    def drain(self):
+        """Returns everything still pending, ignoring the rate limit."""
+        with self._cond:
+            events = list(self._ordered)
+            self._ordered.clear()
+            if self._latest is not None:
+                events.append(self._latest)
+                self._latest = None
+            return events
+
+    def spawn(self, target):
+        """Starts `target` in a thread that wakes this channel when it exits."""
+        def run():
+            try:
+                target()
+            finally:
+                self.wake()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+def pump_progress(channel, worker, cancelled):
+    """
+    Relays channel events as SSE chunks while the `worker` thread runs, sending a
+    heartbeat comment when idle. Returns True if `cancelled()` became true first.
+    """
+    last_sent = time.monotonic()
+    while worker.is_alive():
+        if cancelled():
+            return True
+        events = channel.get(SSE_HEARTBEAT_INTERVAL, until=lambda: not worker.is_alive() or cancelled())
+        for event in events:
+            yield f"data: {json.dumps(event)}\n\n"
+        if events:
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+            yield SSE_HEARTBEAT
+            last_sent = time.monotonic()
+    worker.join()
+    for event in channel.drain():
+        yield f"data: {json.dumps(event)}\n\n"
+    return False
+
+
+# ==============================================================================
+# SINGLE-FLIGHT (coalescing identical concurrent work)
+# ==============================================================================
+
+# Leader events worth relaying to followers; terminal ones are produced per follower
+FLIGHT_RELAYED_STATUSES = ('queued', 'downloading', 'processing', 'merging', 'completed')
+
+class Flight:
+    """
+    One piece of in-progress work shared by a leader and any followers.
+
+    The leader publishes progress, listeners subscribed by followers receive it,
+    and finish() hands everyone the result. `is_alive()`/`join()` mirror a thread
+    so pump_progress() can wait on a flight like on a worker.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.error = None
+        self.abandoned = False      # leader gave up (cancelled); a follower should take over
+        self._done = threading.Event()
+        self._listeners = []
+        self._wakers = []
+        self._claims = []           # followers' claims on the result, run by the leader (see hand_off)
+        self._handed_off = False
+        self._last = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener, wake=None):
+        """Adds a follower; it immediately receives the latest event, if any."""
+        with self._lock:
+            self._listeners.append(listener)
+            if wake:
+                self._wakers.append(wake)
+            last = self._last
+        if last is not None:
+            self._deliver(listener, last)
+
+    def unsubscribe(self, listener, wake=None):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+            if wake in self._wakers:
+                self._wakers.remove(wake)
+
+    def publish(self, event):
+        with self._lock:
+            self._last = event
+            listeners = list(self._listeners)
+        for listener in listeners:
+            self._deliver(listener, event)
+
+    @staticmethod
+    def _deliver(listener, event):
+        # A follower's hook must never break the leader's download
+        try:
+            listener(event)
+        except Exception:
+            pass
+
+    def add_claim(self, claim):
+        """Registers a follower's claim(result); returns its record, or None if the leader already handed off."""
+        with self._lock:
+            if self._handed_off:
+                return None
+            record = {'claim': claim, 'ok': False}
+            self._claims.append(record)
+            return record
+
+    def remove_claim(self, record):
+        with self._lock:
+            if record in self._claims:
+                self._claims.remove(record)
+
+    def hand_off(self, result):
+        """Runs the registered claims in the leader's thread, while the leader still holds the result."""
+        with self._lock:
+            self._handed_off = True
+            claims = list(self._claims)
+        for record in claims:
+            try:
+                record['claim'](result)
+                record['ok'] = True
+            except Exception as e:
+                logger.warning(f"Follower could not take its share of {self.key}: {e}")
+
+    @staticmethod
+    def fresh_error(error):
+        """A copy of the leader's exception, so concurrent followers don't all raise (and chain onto) one object."""
+        try:
+            return copy.copy(error)
+        except Exception:
+            return RuntimeError(str(error))
+
+    def finish(self, result=None, error=None, abandoned=False):
+        self.result, self.error, self.abandoned = result, error, abandoned
+        self._done.set()
+        with self._lock:
+            wakers = list(self._wakers)
+        for wake in wakers:
+            wake()
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def join(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def wait(self, cancelled=None, poll=1.0, timeout=None):
+        """Blocks until the flight lands. Returns False if `cancelled()` became true or `timeout` passed first."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self._done.wait(poll):
+            if cancelled and cancelled():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    @property
+    def followers(self):
+        with self._lock:
+            return len(self._listeners)
+
+class SingleFlight:
+    """Registry of in-progress flights; the first caller for a key leads, later ones follow."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def join(self, key):
+        """Returns (flight, leading)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+            return flight, True
+
+    def finish(self, flight, result=None, error=None, abandoned=False):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.finish(result, error, abandoned)
+
+    def do(self, key, fn, listener=None, cancelled=None, claim=None):
+        """
+        Runs fn(flight) once for all concurrent callers with the same key.
+
+        Followers block (optionally receiving the leader's published events via
+        `listener`) and share its result or a copy of its exception. If the leader
+        was cancelled, a waiting follower takes over. Raises DownloadCancelled if
+        `cancelled()` becomes true while following.
+
+        `claim(result)` is how a follower takes its share of a result the leader may
+        delete right after (e.g. linking its files): the leader runs it before the
+        flight lands. A follower that joined too late claims on its own, and one
+        whose claim fails with OSError does the work itself.
+        """
+        while True:
+            flight, leading = self.join(key)
+            if leading:
+                break
+            record = flight.add_claim(claim) if claim else None
+            if listener:
+                flight.subscribe(listener)
+            try:
+                if not flight.wait(cancelled):
+                    raise DownloadCancelled("Download cancelled by user")
+            finally:
+                if listener:
+                    flight.unsubscribe(listener)
+                if record:
+                    flight.remove_claim(record)
+            if not flight.abandoned:
+                if flight.error:
+                    raise flight.fresh_error(flight.error) from flight.error
+                if claim and not (record and record['ok']):
+                    try:
+                        claim(flight.result)
+                    except OSError as e:
+                        logger.warning(f"Result of {key} is gone ({e}), running it again")
+                        continue
+                return flight.result
+        try:
+            result = fn(flight)
+        except BaseException as e:
+            self.finish(flight, error=e, abandoned=isinstance(e, DownloadCancelled))
+            raise
+        flight.hand_off(result)
+        self.finish(flight, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._flights), 'coalesced': self.coalesced}
+
+flights = SingleFlight()
+
+def download_flight_key(cache_key, url, format_id, file_type, audio_id=None, target_codec=None):
+    """Identical single downloads share a flight; the cache key is preferred since it survives URL variations."""
+    return cache_key or f"url:{normalize_url(url)}:{format_id}:{file_type}:{audio_id}:{target_codec}"
+
+def relay_to_followers(flight, chunks):
+    """Passes a leader's SSE chunks through, publishing its progress to followers. Returns the generator's result."""
+    try:
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration as stop:
+                return stop.value
+            if chunk.startswith('data: {'):
+                event = json.loads(chunk[len('data: '):])
+                if event.get('status') in FLIGHT_RELAYED_STATUSES:
+                    flight.publish(event)
+            yield chunk
+    finally:
+        chunks.close()
+
+def follow_flight(flight, job_id, cancelled):
+    """
+    Relays a leader's progress as this job's SSE events until the flight lands.
+    Returns the leader's result, or None if cancelled or the flight failed.
+    """
+    channel = ProgressChannel()
+    def listener(event):
+        if 'session_id' in event:
+            event = dict(event, session_id=job_id)
+        channel.publish(event, coalesce=event.get('status') == 'downloading')
+    flight.subscribe(listener, channel.wake)
+    try:
+        if (yield from pump_progress(channel, flight, cancelled)):
+            return None
+    finally:
+        flight.unsubscribe(listener, channel.wake)
+    return flight.result
+
+
+# ==============================================================================
 # HELPER FUNCTIONS
 # ==============================================================================
 
+def disconnect_probe():
+    """
+    Returns a callable that is true once the client of the current request has gone away.
+
+    AsgiServer flags the environ on http.disconnect; under werkzeug's server a closed
+    socket reads as EOF. Other servers never report a disconnect.
+    """
+    environ = request.environ
+    flag = environ.get('anyvidow.disconnected')
+    if flag is not None:
+        return flag.is_set
+    sock = environ.get('werkzeug.socket')
+    if sock is None:
+        return lambda: False
+
+    def gone():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+        except ValueError:      # TLS sockets cannot peek
+            return False
+        except OSError:
+            return True
+    return gone
+
 def sanitize_filename(title):
     """Removes illegal characters from a string to make it a valid filename."""
     if not title: return "untitled"
@@ -47,47 +2423,70 @@ def sanitize_filename(title):
     s = re.sub(r'\s+', '_', s).strip('_')
     return s[:100]
 
-def get_video_info(url, quick_fetch=False):
-    """Extracts video or playlist information using yt-dlp."""
-    ydl_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "extract_flat": "in_playlist" if quick_fetch else False,
-        "http_headers": {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+def get_video_info(url, quick_fetch=False, use_cache=True, items=None):
+    """
+    Extracts video or playlist information using yt-dlp (served from info_cache when possible).
+    `items` limits a playlist to some of its entries (yt-dlp `playlist_items`, e.g. "1-10");
+    such partial results bypass the cache.
+    """
+    use_cache = use_cache and not items
+    if use_cache:
+        cached = info_cache.get(url, quick_fetch)
+        if cached is not None:
+            return cached
+
+    def extract(flight):
+        ydl_opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "extract_flat": "in_playlist" if quick_fetch else False,
+            "http_headers": {
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+            }
         }
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            return ydl.extract_info(url, download=False)
-        except Exception as e:
-            logger.error(f"yt-dlp error: {e}")
-            return None
+        if items:
+            ydl_opts["playlist_items"] = items
+        started = time.monotonic()
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            try:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            except Exception as e:
+                logger.error(f"yt-dlp error: {e}")
+                EXTRACTIONS.inc(extractor=host_key(url), result='error')
+                return None
+        extractor = (info or {}).get('extractor_key') or host_key(url)
+        EXTRACTION_SECONDS.observe(time.monotonic() - started, extractor=extractor)
+        EXTRACTIONS.inc(extractor=extractor, result='ok')
+        return info
+
+    # Concurrent lookups of the same URL share one extraction
+    flight_key = f"info:{InfoCache.make_key(url, quick_fetch)}"
+    info = flights.do(f"{flight_key}:{items}" if items else flight_key, extract)
+    if info and use_cache:
+        info_cache.put(url, quick_fetch, info)
+        # Downloads are requested with the canonical URL, previews with whatever was pasted
+        if info.get('webpage_url') and normalize_url(info['webpage_url']) != normalize_url(url):
+            info_cache.put(info['webpage_url'], quick_fetch, info)
+    return info
+
+def get_playlist_range(url, start, end):
+    """
+    Flat playlist info holding only entries start..end (1-based, inclusive). Entries carry just
+    a title and URL; each one is fully extracted when it downloads. A cached preview is sliced
+    by the same positions as yt-dlp's `playlist_items`, so unavailable (None) entries are
+    dropped only after slicing.
+    """
+    cached = info_cache.get(url, quick_fetch=True)
+    if cached is not None and 'entries' in cached:
+        return dict(cached, entries=[e for e in (cached['entries'] or [])[start - 1:end] if e])
+    return get_video_info(url, quick_fetch=True, items=f"{start}-{end}")
 
 def get_best_audio_format(info):
-    """Get the best available audio format with fallback options."""
+    """Get the best available audio format, falling back to the best combined one."""
     if not info or 'formats' not in info:
         return None
-    
-    audio_formats = [
-        f for f in info.get('formats', [])
-        if f.get('acodec') != 'none' and f.get('vcodec') == 'none'
-    ]
-    
-    if not audio_formats:
-        # Fallback: look for combined formats with audio
-        combined_formats = [
-            f for f in info.get('formats', [])
-            if f.get('acodec') != 'none' and f.get('vcodec') != 'none'
-        ]
-        if combined_formats:
-            # Use the best combined format as audio source
-            return sorted(combined_formats, key=lambda x: x.get('quality', 0), reverse=True)[0].get('format_id')
-        return None
-    
-    # Sort by audio bitrate/quality and return the best
-    best_audio = sorted(audio_formats, key=lambda x: x.get('abr', 0), reverse=True)[0]
-    return best_audio.get('format_id')
+    best_audio = format_index(info).best_audio()
+    return best_audio.format_id if best_audio else None
 
 def validate_downloaded_file(file_path, min_size_mb=0.1):
     """Validate that a downloaded file exists and has reasonable size."""
@@ -99,41 +2498,59 @@ def validate_downloaded_file(file_path, min_size_mb=0.1):
     
     return file_size >= min_size_bytes
 
-def process_formats(formats):
-    """Processes the raw format list for the single video view."""
-    video_formats, audio_formats = {}, {}
-    for f in formats:
-        filesize = f.get('filesize') or f.get('filesize_approx')
-        filesize_str = f"{filesize / 1024 / 1024:.2f} MB" if filesize else "N/A"
-        if f.get('vcodec') != 'none':
-            res = f.get('format_note') or (str(f.get('height')) + 'p' if f.get('height') else 'N/A')
-            if res not in video_formats:
-                video_formats[res] = {'format_id': f['format_id'], 'resolution': res, 'ext': f['ext'], 'filesize': filesize_str, 'type': 'video_only' if f.get('acodec') == 'none' else 'combined'}
-        if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-            q = f.get('format_note') or f"{f.get('abr', 0)}k"
-            if q not in audio_formats:
-                audio_formats[q] = {'format_id': f['format_id'], 'quality': q, 'ext': f['ext'], 'filesize': filesize_str, 'type': 'audio'}
-    sorted_videos = sorted(video_formats.values(), key=lambda x: (int(re.sub(r'\D', '', x['resolution'])) if re.sub(r'\D', '', x['resolution']).isdigit() else 0), reverse=True)
-    sorted_audios = sorted(audio_formats.values(), key=lambda x: (int(re.sub(r'\D', '', x['quality'])) if re.sub(r'\D', '', x['quality']).isdigit() else 0), reverse=True)
-    return sorted_videos, sorted_audios
-
-def merge_video_audio(video_file, audio_file, output_file):
-    """
-    Merges separate video and audio files using FFmpeg with robust error handling.
+# Containers that can hold each codec without re-encoding, in order of preference
+REMUX_CONTAINERS = (
+    ('mp4', {'h264', 'hevc', 'av1', 'mpeg4'}, {'aac', 'mp3', 'alac', 'ac3', 'eac3', 'opus', 'flac'}),
+    ('webm', {'vp8', 'vp9', 'av1'}, {'opus', 'vorbis'}),
+    ('mkv', None, None),    # Matroska holds anything
+)
+
+# Explicit transcode targets: name -> (video encoder, codec name, audio encoder, codec name, container)
+TRANSCODE_TARGETS = {
+    'h264': ('libx264', 'h264', 'aac', 'aac', 'mp4'),
+    'hevc': ('libx265', 'hevc', 'aac', 'aac', 'mp4'),
+    'vp9': ('libvpx-vp9', 'vp9', 'libopus', 'opus', 'webm'),
+}
+
+def probe_codecs(path):
+    """Returns (video codec, audio codec) of a media file from a single ffprobe JSON call."""
+    cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', path]
+    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    if proc.returncode != 0:
+        return None, None
+    codecs = {'video': None, 'audio': None}
+    for stream in json.loads(proc.stdout or '{}').get('streams', []):
+        kind = stream.get('codec_type')
+        if kind in codecs and not codecs[kind] and not stream.get('disposition', {}).get('attached_pic'):
+            codecs[kind] = stream.get('codec_name')
+    return codecs['video'], codecs['audio']
+
+def remux_container(video_codec, audio_codec):
+    for container, video_codecs, audio_codecs in REMUX_CONTAINERS:
+        if video_codecs is None or (video_codec in video_codecs and audio_codec in audio_codecs):
+            return container
+    return 'mkv'
+
+def merge_video_audio(video_file, audio_file, output_stem, target_codec=None):
+    """
+    Merges separate video and audio files into `output_stem`.<container> using FFmpeg.
 
     Strategy:
-      1) Validate input files exist and are readable
-      2) Try to copy video stream and encode audio to AAC: fastest and preserves video quality
-      3) If that fails, fallback to re-encoding video to libx264 and audio to aac for maximum compatibility
-      4) If both fail, try basic merge without specific codec settings
+      1) Probe both inputs for their codecs
+      2) Without a target codec: remux with `-c copy` into the first container that
+         can hold both streams (mp4, then webm, then mkv); retry as mkv if that fails
+      3) With a target codec (see TRANSCODE_TARGETS): re-encode only the streams
+         that are not already in the target codec
+
+    Returns a dict describing the merge (path, strategy, container, codecs, probe and total seconds) or None.
     """
     # Validate input files
     if not os.path.exists(video_file):
         logger.error(f"Video file not found: {video_file}")
-        return False
+        return None
     if not os.path.exists(audio_file):
         logger.error(f"Audio file not found: {audio_file}")
-        return False
+        return None
     
     # Check file sizes
     video_size = os.path.getsize(video_file)
@@ -141,102 +2558,167 @@ def merge_video_audio(video_file, audio_file, output_file):
     
     if video_size < 512:  # Less than 512 bytes
         logger.error(f"Video file too small: {video_size} bytes")
-        return False
+        return None
     if audio_size < 512:  # Less than 512 bytes
         logger.error(f"Audio file too small: {audio_size} bytes")
-        return False
-    
-    logger.info(f"Merging video ({video_size/1024/1024:.1f}MB) with audio ({audio_size/1024/1024:.1f}MB)")
-    
-    # Primary attempt: copy video stream, encode audio to aac
-    cmd_primary = [
-        'ffmpeg', '-y',
-        '-i', video_file,
-        '-i', audio_file,
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-b:a', '192k',
-        '-shortest',
-        '-avoid_negative_ts', 'make_zero',
-        output_file
-    ]
-
-    # Fallback: re-encode video + audio to compatible codecs
-    cmd_fallback = [
-        'ffmpeg', '-y',
-        '-i', video_file,
-        '-i', audio_file,
-        '-c:v', 'libx264',
-        '-preset', 'fast',
-        '-crf', '23',
-        '-c:a', 'aac',
-        '-b:a', '192k',
-        '-shortest',
-        '-avoid_negative_ts', 'make_zero',
-        output_file
-    ]
+        return None
     
-    # Last resort: basic merge
-    cmd_basic = [
-        'ffmpeg', '-y',
-        '-i', video_file,
-        '-i', audio_file,
-        '-shortest',
-        output_file
-    ]
-
+    started = time.monotonic()
     try:
-        # Try primary approach
-        logger.info("Attempting primary merge (copy video, encode audio)")
-        proc = subprocess.run(cmd_primary, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=300)
-        if proc.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
-            logger.info("Primary merge successful")
-            return True
+        video_codec, _ = probe_codecs(video_file)
+        _, audio_codec = probe_codecs(audio_file)
+        probe_seconds = round(time.monotonic() - started, 3)
+        logger.info(f"Merging video ({video_size/1024/1024:.1f}MB, {video_codec}) with audio ({audio_size/1024/1024:.1f}MB, {audio_codec})")
+
+        if target_codec in TRANSCODE_TARGETS:
+            video_encoder, video_target, audio_encoder, audio_target, container = TRANSCODE_TARGETS[target_codec]
+            codec_args = [
+                '-c:v', 'copy' if video_codec == video_target else video_encoder,
+                '-c:a', 'copy' if audio_codec == audio_target else audio_encoder,
+            ]
+            if video_codec != video_target and video_encoder in ('libx264', 'libx265'):
+                codec_args += ['-preset', 'fast', '-crf', '23']
+            if audio_codec != audio_target:
+                codec_args += ['-b:a', '192k']
+            strategy = 'transcode'
+            attempts = [(container, codec_args)]
         else:
-            logger.warning(f"Primary merge failed (return code: {proc.returncode}). stderr: {proc.stderr[:500]}")
-            
+            container = remux_container(video_codec, audio_codec)
+            strategy = 'remux'
+            attempts = [(container, ['-c', 'copy'])]
+            if container != 'mkv':
+                attempts.append(('mkv', ['-c', 'copy']))
+
+        for container, codec_args in attempts:
+            output_file = f"{output_stem}.{container}"
+            cmd = ['ffmpeg', '-y', '-i', video_file, '-i', audio_file, '-map', '0:v:0', '-map', '1:a:0',
+                   *codec_args, '-shortest', '-avoid_negative_ts', 'make_zero', output_file]
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                  timeout=600 if strategy == 'transcode' else 300)
+            if proc.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
+                result = {
+                    'path': output_file,
+                    'strategy': strategy,
+                    'container': container,
+                    'video_codec': video_codec,
+                    'audio_codec': audio_codec,
+                    'probe_seconds': probe_seconds,
+                    'seconds': round(time.monotonic() - started, 3),
+                }
+                logger.info(f"Merge successful: {strategy} into {container} in {result['seconds']:.2f}s")
+                MERGES.inc(strategy=strategy, container=container, result='ok')
+                MERGE_SECONDS.observe(result['seconds'], strategy=strategy, container=container)
+                return result
+            MERGES.inc(strategy=strategy, container=container, result='failed')
+            logger.warning(f"{strategy.capitalize()} into {container} failed (return code: {proc.returncode}). stderr: {proc.stderr[:500]}")
             # Clean up failed output
             if os.path.exists(output_file):
                 try:
                     os.remove(output_file)
-                except:
+                except OSError:
                     pass
-            
-            # Try fallback approach
-            logger.info("Attempting fallback merge (re-encode both streams)")
-            proc2 = subprocess.run(cmd_fallback, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=600)
-            if proc2.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
-                logger.info("Fallback merge successful")
-                return True
-            else:
-                logger.warning(f"Fallback merge failed (return code: {proc2.returncode}). stderr: {proc2.stderr[:500]}")
-                
-                # Clean up failed output
-                if os.path.exists(output_file):
-                    try:
-                        os.remove(output_file)
-                    except:
-                        pass
-                
-                # Try basic merge as last resort
-                logger.info("Attempting basic merge (no codec specification)")
-                proc3 = subprocess.run(cmd_basic, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=600)
-                if proc3.returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
-                    logger.info("Basic merge successful")
-                    return True
-                else:
-                    logger.error(f"All merge attempts failed. Basic merge stderr: {proc3.stderr[:500]}")
-                    return False
-                    
+        logger.error("All merge attempts failed")
+        return None
+
     except subprocess.TimeoutExpired:
         logger.error("FFmpeg merge timed out")
-        return False
+        return None
     except FileNotFoundError as fnf:
         logger.error(f"FFmpeg not found on system PATH: {fnf}")
-        return False
+        return None
     except Exception as e:
         logger.error(f"Unexpected FFmpeg error: {e}")
-        return False
+        return None
+
+def download_with_info(ydl, url):
+    """
+    Downloads `url` with an open YoutubeDL. When the preview left its info dict in info_cache,
+    formats are chosen from that dict instead of extracting the page a second time; a cache
+    miss, or cached format URLs that no longer work, fall back to a fresh extraction.
+    """
+    info = info_cache.get(url)
+    if not info or info.get('_type', 'video') != 'video':
+        INFO_REUSE.inc(result='miss')
+        ydl.download([url])
+        return
+    INFO_REUSE.inc(result='hit')
+    try:
+        ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+    except yt_dlp.DownloadError as e:
+        if isinstance(e, DownloadCancelled) or 'cancelled' in str(e).lower():
+            raise
+        logger.warning(f"Download from cached info failed ({e}), extracting {url} again")
+        ydl.download([url])
+
+def download_playlist_entry(video_url, entry_dir, selector, progress_hook):
+    """Downloads one playlist entry into its own folder. `selector` is a yt-dlp format string or callable. Raises on failure."""
+    os.makedirs(entry_dir, exist_ok=True)
+    ydl_opts = {
+        'format': selector,
+        'outtmpl': os.path.join(entry_dir, '%(title)s.%(ext)s'),
+        'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': 'mp4'}],
+        'progress_hooks': [progress_hook],
+        'ignoreerrors': False,
+        'noprogress': True,
+        'quiet': True,
+        'http_headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        }
+    }
+    # YoutubeDL instances are not thread-safe, so every worker builds its own
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        download_with_info(ydl, video_url)
+
+def download_streams(url, streams, on_progress=None, timeline=None, sizes=None):
+    """
+    Downloads several formats of one URL concurrently, e.g. the video and audio of a merge.
+
+    `streams` maps a role to its YoutubeDL options. `on_progress(downloaded, total, speed)`
+    receives byte totals summed over all streams, so the percentage is weighted by size.
+    A stream that has not reported its total yet counts at its expected size from `sizes`
+    ({role: bytes}); without one the combined total is unknown and reported as 0.
+    With a JobTimeline, each stream is recorded as a phase named after its role.
+    Returns {role: exception or None}.
+    """
+    progress = {role: (0, 0, 0) for role in streams}
+    sizes = sizes or {}
+    lock = threading.Lock()
+
+    def make_hook(role):
+        def hook(d):
+            if d.get('status') != 'downloading':
+                return
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            with lock:
+                progress[role] = (d.get('downloaded_bytes') or 0, total, d.get('speed') or 0)
+                downloaded, speed = (sum(p[k] for p in progress.values()) for k in (0, 2))
+                # A partial sum would make the percentage jump back once the next stream reports its total
+                totals = [p[1] or sizes.get(r, 0) for r, p in progress.items()]
+                total = sum(totals) if all(totals) else 0
+            if on_progress:
+                on_progress(downloaded, total, speed)
+        return hook
+
+    def run(role):
+        opts = dict(streams[role], progress_hooks=list(streams[role].get('progress_hooks', [])) + [make_hook(role)])
+        # YoutubeDL instances are not thread-safe, so every stream gets its own
+        with (timeline.phase(role) if timeline else nullcontext()), yt_dlp.YoutubeDL(opts) as ydl:
+            download_with_info(ydl, url)
+
+    with ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix='stream') as pool:
+        futures = {role: pool.submit(run, role) for role in streams}
+    return {role: future.exception() for role, future in futures.items()}
+
+def expected_sizes(info, formats):
+    """Expected bytes of each {role: format_id} from already extracted info; roles with no known size are left out."""
+    index = format_index(info) if info else None
+    rows = {role: index.get(format_id) for role, format_id in formats.items() if format_id} if index else {}
+    return {role: row.size for role, row in rows.items() if row and row.size}
+
+def format_extension(info, format_id, default='mp4'):
+    """File extension yt-dlp will use for `format_id`, from already extracted info."""
+    row = format_index(info).get(format_id) if info else None
+    return (row and row.ext) or default
 
 def format_duration(seconds):
     if seconds is None: return "N/A"
@@ -254,19 +2736,441 @@ def get_embeddable_url(info):
     if 'dailymotion' in extractor: return f"https://www.dailymotion.com/embed/video/{video_id}"
     return None
 
+# ==============================================================================
+# PLAYLIST ARCHIVES
+# ==============================================================================
+
+def zip_compress_type(filename):
+    """Media is already compressed, so it is stored as-is; anything else is deflated."""
+    return zipfile.ZIP_STORED if os.path.splitext(filename)[1].lower() in MEDIA_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+def playlist_members(playlist_dir, seen=None):
+    """Returns (path, arcname) pairs in playlist order, skipping partial downloads and renaming duplicate titles."""
+    members = []
+    seen = set() if seen is None else seen
+    # Entry folders are zero-padded, so sorted order is playlist order
+    for root, dirs, files in os.walk(playlist_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(PARTIAL_DOWNLOAD_SUFFIXES):
+                continue
+            arcname = file
+            if arcname in seen:
+                arcname = f"{os.path.basename(root)}_{file}"
+            seen.add(arcname)
+            members.append((os.path.join(root, file), arcname))
+    return members
+
+class PlaylistArchive:
+    """
+    On-disk playlist ZIP that grows while the playlist downloads.
+
+    Workers report each finished entry; entries are appended in playlist order
+    (an entry waits until all earlier ones are reported) on a single archiver
+    thread, and an entry's folder is deleted once all its files are written so
+    peak disk usage stays near the size of the archive itself.
+
+    An interrupted run never writes the central directory, so a resumed job
+    starts a new archive; entries whose folders are gone are downloaded again
+    (see playlist_download_job).
+    """
+
+    def __init__(self, zip_filepath):
+        self.zip_filepath = zip_filepath
+        self._zipf = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._finished = {}     # entry index -> entry folder (None if nothing to add)
+        self._next_index = 0
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+        self._build_seconds = 0.0
+
+    def entry_finished(self, index, entry_dir):
+        """Called from worker threads once an entry succeeded or failed."""
+        with self._lock:
+            if self._closed:
+                return
+            self._finished[index] = entry_dir
+            while self._next_index in self._finished:
+                entry_dir = self._finished.pop(self._next_index)
+                self._next_index += 1
+                if entry_dir:
+                    self._writer.submit(self._append, entry_dir)
+
+    def _append(self, entry_dir):
+        started = time.monotonic()
+        try:
+            for path, arcname in playlist_members(entry_dir, self._seen):
+                self._zipf.write(path, arcname=arcname, compress_type=zip_compress_type(arcname))
+            # Only a fully written entry loses its files; a run stopped mid-entry still has them to resume from
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        except Exception as e:
+            logger.error(f"Failed to archive {entry_dir}: {e}")
+        self._build_seconds += time.monotonic() - started
+
+    def close(self):
+        """Waits for pending appends and writes the central directory."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._writer.shutdown(wait=True)
+        started = time.monotonic()
+        self._zipf.close()
+        ZIP_BUILD_SECONDS.observe(self._build_seconds + time.monotonic() - started, mode='file')
+
+class _ZipChunkSink:
+    """Write-only, unseekable file object that collects zipfile output for streaming."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(members, chunk_size=ZIP_STREAM_CHUNK_SIZE):
+    """
+    Generates a ZIP archive of (path, arcname) members chunk by chunk, without a
+    temporary archive on disk. zipfile switches to data descriptors on an
+    unseekable sink and adds ZIP64 records automatically for large archives.
+    """
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for path, arcname in members:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zip_compress_type(arcname)
+            with open(path, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+def zip_etag(members):
+    """
+    ETag for the archive stream_zip() would produce from `members`. The output is
+    deterministic for unchanged files, so a streamed archive and its materialized
+    copy share one tag and If-Range resumes across the two.
+    """
+    digest = hashlib.sha1()
+    for path, arcname in members:
+        stat = os.stat(path)
+        digest.update(f"{arcname}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def materialize_zip(playlist_dir, zip_path):
+    """Writes the streamed archive of `playlist_dir` to `zip_path` (same bytes as the stream)."""
+    tmp_path = zip_path + '.part'
+    with ZIP_BUILD_SECONDS.time(mode='materialize'), open(tmp_path, 'wb') as fh:
+        for chunk in stream_zip(playlist_members(playlist_dir)):
+            fh.write(chunk)
+    os.replace(tmp_path, zip_path)
+    return zip_path
+
+def materialize_in_background(artifact):
+    """
+    Builds the file form of a streamed playlist ZIP so later requests can get byte ranges.
+    The loose entry files are deleted only once no streamed transfer still reads them.
+    Caller holds artifact.lock.
+    """
+    if artifact.materializing:
+        return
+    artifact.materializing = True
+    playlist_dir = artifact.final_path
+
+    def build():
+        try:
+            zip_path = materialize_zip(playlist_dir, os.path.join(artifact.dir, 'playlist.zip'))
+        except Exception as e:
+            logger.error(f"Materializing ZIP of {artifact.job_id} failed: {e}")
+            with artifact.lock:
+                artifact.materializing = False
+            return
+        with artifact.lock:
+            artifact.final_path = zip_path
+            artifact.materializing = False
+        artifacts.when_idle(artifact, lambda: shutil.rmtree(playlist_dir, ignore_errors=True))
+
+    threading.Thread(target=build, name=f"zip-{artifact.job_id[:8]}", daemon=True).start()
+
+
+# ==============================================================================
+# PIPE DOWNLOADS (bytes sent to the client while they download)
+# ==============================================================================
+
+def start_pipe_download(url, format_selector, audio_format=None):
+    """
+    Starts yt-dlp writing `format_selector` to a pipe. With `audio_format`, a second
+    yt-dlp feeds the audio and ffmpeg remuxes both into fragmented MP4 on its stdout.
+    Nothing touches the disk.
+
+    Blocks until the first bytes are available and returns (processes, first_chunk),
+    where the last process is the one whose stdout carries the output; or None if
+    the pipeline could not start.
+    """
+    def fetch(selector):
+        return subprocess.Popen(
+            [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-part', '--no-playlist',
+             '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+             '-f', selector, '-o', '-', url],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    started = time.monotonic()
+    processes = []
+    try:
+        processes.append(fetch(format_selector))
+        if audio_format:
+            processes.append(fetch(audio_format))
+            video, audio = processes
+            audio_fd = audio.stdout.fileno()
+            try:
+                processes.append(subprocess.Popen(
+                    ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-i', f'pipe:{audio_fd}',
+                     '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy',
+                     '-movflags', PIPE_MERGE_MOVFLAGS, '-f', 'mp4', 'pipe:1'],
+                    stdin=video.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(audio_fd,)))
+            finally:
+                # ffmpeg holds its own copies of the read ends
+                video.stdout.close()
+                audio.stdout.close()
+    except OSError as e:
+        logger.error(f"Streaming download unavailable: {e}")
+        stop_processes(processes)
+        return None
+
+    output = processes[-1]
+    first_chunk = output.stdout.read1(PIPE_CHUNK_SIZE)
+    if not first_chunk:
+        output.wait()
+        stderr = output.stderr.read()[:500] if output.stderr else ''
+        logger.error(f"Streaming download produced no output (return code: {output.returncode}). {stderr}")
+        stop_processes(processes)
+        return None
+    logger.info(f"Streaming download sent its first bytes after {time.monotonic() - started:.2f}s")
+    return processes, first_chunk
+
+def stop_processes(processes):
+    for proc in processes:
+        if proc.poll() is None:
+            proc.kill()
+    for proc in processes:
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+
+def pipe_download_response(piped, job_id, ticket, download_name):
+    """
+    Streams a started pipe download to the client. Owns the job's scheduler ticket
+    and registration from here on.
+
+    Chunks are read from the pipe only as the client consumes them, so a slow client
+    fills the pipe buffer and yt-dlp/ffmpeg block on write (backpressure). A client
+    disconnect closes the generator, which kills the pipeline.
+    """
+    processes, first_chunk = piped
+    output = processes[-1]
+
+    def generate():
+        sent = len(first_chunk)
+        started = time.monotonic()
+        try:
+            yield first_chunk
+            while not scheduler.is_cancelled(job_id):
+                chunk = output.stdout.read1(PIPE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                yield chunk
+            logger.info(f"Streaming download finished: {sent / 1024 / 1024:.1f} MB sent")
+            observe_job('pipe', sent, time.monotonic() - started)
+        finally:
+            stop_processes(processes)
+            scheduler.release(ticket)
+            scheduler.unregister(job_id)
+
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+    if len(processes) > 1:
+        response.headers['X-Merge-Strategy'] = 'remux/fmp4-pipe'
+    return response
+
+
+# ==============================================================================
+# WORKER POOL (runs queued jobs outside the web process)
+# ==============================================================================
+
+def job_response(job_id, after=0):
+    """SSE response following a queued job; AsgiServer follows it on its event loop instead of a thread."""
+    response = Response(count_sse(job_queue.follow(job_id, after)), mimetype='text/event-stream')
+    response.follow_job = (job_id, after)
+    return response
+
+def job_accepted_response(job):
+    """202 for a job that is not over yet, pointing the client at its progress stream."""
+    events_url = url_for('job_events', job_id=job['id'])
+    response = jsonify({'session_id': job['id'], 'state': job['state'], 'position': job_queue.position(job['id']),
+                        'events': events_url, 'status': url_for('job_status', job_id=job['id'])})
+    response.status_code = 202
+    response.headers['Location'] = events_url
+    return response
+
+def start_job(kind, params):
+    """SSE response for a new job: run right here, or enqueued for a worker process when the job queue is on."""
+    if job_queue:
+        return job_response(job_queue.enqueue(kind, params, JOB_PRIORITIES[kind]))
+    return Response(count_sse(JOB_RUNNERS[kind](params, str(uuid.uuid4()))), mimetype='text/event-stream')
+
+def run_job(job):
+    """Runs one claimed job in this worker, storing its events and handing its output to the web process."""
+    job_id = job['id']
+    last_event, merge = {}, None
+    chunks = JOB_RUNNERS[job['kind']](job['params'], job_id)
+    try:
+        for chunk in chunks:
+            if chunk == SSE_HEARTBEAT:
+                continue
+            job_queue.append_event(job_id, chunk)
+            if chunk.startswith('data: {'):
+                last_event = json.loads(chunk[6:])
+                merge = last_event.get('merge', merge)
+    except Exception as e:
+        logger.error(f"Job {job_id} crashed: {e}")
+        job_queue.finish(job_id, 'failed', event={'status': 'error', 'message': f'An unexpected error occurred: {e}'})
+        return
+    finally:
+        chunks.close()
+
+    artifact = artifacts.detach(job_id)
+    if artifact and artifact.state == 'ready':
+        path = artifact.final_path
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(artifact.dir) and os.path.isfile(path):
+            # Served from the download cache: give the job its own link so eviction can't pull it away
+            path = artifact.link(path, artifact.download_name)
+        for callback in artifact.on_remove:
+            callback()
+        job_queue.finish(job_id, 'done', {'final_path': path, 'download_name': artifact.download_name, 'merge': merge})
+        # Web processes adopt the job from the queue now (see adopt_job), which claims the folder again
+        artifact.release_claim()
+    else:
+        if artifact:
+            artifacts.remove(job_id)
+        job_queue.finish(job_id, 'cancelled' if last_event.get('status') == 'cancelled' else 'failed')
+
+def worker_main(max_jobs=WORKER_JOBS):
+    """Claims and runs queued jobs until SIGTERM/SIGINT; at most `max_jobs` at once."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = threading.Event()
+    running = {}
+
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def heartbeat():
+        while not stopping.is_set():
+            try:
+                job_queue.heartbeat(worker_id)
+                for job_id in job_queue.cancel_requests(worker_id):
+                    scheduler.cancel(job_id)
+            except sqlite3.Error as e:
+                logger.warning(f"Worker heartbeat failed: {e}")
+            stopping.wait(WORKER_HEARTBEAT_INTERVAL)
+    job_queue.heartbeat(worker_id)
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    logger.info(f"Worker {worker_id} started (up to {max_jobs} jobs at once)")
+
+    while not stopping.is_set():
+        for job_id in [j for j, thread in running.items() if not thread.is_alive()]:
+            del running[job_id]
+        job = None
+        if len(running) < max_jobs:
+            job_queue.reap_stale()
+            job = job_queue.claim(worker_id)
+        if job:
+            logger.info(f"Worker {worker_id} running {job['kind']} job {job['id']}")
+            running[job['id']] = threading.Thread(target=run_job, args=(job,), name=f"job-{job['id'][:8]}", daemon=True)
+            running[job['id']].start()
+        else:
+            stopping.wait(JOB_POLL_INTERVAL)
+
+    # Shutting down: hand unfinished jobs back to the queue. Their partial files stay
+    # in place, and the next worker to claim them resumes where this one stopped.
+    unfinished = [job_id for job_id, thread in running.items() if thread.is_alive()]
+    for job_id in unfinished:
+        job_queue.release(job_id)
+    job_queue.remove_worker(worker_id)
+    logger.info(f"Worker {worker_id} stopped ({len(unfinished)} job(s) handed back)")
+    if unfinished:
+        os._exit(0)     # don't let download threads (or their cleanup) run on past the hand-off
+
+def run_workers(processes):
+    """Runs `processes` worker processes (one per core by default) and waits for them."""
+    if processes <= 1:
+        worker_main()
+        return
+    os.environ['ANYVIDOW_ROLE'] = 'worker'      # children re-import this module as workers
+    context = multiprocessing.get_context('spawn')
+    children = [context.Process(target=worker_main, name=f'worker-{i}') for i in range(processes)]
+    for child in children:
+        child.start()
+
+    def stop(signum, frame):
+        for child in children:
+            child.terminate()       # SIGTERM: each worker hands its jobs back and unregisters
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()
+
+def spawn_workers(count):
+    """Starts detached worker processes up to `count` live workers; they keep running across web restarts."""
+    missing = count - job_queue.live_workers()
+    if missing > 0:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--processes', str(missing)],
+                         start_new_session=True)
+        logger.info(f"Started {missing} worker process(es)")
+
+
 # ============================================================================== 
 # MIDDLEWARE & AUTHENTICATION (No Changes)
 # ============================================================================== 
 @app.after_request
 def add_no_cache_headers(response):
+    if response.cache_control.immutable:
+        return response     # thumbnails are cached by the browser for good
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+@app.before_request
+def ensure_janitor():
+    # WSGI servers that import `app` (gunicorn, ...) have no startup hook; the first request starts it
+    if not janitor_started:
+        start_janitor()
+
 @app.before_request
 def require_login():
-    allowed_routes = ['login', 'static']
+    allowed_routes = ['login', 'static', 'metrics_endpoint']     # /metrics checks its own token
     if request.endpoint not in allowed_routes and not session.get('logged_in'):
         return redirect(url_for('login'))
 
@@ -314,52 +3218,152 @@ def terms(): return render_template('terms.html')
 # API & DOWNLOAD ROUTES
 # ============================================================================== 
 
-@app.route('/api/fetch_info', methods=['POST'])
-def fetch_info():
-    """Universal endpoint to fetch info for either a single video or a playlist."""
-    url = request.json.get('url')
-    if not url: return jsonify({'error': 'URL is required'}), 400
+info_pool = ThreadPoolExecutor(max_workers=INFO_BATCH_WORKERS, thread_name_prefix='info')
 
+def describe_url(url):
+    """The /api/fetch_info payload for a single video or a playlist. Returns (payload, error message)."""
     # First, quickly check if it's a playlist
     is_playlist = 'list=' in url or '/playlist/' in url or '/sets/' in url
 
     info = get_video_info(url, quick_fetch=is_playlist)
     if not info:
-        return jsonify({'error': 'Unable to fetch info. The URL may be invalid or unsupported.'}), 500
+        return None, 'Unable to fetch info. The URL may be invalid or unsupported.'
 
     # If the response indicates a playlist, handle it as a playlist
     if 'entries' in info or info.get('_type') == 'playlist':
         entries = [e for e in info.get('entries', []) if e]
-        thumbnail = info.get('thumbnail')
-        if not thumbnail and entries and entries[0]:
-            # Fallback: get thumbnail from the first video
-            first_video_info = get_video_info(entries[0]['url'])
-            if first_video_info: thumbnail = first_video_info.get('thumbnail')
+        thumbnail = thumbnail_url(best_thumbnail(info))
+        if not thumbnail and entries:
+            # Fallback: the first video's thumbnail, looked up by the proxy when it is first shown
+            thumbnail = thumbnail_url(best_thumbnail(entries[0])) or thumbnail_url(entries[0].get('url'), page=True)
         
-        return jsonify({
+        return {
             'type': 'playlist',
             'title': info.get('title', 'Playlist'),
             'author': info.get('uploader', 'Unknown Artist'),
             'thumbnail': thumbnail, 
             'video_count': len(entries),
             'original_url': info.get('webpage_url'),
-            'videos': [{'id': v.get('id'), 'title': v.get('title', 'Untitled'), 'url': v.get('url'), 'duration': format_duration(v.get('duration'))} for v in entries if v]
-        })
+            'videos': [{'id': v.get('id'), 'title': v.get('title', 'Untitled'), 'url': v.get('url'), 'duration': format_duration(v.get('duration')),
+                        'thumbnail': thumbnail_url(best_thumbnail(v))} for v in entries if v]
+        }, None
     
     # Otherwise, handle it as a single video
     else:
-        video_formats, audio_formats = process_formats(info.get('formats', []))
+        index = format_index(info)
+        video_formats, audio_formats = index.listing()
+        best_audio = index.best_audio()
         author_url = info.get('channel_url') or info.get('uploader_url')
         if author_url and not author_url.startswith(('http://', 'https://')): author_url = None
-        return jsonify({
+        return {
             'type': 'video',
             'title': info.get('title', 'No Title'),'author': info.get('uploader', 'Unknown Author'),'author_url': author_url,
-            'platform': info.get('extractor_key', 'Unknown'),'thumbnail': info.get('thumbnail'),
+            'platform': info.get('extractor_key', 'Unknown'),'thumbnail': thumbnail_url(best_thumbnail(info)),
             'original_url': info.get('webpage_url'),'embed_url': get_embeddable_url(info),
             'duration': format_duration(info.get('duration')),'upload_date': format_upload_date(info.get('upload_date')),
             'like_count': f"{info.get('like_count') or 0:,}",'video_formats': video_formats,'audio_formats': audio_formats,
-            'best_audio_id': audio_formats[0]['format_id'] if audio_formats else None
-    })
+            'best_audio_id': best_audio.format_id if best_audio else None
+        }, None
+
+@app.route('/api/fetch_info', methods=['POST'])
+def fetch_info():
+    """Universal endpoint to fetch info for either a single video or a playlist."""
+    url = request.json.get('url')
+    if not url: return jsonify({'error': 'URL is required'}), 400
+
+    payload, error = describe_url(url)
+    if error:
+        return jsonify({'error': error}), 500
+    return jsonify(payload)
+
+@app.route('/api/fetch_info_batch', methods=['POST'])
+def fetch_info_batch():
+    """
+    Fetches info for many URLs concurrently. One result per URL is streamed as soon as it
+    is ready, as NDJSON lines (default) or SSE events (`Accept: text/event-stream`).
+    Each result has `index`, `url` and either `info` or `error`; a final `done` line follows.
+    """
+    urls = (request.get_json(silent=True) or {}).get('urls')
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return jsonify({'error': 'A list of URLs is required'}), 400
+    if len(urls) > INFO_BATCH_MAX_URLS:
+        return jsonify({'error': f'At most {INFO_BATCH_MAX_URLS} URLs per request'}), 400
+    urls = [url.strip() for url in urls]
+    sse = request.accept_mimetypes.best_match(['application/x-ndjson', 'text/event-stream']) == 'text/event-stream'
+
+    def emit(result):
+        return f"data: {json.dumps(result)}\n\n" if sse else json.dumps(result) + "\n"
+
+    def generate():
+        # The same URL pasted twice is resolved once
+        indexes = {}
+        for i, url in enumerate(urls):
+            indexes.setdefault(url, []).append(i)
+        futures = {info_pool.submit(describe_url, url): url for url in indexes if url}
+        failed = 0
+        try:
+            if '' in indexes:
+                for i in indexes['']:
+                    failed += 1
+                    yield emit({'index': i, 'url': '', 'error': 'URL is required'})
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=SSE_HEARTBEAT_INTERVAL, return_when=FIRST_COMPLETED)
+                if not done and sse:
+                    yield SSE_HEARTBEAT
+                for future in done:
+                    url = futures[future]
+                    try:
+                        payload, error = future.result()
+                    except Exception as e:
+                        logger.error(f"Batch info for {url} failed: {e}")
+                        payload, error = None, f'An unexpected error occurred: {e}'
+                    for i in indexes[url]:
+                        failed += bool(error)
+                        yield emit({'index': i, 'url': url, 'error': error} if error else {'index': i, 'url': url, 'info': payload})
+            yield emit({'done': True, 'total': len(urls), 'failed': failed})
+            if sse:
+                yield "data: [DONE]\n\n"
+        finally:
+            # Client went away: drop the lookups that haven't started
+            for future in futures:
+                future.cancel()
+
+    if sse:
+        return Response(count_sse(generate()), mimetype='text/event-stream')
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/thumb/<key>')
+def thumbnail(key):
+    """
+    Serves a thumbnail through the on-disk cache. `?w=` asks for a narrower copy (rounded up
+    to one of THUMB_WIDTHS), and browsers that accept WebP get WebP.
+    """
+    source = thumbnail_source(key)
+    if not source:
+        return Response("Unknown thumbnail.", status=404)
+    url, is_page = source
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    try:
+        requested = int(request.args.get('w', 0))
+    except ValueError:
+        requested = 0
+    width = next((w for w in THUMB_WIDTHS if w >= requested), THUMB_WIDTHS[-1]) if requested > 0 else None
+    webp = 'image/webp' in request.headers.get('Accept', '')
+
+    variant = f"{digest}.{f'w{width}' if width else 'full'}.{'webp' if webp else 'jpg'}" if width or webp else None
+    path = thumb_cache.get(variant) if variant else None
+    if not path:
+        path = load_thumbnail(digest, url, is_page)
+        if not path:
+            return Response("Thumbnail unavailable.", status=404)
+        if width or (webp and not path.endswith('.webp')):
+            path = render_thumbnail(variant, path, width, webp)
+    # Hits touch the file's mtime, so the ETag comes from the name (one name, one content)
+    response = send_file(path, max_age=THUMB_MAX_AGE, etag=os.path.basename(path))
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
 
 @app.route('/cancel_download', methods=['POST'])
 def cancel_download():
@@ -368,431 +3372,425 @@ def cancel_download():
     if not session_id:
         return jsonify({'error': 'Session ID required'}), 400
     
-    if session_id in active_downloads:
-        active_downloads[session_id]['cancelled'] = True
+    if scheduler.cancel(session_id) or (job_queue and job_queue.request_cancel(session_id)):
         return jsonify({'success': True})
     
     return jsonify({'error': 'Download not found'}), 404
 
+@app.route('/api/storage')
+def storage_stats():
+    """Disk usage and cleanup counters for the downloads folder, the download cache and the metadata cache."""
+    return jsonify({
+        'downloads': janitor.stats(),
+        'cache': download_cache.stats() if download_cache else None,
+        'info_cache': info_cache.stats(),
+        'queue': job_queue.stats() if job_queue else None,
+    })
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """State of a queued job, for clients deciding whether to reattach to its progress stream."""
+    job = job_queue.get(job_id) if job_queue else None
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    entries = job_queue.entries(job_id)
+    return jsonify({
+        'id': job['id'],
+        'kind': job['kind'],
+        'state': job['state'],
+        'attempts': job['attempts'],
+        'position': job_queue.position(job_id),
+        'entries': {'done': sum(state == 'done' for _, state in entries.values()),
+                    'failed': sum(state == 'failed' for _, state in entries.values())},
+    })
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """Reattaches to a job's SSE stream, replaying the events after Last-Event-ID (or ?after=)."""
+    if not job_queue or not job_queue.get(job_id):
+        return Response("Job not found", status=404)
+    after = request.headers.get('Last-Event-ID') or request.args.get('after') or 0
+    try:
+        after = int(after)
+    except ValueError:
+        return Response("Invalid event ID", status=400)
+    return job_response(job_id, after)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint. Open unless ANYVIDOW_METRICS_TOKEN is set."""
+    if METRICS_TOKEN and not session.get('logged_in'):
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+            return "Unauthorized", 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/stream_single_download')
 def stream_single_download():
     """Handles single video download with real-time progress updates."""
-    url = request.args.get('url')
-    format_id = request.args.get('format_id')
-    title = request.args.get('title')
-    file_type = request.args.get('type')
-    best_audio_id = request.args.get('best_audio_id')
-
-    if not all([url, format_id, title, file_type]):
+    params = {name: request.args.get(name) for name in ('url', 'format_id', 'title', 'type', 'best_audio_id', 'codec')}
+    if not all(params[name] for name in ('url', 'format_id', 'title', 'type')):
         return Response("Missing required parameters", status=400)
+    if params['codec'] and params['codec'] not in TRANSCODE_TARGETS:
+        return Response(f"Unsupported codec. Choose from: {', '.join(TRANSCODE_TARGETS)}", status=400)
+    return start_job('single', params)
+
+def single_download_job(params, session_id):
+    """Downloads one video (merging separate streams when needed); yields SSE progress events."""
+    url = params['url']
+    format_id = params['format_id']
+    title = params['title']
+    file_type = params['type']
+    best_audio_id = params.get('best_audio_id')
+    target_codec = params.get('codec')    # re-encode only when explicitly requested
 
     def generate():
         safe_title = sanitize_filename(title)
-        session_id = str(uuid.uuid4())
         
-        # Track this download
-        active_downloads[session_id] = {'cancelled': False, 'process': None}
+        # Track this download; its files live in their own subdirectory
+        scheduler.register(session_id, 'single')
+        artifact = artifacts.create(session_id)
+        ticket = None
+        flight, leading, shared, flight_landed = None, False, None, False
         
         # Initialize variables outside try block
         nonlocal best_audio_id
-        progress_data = {'video_done': False, 'audio_done': False, 'current_progress': None, 'should_stop': False}
+        progress_data = {'video_done': False, 'audio_done': False}
+        channel = ProgressChannel()
+        is_cancelled = lambda: scheduler.is_cancelled(session_id)
+        timeline = JobTimeline(session_id, 'single', format_id=format_id, type=file_type, codec=target_codec)
         
         try:
-            yield f"data: {json.dumps({'status': 'starting', 'message': 'Initializing download...'})}\n\n"
+            yield f"data: {json.dumps({'status': 'starting', 'session_id': session_id, 'message': 'Initializing download...'})}\n\n"
             
             # Initialize best_audio_id if needed
             if not best_audio_id:
-                info = get_video_info(url)
+                with timeline.phase('extract'):
+                    info = get_video_info(url)
                 if info:
                     best_audio_id = get_best_audio_format(info)
             
-            def progress_hook(d):
-                # Check if cancelled at every progress update
-                if active_downloads.get(session_id, {}).get('cancelled'):
-                    raise yt_dlp.DownloadError("Download cancelled by user")
-                    
-                if d['status'] == 'downloading':
-                    downloaded = d.get('downloaded_bytes', 0)
-                    total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                    speed = d.get('speed', 0)
-                    eta = d.get('eta', 0)
-                    
-                    if total > 0:
-                        percent = (downloaded / total) * 100
-                        speed_str = f"{speed / 1024 / 1024:.1f} MB/s" if speed else "N/A"
-                        size_str = f"{downloaded / 1024 / 1024:.1f} MB / {total / 1024 / 1024:.1f} MB"
-                        if eta:
-                            eta_mins = int(eta // 60)
-                            eta_secs = int(eta % 60)
-                            eta_str = f"{eta_mins:02d}:{eta_secs:02d}"
-                        else:
-                            eta_str = "N/A"
-                        
-                        phase = 'video' if not progress_data['video_done'] else 'audio'
-                        message = f"Downloading {phase}... {percent:.1f}%"
-                        
-                        progress_data['current_progress'] = {
-                            'status': 'downloading',
-                            'phase': phase,
-                            'progress': percent,
-                            'speed': speed_str,
-                            'size': size_str,
-                            'eta': eta_str,
-                            'message': message,
-                            'session_id': session_id
-                        }
-                        
-                elif d['status'] == 'finished':
-                    if not progress_data['video_done']:
-                        progress_data['video_done'] = True
-                    else:
-                        progress_data['audio_done'] = True
-            
-            def progress_sender():
-                while not progress_data['should_stop']:
-                    if progress_data['current_progress']:
-                        try:
-                            yield f"data: {json.dumps(progress_data['current_progress'])}\n\n"
-                        except:
-                            pass
-                    time.sleep(0.5)
-            
-            # Start progress sender in background
-            import queue
-            progress_queue = queue.Queue()
-            
-            def queue_progress():
-                while not progress_data['should_stop'] and not active_downloads.get(session_id, {}).get('cancelled'):
-                    if progress_data['current_progress']:
-                        progress_queue.put(progress_data['current_progress'])
-                    time.sleep(0.5)
+            # Cache hit: skip yt-dlp and ffmpeg entirely
+            cache_key = download_cache_key(url, format_id, file_type, best_audio_id, target_codec)
+            cached_path = claim_cached_download(artifact, cache_key)
+            if cached_path:
+                artifacts.mark_ready(session_id, cached_path, download_name=f"{safe_title}{os.path.splitext(cached_path)[1]}")
+                timeline.attrs.update(cached=True, bytes=os.path.getsize(cached_path))
+                yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!', 'cached': True})}\n\n"
+                yield f"data: {json.dumps({'status': 'ready', 'session_id': session_id, 'filename': artifact.download_name, 'message': 'Ready for download!', 'timeline': timeline.finish('ready')})}\n\n"
+                yield "data: [DONE]\n\n"
+                return
             
-            progress_thread = threading.Thread(target=queue_progress, daemon=True)
-            progress_thread.start()
-
-            fallback_selector = "bv*+ba/b"
-            final_file_path = None
+            # An identical download is already running: follow it instead of fetching twice
+            flight_key = download_flight_key(cache_key, url, format_id, file_type, best_audio_id, target_codec)
+            flight, leading = flights.join(flight_key)
+            while not leading:
+                yield f"data: {json.dumps({'status': 'downloading', 'phase': 'video', 'progress': 0, 'session_id': session_id, 'message': 'Joining an identical download in progress...'})}\n\n"
+                with timeline.phase('follow'):
+                    shared = yield from follow_flight(flight, session_id, is_cancelled)
+                if shared:
+                    shared_path, final_filename = shared
+                    artifacts.mark_ready(session_id, artifact.link(shared_path, final_filename), download_name=final_filename)
+                    timeline.attrs.update(coalesced=True, bytes=os.path.getsize(shared_path))
+                    yield f"data: {json.dumps({'status': 'ready', 'session_id': session_id, 'filename': final_filename, 'message': 'Ready for download!', 'timeline': timeline.finish('ready')})}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return
+                if is_cancelled():
+                    yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
+                    return
+                if not flight.abandoned:
+                    yield f"data: {json.dumps({'status': 'error', 'message': 'Download failed.'})}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return
+                # The leader was cancelled; take over
+                flight, leading = flights.join(flight_key)
 
-            if file_type != 'video_only':
-                yield f"data: {json.dumps({'status': 'downloading', 'phase': 'video', 'progress': 0, 'message': 'Starting download...'})}\n\n"
-                
-                outtmpl = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{session_id}.%(ext)s")
-                # Custom hook to check cancellation more frequently
-                def cancellation_hook(d):
-                    if active_downloads.get(session_id, {}).get('cancelled'):
-                        raise yt_dlp.DownloadError("Download cancelled by user")
-                    progress_hook(d)
-                
-                ydl_opts = {
-                    'format': f"{format_id}/{fallback_selector}",
-                    'outtmpl': outtmpl,
-                    'merge_output_format': 'mp4',
-                    'progress_hooks': [cancellation_hook],
-                    'hookwarning': False,
-                    'http_headers': {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    }
-                }
+            def download():
+                nonlocal ticket
+                cacheable = False
                 
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    # Start sending progress updates
-                    start_time = time.time()
-                    
-                    def download_with_check():
-                        try:
-                            ydl.download([url])
-                        except yt_dlp.DownloadError as e:
-                            if "cancelled" in str(e).lower():
-                                return  # Exit gracefully on cancellation
-                            raise e
-                        except Exception as e:
-                            if active_downloads.get(session_id, {}).get('cancelled'):
-                                return  # Exit gracefully on cancellation
-                            raise e
-                    
-                    # Download in separate thread to allow progress updates
-                    download_thread = threading.Thread(target=download_with_check)
-                    download_thread.start()
-                    
-                    # Send progress updates while downloading
-                    while download_thread.is_alive():
-                        if active_downloads.get(session_id, {}).get('cancelled'):
+                # Wait for a download slot, reporting queue position meanwhile
+                ticket = scheduler.enqueue(session_id, url, SINGLE_DOWNLOAD_PRIORITY)
+                last_position, last_sent = None, time.monotonic()
+                with timeline.phase('queue'):
+                    while not scheduler.wait(ticket, timeout=QUEUE_POSITION_INTERVAL):
+                        if scheduler.is_cancelled(session_id):
                             yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
                             return
-                        try:
-                            progress = progress_queue.get_nowait()
-                            yield f"data: {json.dumps(progress)}\n\n"
-                        except queue.Empty:
-                            pass
-                        time.sleep(0.2)
-                    
-                    download_thread.join()
+                        position = scheduler.position(ticket)
+                        if position != last_position:
+                            yield f"data: {json.dumps({'status': 'queued', 'position': position, 'session_id': session_id, 'message': f'Waiting in queue (position {position})...'})}\n\n"
+                            last_position, last_sent = position, time.monotonic()
+                        elif time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                            yield SSE_HEARTBEAT
+                            last_sent = time.monotonic()
+                job_started = time.monotonic()
+            
+                def publish_progress(phase, downloaded, total, speed, eta):
+                    if total <= 0:
+                        return
+                    percent = (downloaded / total) * 100
+                    speed_str = f"{speed / 1024 / 1024:.1f} MB/s" if speed else "N/A"
+                    size_str = f"{downloaded / 1024 / 1024:.1f} MB / {total / 1024 / 1024:.1f} MB"
+                    if eta:
+                        eta_mins = int(eta // 60)
+                        eta_secs = int(eta % 60)
+                        eta_str = f"{eta_mins:02d}:{eta_secs:02d}"
+                    else:
+                        eta_str = "N/A"
                     
-                    # Send any remaining progress updates
-                    while not progress_queue.empty():
-                        try:
-                            progress = progress_queue.get_nowait()
-                            yield f"data: {json.dumps(progress)}\n\n"
-                        except queue.Empty:
-                            break
-
-                candidates = [
-                    os.path.join(DOWNLOAD_FOLDER, f)
-                    for f in os.listdir(DOWNLOAD_FOLDER)
-                    if session_id in f
-                ]
-                if not candidates:
-                    yield f"data: {json.dumps({'status': 'error', 'message': 'Download failed (no output file).'})}\n\n"
-                    return
+                    channel.publish({
+                        'status': 'downloading',
+                        'phase': phase,
+                        'progress': percent,
+                        'speed': speed_str,
+                        'size': size_str,
+                        'eta': eta_str,
+                        'message': f"Downloading {phase.replace('+', ' and ')}... {percent:.1f}%",
+                        'session_id': session_id
+                    })
+
+                def progress_hook(d):
+                    # Check if cancelled at every progress update
+                    if scheduler.is_cancelled(session_id):
+                        raise yt_dlp.DownloadError("Download cancelled by user")
                     
-                final_file_path = max(candidates, key=os.path.getctime)
-                yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
+                    if d['status'] == 'downloading':
+                        downloaded = d.get('downloaded_bytes', 0)
+                        total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+                        phase = 'video' if not progress_data['video_done'] else 'audio'
+                        publish_progress(phase, downloaded, total, d.get('speed', 0), d.get('eta', 0))
+                        
+                    elif d['status'] == 'finished':
+                        if not progress_data['video_done']:
+                            progress_data['video_done'] = True
+                        else:
+                            progress_data['audio_done'] = True
+            
+                fallback_selector = "bv*+ba/b"
+                final_file_path = None
 
-            else:
-                # Video only - download video + audio separately and merge
-                yield f"data: {json.dumps({'status': 'downloading', 'phase': 'video', 'progress': 0, 'message': 'Downloading video...'})}\n\n"
-                
-                # Get fresh video info to ensure we have the best audio format
-                if not best_audio_id:
-                    info = get_video_info(url)
-                    if info:
-                        best_audio_id = get_best_audio_format(info)
+                if file_type != 'video_only':
+                    yield f"data: {json.dumps({'status': 'downloading', 'phase': 'video', 'progress': 0, 'message': 'Starting download...'})}\n\n"
                 
-                video_out = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_video_{session_id}.%(ext)s")
-                # Custom hook to check cancellation more frequently
-                def video_cancellation_hook(d):
-                    if active_downloads.get(session_id, {}).get('cancelled'):
-                        raise yt_dlp.DownloadError("Download cancelled by user")
-                    progress_hook(d)
+                    outtmpl = os.path.join(artifact.dir, f"{safe_title}.%(ext)s")
+                    # Custom hook to check cancellation more frequently
+                    def cancellation_hook(d):
+                        if scheduler.is_cancelled(session_id):
+                            raise yt_dlp.DownloadError("Download cancelled by user")
+                        progress_hook(d)
                 
-                try:
-                    with yt_dlp.YoutubeDL({
+                    ydl_opts = {
                         'format': f"{format_id}/{fallback_selector}",
-                        'outtmpl': video_out,
-                        'progress_hooks': [video_cancellation_hook],
+                        'outtmpl': outtmpl,
+                        'merge_output_format': 'mp4',
+                        'progress_hooks': [cancellation_hook],
+                        'post_hooks': [artifact.hook('output')],
                         'hookwarning': False,
-                        'ignoreerrors': False,
                         'http_headers': {
                             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
                         }
-                    }) as ydl:
-                        def download_video():
+                    }
+                
+                    with timeline.phase('download'), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        def download_with_check():
                             try:
-                                ydl.download([url])
+                                download_with_info(ydl, url)
                             except yt_dlp.DownloadError as e:
                                 if "cancelled" in str(e).lower():
                                     return  # Exit gracefully on cancellation
                                 raise e
                             except Exception as e:
-                                if active_downloads.get(session_id, {}).get('cancelled'):
+                                if scheduler.is_cancelled(session_id):
                                     return  # Exit gracefully on cancellation
                                 raise e
-                        
-                        # Download video with progress updates
-                        download_thread = threading.Thread(target=download_video)
-                        download_thread.start()
-                        
-                        while download_thread.is_alive():
-                            if active_downloads.get(session_id, {}).get('cancelled'):
-                                yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
-                                return
-                            try:
-                                progress = progress_queue.get_nowait()
-                                yield f"data: {json.dumps(progress)}\n\n"
-                            except queue.Empty:
-                                pass
-                            time.sleep(0.2)
-                        
-                        download_thread.join()
-                        
-                        # Clear remaining progress
-                        while not progress_queue.empty():
-                            try:
-                                progress_queue.get_nowait()
-                            except queue.Empty:
-                                break
-                except Exception as e:
-                    logger.error(f"Video download failed: {e}")
-                    yield f"data: {json.dumps({'status': 'error', 'message': f'Video download failed: {str(e)}'})}\n\n"
-                    return
-
-                video_candidates = [f for f in os.listdir(DOWNLOAD_FOLDER) if f"video_{session_id}" in f]
-                if not video_candidates:
-                    yield f"data: {json.dumps({'status': 'error', 'message': 'Video download failed - no output file found.'})}\n\n"
-                    return
                     
-                video_file = max(video_candidates, key=lambda f: os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f)))
-                video_path = os.path.join(DOWNLOAD_FOLDER, video_file)
-                
-                # Validate video file
-                if not validate_downloaded_file(video_path, 0.01):  # 10KB minimum
+                        # Download in separate thread; progress is pushed through the channel
+                        download_thread = channel.spawn(download_with_check)
+                        if (yield from pump_progress(channel, download_thread, is_cancelled)):
+                            yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
+                            return
+
+                    final_file_path = artifact.files.get('output')
+                    if not final_file_path or not os.path.exists(final_file_path):
+                        yield f"data: {json.dumps({'status': 'error', 'message': 'Download failed (no output file).'})}\n\n"
+                        return
+                    timeline.annotate('download', bytes=os.path.getsize(final_file_path))
+                    cacheable = True
                     yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
-                    final_file_path = video_path
+
+                else:
+                    # Video only - fetch video and audio concurrently, then merge
+                    yield f"data: {json.dumps({'status': 'downloading', 'phase': 'video+audio', 'progress': 0, 'message': 'Downloading video and audio...'})}\n\n"
                 
-                # Reset progress for audio phase
-                progress_data['current_progress'] = None
-                yield f"data: {json.dumps({'status': 'downloading', 'phase': 'audio', 'progress': 0, 'message': 'Downloading audio...'})}\n\n"
-
-                audio_out = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_audio_{session_id}.%(ext)s")
-                # Custom hook to check cancellation more frequently
-                def audio_cancellation_hook(d):
-                    if active_downloads.get(session_id, {}).get('cancelled'):
-                        raise yt_dlp.DownloadError("Download cancelled by user")
-                    progress_hook(d)
+                    # Custom hook to check cancellation more frequently
+                    def stream_cancellation_hook(d):
+                        if scheduler.is_cancelled(session_id):
+                            raise yt_dlp.DownloadError("Download cancelled by user")
                 
-                audio_downloaded = False
-                if best_audio_id:
-                    try:
-                        with yt_dlp.YoutubeDL({
+                    def report_combined(downloaded, total, speed):
+                        eta = (total - downloaded) / speed if speed and total > downloaded else 0
+                        publish_progress('video+audio', downloaded, total, speed, eta)
+                
+                    stream_opts = {
+                        'video': {
+                            'format': f"{format_id}/{fallback_selector}",
+                            'outtmpl': os.path.join(artifact.dir, f"{safe_title}_video.%(ext)s"),
+                            'post_hooks': [artifact.hook('video')],
+                        },
+                    }
+                    if best_audio_id:
+                        stream_opts['audio'] = {
                             'format': f"{best_audio_id}/{fallback_selector}",
-                            'outtmpl': audio_out,
-                            'progress_hooks': [audio_cancellation_hook],
+                            'outtmpl': os.path.join(artifact.dir, f"{safe_title}_audio.%(ext)s"),
+                            'post_hooks': [artifact.hook('audio')],
+                        }
+                    for opts in stream_opts.values():
+                        opts.update({
+                            'progress_hooks': [stream_cancellation_hook],
                             'hookwarning': False,
                             'ignoreerrors': False,
                             'http_headers': {
                                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
                             }
-                        }) as ydl:
-                            def download_audio():
-                                try:
-                                    ydl.download([url])
-                                    return True
-                                except yt_dlp.DownloadError as e:
-                                    if "cancelled" in str(e).lower():
-                                        return False  # Exit gracefully on cancellation
-                                    logger.error(f"Audio download error: {e}")
-                                    return False
-                                except Exception as e:
-                                    if active_downloads.get(session_id, {}).get('cancelled'):
-                                        return False  # Exit gracefully on cancellation
-                                    logger.error(f"Audio download exception: {e}")
-                                    return False
-                            
-                            # Download audio with progress updates
-                            download_result = [False]
-                            def download_wrapper():
-                                download_result[0] = download_audio()
-                            
-                            download_thread = threading.Thread(target=download_wrapper)
-                            download_thread.start()
-                            
-                            while download_thread.is_alive():
-                                if active_downloads.get(session_id, {}).get('cancelled'):
-                                    yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
-                                    return
-                                try:
-                                    progress = progress_queue.get_nowait()
-                                    yield f"data: {json.dumps(progress)}\n\n"
-                                except queue.Empty:
-                                    pass
-                                time.sleep(0.2)
-                            
-                            download_thread.join()
-                            audio_downloaded = download_result[0]
-                            
-                            # Clear remaining progress
-                            while not progress_queue.empty():
-                                try:
-                                    progress_queue.get_nowait()
-                                except queue.Empty:
-                                    break
-                    except Exception as e:
-                        logger.error(f"Audio download setup failed: {e}")
-                        audio_downloaded = False
+                        })
+                
+                    stream_errors = {}
+                    # Sizes from the cached listing give a steady percentage before every stream has reported
+                    sizes = expected_sizes(info_cache.get(url), {'video': format_id, 'audio': best_audio_id})
+                    download_thread = channel.spawn(lambda: stream_errors.update(download_streams(url, stream_opts, report_combined, timeline, sizes)))
+                    if (yield from pump_progress(channel, download_thread, is_cancelled)) or scheduler.is_cancelled(session_id):
+                        yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
+                        return
+                
+                    video_error = stream_errors.get('video')
+                    if video_error:
+                        logger.error(f"Video download failed: {video_error}")
+                        yield f"data: {json.dumps({'status': 'error', 'message': f'Video download failed: {str(video_error)}'})}\n\n"
+                        return
+
+                    video_path = artifact.files.get('video')
+                    if not video_path or not os.path.exists(video_path):
+                        yield f"data: {json.dumps({'status': 'error', 'message': 'Video download failed - no output file found.'})}\n\n"
+                        return
+                    for role in stream_opts:
+                        if artifact.files.get(role) and os.path.exists(artifact.files[role]):
+                            timeline.annotate(role, bytes=os.path.getsize(artifact.files[role]))
+                
+                    # Validate video file
+                    if not validate_downloaded_file(video_path, 0.01):  # 10KB minimum
+                        yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
+                        final_file_path = video_path
+                
+                    audio_downloaded = 'audio' in stream_opts and not stream_errors.get('audio')
+                    if stream_errors.get('audio'):
+                        logger.error(f"Audio download error: {stream_errors['audio']}")
 
-                if not audio_downloaded:
-                    # Fallback: try to extract audio from video file itself
-                    yield f"data: {json.dumps({'status': 'processing', 'phase': 'fallback', 'progress': 50, 'message': 'Audio download failed, trying to extract from video...'})}\n\n"
+                    if not audio_downloaded:
+                        # Fallback: try to extract audio from video file itself
+                        yield f"data: {json.dumps({'status': 'processing', 'phase': 'fallback', 'progress': 50, 'message': 'Audio download failed, trying to extract from video...'})}\n\n"
                     
-                    # Check if video has embedded audio
-                    try:
-                        import subprocess
-                        probe_cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'a', video_path]
-                        result = subprocess.run(probe_cmd, capture_output=True, text=True)
+                        # Check if video has embedded audio
+                        try:
+                            import subprocess
+                            probe_cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'a', video_path]
+                            with timeline.phase('probe_fallback'):
+                                result = subprocess.run(probe_cmd, capture_output=True, text=True)
                         
-                        if result.returncode == 0 and result.stdout.strip():
-                            # Video has audio, use it directly as final output
-                            final_file_path = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{session_id}.mp4")
-                            shutil.copy2(video_path, final_file_path)
-                            try: os.remove(video_path)
-                            except: pass
-                            yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
-                        else:
-                            # No audio in video, return video-only
+                            if result.returncode == 0 and result.stdout.strip():
+                                # Video has audio, use it directly as final output
+                                final_file_path = os.path.join(artifact.dir, f"{safe_title}.mp4")
+                                os.replace(video_path, final_file_path)
+                                yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
+                            else:
+                                # No audio in video, return video-only
+                                final_file_path = video_path
+                                yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
+                        except Exception as probe_error:
+                            logger.error(f"Audio probe failed: {probe_error}")
+                            # Return video-only as last resort
                             final_file_path = video_path
                             yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
-                    except Exception as probe_error:
-                        logger.error(f"Audio probe failed: {probe_error}")
-                        # Return video-only as last resort
-                        final_file_path = video_path
-                        yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
-                else:
-                    # Audio downloaded successfully, proceed with merge
-                    audio_candidates = [f for f in os.listdir(DOWNLOAD_FOLDER) if f"audio_{session_id}" in f]
-                    if not audio_candidates:
-                        # This shouldn't happen if audio_downloaded is True, but handle it
-                        final_file_path = video_path
-                        yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
                     else:
-                        audio_file = max(audio_candidates, key=lambda f: os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f)))
-                        audio_path = os.path.join(DOWNLOAD_FOLDER, audio_file)
-                        
-                        # Validate audio file
-                        if not validate_downloaded_file(audio_path, 0.01):
-                            logger.warning("Audio file validation failed, using video-only")
+                        # Audio downloaded successfully, proceed with merge
+                        audio_path = artifact.files.get('audio')
+                        if not audio_path or not os.path.exists(audio_path):
+                            # This shouldn't happen if audio_downloaded is True, but handle it
                             final_file_path = video_path
                             yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
                         else:
-                            yield f"data: {json.dumps({'status': 'merging', 'phase': 'merge', 'progress': 90, 'message': 'Merging video and audio...'})}\n\n"
-
-                            merged_p = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{session_id}.mp4")
-
-                            if merge_video_audio(video_path, audio_path, merged_p):
-                                try: os.remove(video_path)
-                                except: pass
-                                try: os.remove(audio_path)
-                                except: pass
-                                final_file_path = merged_p
-                                yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
-                            else:
-                                logger.error("Merge failed, returning video-only")
-                                try: os.remove(audio_path)
-                                except: pass
+                        
+                            # Validate audio file
+                            if not validate_downloaded_file(audio_path, 0.01):
+                                logger.warning("Audio file validation failed, using video-only")
                                 final_file_path = video_path
                                 yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
+                            else:
+                                merge_message = f'Converting to {target_codec}...' if target_codec else 'Merging video and audio...'
+                                yield f"data: {json.dumps({'status': 'merging', 'phase': 'merge', 'progress': 90, 'message': merge_message})}\n\n"
+
+                                with timeline.phase('merge') as span:
+                                    merge = merge_video_audio(video_path, audio_path, os.path.join(artifact.dir, safe_title), target_codec)
+                                    span.update({k: merge[k] for k in ('strategy', 'container', 'probe_seconds')} if merge else {'strategy': 'failed'})
+                                if merge:
+                                    try: os.remove(video_path)
+                                    except: pass
+                                    try: os.remove(audio_path)
+                                    except: pass
+                                    final_file_path = merge.pop('path')
+                                    cacheable = True
+                                    yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!', 'merge': merge})}\n\n"
+                                else:
+                                    logger.error("Merge failed, returning video-only")
+                                    try: os.remove(audio_path)
+                                    except: pass
+                                    final_file_path = video_path
+                                    yield f"data: {json.dumps({'status': 'completed', 'progress': 100, 'message': 'Download completed!'})}\n\n"
 
-            # Stop progress tracking
-            progress_data['should_stop'] = True
+                # Check if cancelled
+                if scheduler.is_cancelled(session_id):
+                    yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return
             
-            # Check if cancelled
-            if active_downloads.get(session_id, {}).get('cancelled'):
-                yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
-                yield "data: [DONE]\n\n"
-                return
+                if final_file_path:
+                    final_filename = os.path.basename(final_file_path)
+                    timeline.attrs['bytes'] = os.path.getsize(final_file_path)
+                    observe_job('single', timeline.attrs['bytes'], time.monotonic() - job_started)
+                    if cacheable:
+                        final_file_path = cache_finished_download(artifact, cache_key, final_file_path)
+                    artifacts.mark_ready(session_id, final_file_path, download_name=final_filename)
+                    yield f"data: {json.dumps({'status': 'ready', 'session_id': session_id, 'filename': final_filename, 'message': 'Ready for download!', 'timeline': timeline.finish('ready')})}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return final_file_path, final_filename
+                else:
+                    yield f"data: {json.dumps({'status': 'error', 'message': 'Download failed.'})}\n\n"
+                    yield "data: [DONE]\n\n"
+
+            shared = yield from relay_to_followers(flight, download())
+            flight_landed = True
             
-            if final_file_path:
-                final_filename = os.path.basename(final_file_path).replace(f"_{session_id}", "")
-                yield f"data: {json.dumps({'status': 'ready', 'session_id': session_id, 'filename': final_filename, 'message': 'Ready for download!'})}\n\n"
-                yield "data: [DONE]\n\n"
-            else:
-                yield f"data: {json.dumps({'status': 'error', 'message': 'Download failed.'})}\n\n"
-                yield "data: [DONE]\n\n"
-                
         except Exception as e:
-            progress_data['should_stop'] = True
-            
             # Check if it was a cancellation
-            if "cancelled" in str(e).lower() or active_downloads.get(session_id, {}).get('cancelled'):
+            if "cancelled" in str(e).lower() or scheduler.is_cancelled(session_id):
                 yield f"data: {json.dumps({'status': 'cancelled', 'message': 'Download cancelled'})}\n\n"
             else:
                 print(f"Download Error: {e}")
                 yield f"data: {json.dumps({'status': 'error', 'message': f'An unexpected error occurred: {e}'})}\n\n"
+                flight_landed = True
         finally:
-            # Clean up tracking
-            if session_id in active_downloads:
-                del active_downloads[session_id]
+            if leading:
+                # Followers share the result; if this client left or cancelled, one of them takes over
+                flights.finish(flight, result=shared, abandoned=not shared and (not flight_landed or is_cancelled()))
+            # Release the slot and clean up tracking; unfinished jobs leave no files behind
+            timeline.finish('cancelled' if is_cancelled() else 'failed')
+            if ticket:
+                scheduler.release(ticket)
+            scheduler.unregister(session_id)
+            if artifact.state != 'ready':
+                artifacts.remove(session_id)
     
-    return Response(generate(), mimetype='text/event-stream')
+    return generate()
 
 @app.route('/download_file')
 def download_file():
@@ -803,35 +3801,18 @@ def download_file():
     if not all([session_id, filename]):
         return "Missing parameters", 400
     
-    # Find the file with session_id
-    candidates = [
-        f for f in os.listdir(DOWNLOAD_FOLDER)
-        if session_id in f
-    ]
-    
-    if not candidates:
+    artifact = find_artifact(session_id)
+    if not artifact or not artifact.final_path or not os.path.exists(artifact.final_path):
         return "File not found", 404
-        
-    actual_file = max(candidates, key=lambda f: os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f)))
     
-    response = send_from_directory(
-        DOWNLOAD_FOLDER,
-        actual_file,
+    # Conditional send: Range, If-Range and ETag let clients resume within the grace window
+    response = send_file(
+        artifact.final_path,
         as_attachment=True,
-        download_name=filename
+        download_name=filename,
+        conditional=True
     )
-    
-    @response.call_on_close
-    def cleanup():
-        def delayed_cleanup():
-            time.sleep(5)
-            try:
-                os.remove(os.path.join(DOWNLOAD_FOLDER, actual_file))
-            except Exception as e:
-                print(f"Cleanup error: {e}")
-        threading.Thread(target=delayed_cleanup, daemon=True).start()
-    
-    return response
+    return artifacts.track(response, artifact)
 
 @app.route('/download')
 def download():
@@ -841,125 +3822,212 @@ def download():
     title = request.args.get('title')
     file_type = request.args.get('type')
     best_audio_id = request.args.get('best_audio_id')
+    target_codec = request.args.get('codec')    # re-encode only when explicitly requested
+    # Send bytes to the client while they download; video_only merges become fragmented MP4 (remux only)
+    stream = request.args.get('stream') == '1' or request.args.get('pipe') == '1'
+    if file_type == 'video_only':
+        stream = stream and not target_codec and PIPE_MERGE_SUPPORTED
 
     if not all([url, format_id, title, file_type]):
         return "Missing required parameters", 400
+    if target_codec and target_codec not in TRANSCODE_TARGETS:
+        return f"Unsupported codec. Choose from: {', '.join(TRANSCODE_TARGETS)}", 400
 
     safe_title = sanitize_filename(title)
+    if job_queue and not stream:
+        # A worker process downloads; this request only waits for the result.
+        # AsgiServer re-dispatches the request with the job id once the job is over (see AsgiServer.await_job)
+        client_gone = disconnect_probe()
+        job_id = request.environ.get('anyvidow.finished_job')
+        if job_id:
+            job = job_queue.get(job_id)
+        else:
+            job_id = job_queue.enqueue('single', {
+                'url': url, 'format_id': format_id, 'title': title, 'type': file_type,
+                'best_audio_id': best_audio_id, 'codec': target_codec}, SINGLE_DOWNLOAD_PRIORITY)
+            if request.environ.get('anyvidow.await_job'):
+                # Under AsgiServer the wait happens on the event loop, not in this pool thread
+                response = job_accepted_response(job_queue.get(job_id))
+                response.await_job = job_id
+                return response
+            job = job_queue.wait(job_id, timeout=JOB_WAIT_TIMEOUT, cancelled=client_gone)
+        if job and job['state'] not in JOB_TERMINAL_STATES:
+            if client_gone():
+                job_queue.request_cancel(job_id)
+                return "Client disconnected.", 499
+            # Not done yet (or no worker is running): the client follows the job instead of holding this request
+            return job_accepted_response(job)
+        artifact = adopt_job(job)
+        if not artifact:
+            return "Download failed.", 500
+        response = send_file(artifact.final_path, as_attachment=True, download_name=artifact.download_name)
+        merge = job['result'].get('merge')
+        if merge:
+            response.headers['X-Merge-Strategy'] = f"{merge['strategy']}/{merge['container']}"
+            response.headers['X-Merge-Seconds'] = str(merge['seconds'])
+        return artifacts.track(response, artifact, grace=0)
+
     session_id = str(uuid.uuid4())
 
+    scheduler.register(session_id, 'single')
+    artifact = artifacts.create(session_id)
+    client_gone = disconnect_probe()
+    # Only a request that actually downloads takes a slot; cache hits and followers never queue
+    ticket = None
+    flight, leading, shared, abandoned = None, False, None, False
+    handed_off = False
+
+    def wait_for_slot():
+        """Synchronous route: block this request until the scheduler admits it. False if the client left first."""
+        nonlocal ticket
+        ticket = scheduler.enqueue(session_id, url, SINGLE_DOWNLOAD_PRIORITY)
+        while not scheduler.wait(ticket, timeout=1.0):
+            if client_gone():
+                return False
+        return True
+
     try:
-        final_file_path = None
-
-        # fallback selector (auto-pick if user format fails)
-        fallback_selector = "bv*+ba/b"
-
-        if file_type != 'video_only':
-            outtmpl = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{session_id}.%(ext)s")
-            ydl_opts = {
-                'format': f"{format_id}/{fallback_selector}",
-                'outtmpl': outtmpl,
-                'merge_output_format': 'mp4',
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                }
-            }
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+        # Cache hit: serve the stored file without touching yt-dlp or ffmpeg
+        if file_type == 'video_only' and not best_audio_id:
+            info = get_video_info(url)
+            if info:
+                best_audio_id = get_best_audio_format(info)
+        cache_key = download_cache_key(url, format_id, file_type, best_audio_id, target_codec)
+        final_file_path = claim_cached_download(artifact, cache_key)
+        final_filename = f"{safe_title}{os.path.splitext(final_file_path)[1]}" if final_file_path else None
+        cacheable = False
+        merge = None
 
-            candidates = [
-                os.path.join(DOWNLOAD_FOLDER, f)
-                for f in os.listdir(DOWNLOAD_FOLDER)
-                if session_id in f
-            ]
-            if not candidates:
-                return "Download failed (no output file).", 500
-            final_file_path = max(candidates, key=os.path.getctime)
+        if not final_file_path and stream and (best_audio_id or file_type != 'video_only'):
+            if not wait_for_slot():
+                return "Client disconnected.", 499
+            if file_type == 'video_only':
+                piped = start_pipe_download(url, format_id, best_audio_id)
+                download_name = f"{safe_title}.mp4"
+            else:
+                piped = start_pipe_download(url, f"{format_id}/b")
+                download_name = f"{safe_title}.{format_extension(get_video_info(url), format_id)}"
+            if piped:
+                handed_off = True
+                return pipe_download_response(piped, session_id, ticket, download_name)
+            logger.warning("Streaming download failed to start, falling back to a file download")
 
-        else:
-            # --- VIDEO ONLY (download video + audio separately and merge) ---
-            video_out = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_video_{session_id}.%(ext)s")
-            with yt_dlp.YoutubeDL({
-                'format': f"{format_id}/{fallback_selector}",
-                'outtmpl': video_out,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        # An identical download is already running: wait for it and share its file
+        flight_key = download_flight_key(cache_key, url, format_id, file_type, best_audio_id, target_codec)
+        while not final_file_path:
+            flight, leading = flights.join(flight_key)
+            if leading:
+                break
+            if not flight.wait(client_gone, timeout=FLIGHT_WAIT_TIMEOUT):
+                if client_gone():
+                    return "Client disconnected.", 499
+                logger.warning(f"Identical download still running after {FLIGHT_WAIT_TIMEOUT:.0f}s, downloading separately")
+                break
+            if flight.result:
+                shared_path, final_filename = flight.result
+                final_file_path = artifact.link(shared_path, final_filename)
+            elif not flight.abandoned:
+                return "Download failed.", 500
+
+        job_started = None
+        if not final_file_path:
+            if not wait_for_slot():
+                # Still queued when the client left: hand the download to a waiting follower
+                abandoned = True
+                return "Client disconnected.", 499
+            job_started = time.monotonic()
+
+            # fallback selector (auto-pick if user format fails)
+            fallback_selector = "bv*+ba/b"
+
+            if file_type != 'video_only':
+                outtmpl = os.path.join(artifact.dir, f"{safe_title}.%(ext)s")
+                ydl_opts = {
+                    'format': f"{format_id}/{fallback_selector}",
+                    'outtmpl': outtmpl,
+                    'merge_output_format': 'mp4',
+                    'post_hooks': [artifact.hook('output')],
+                    'http_headers': {
+                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+                    }
                 }
-            }) as ydl:
-                ydl.download([url])
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    download_with_info(ydl, url)
 
-            video_candidates = [f for f in os.listdir(DOWNLOAD_FOLDER) if f"video_{session_id}" in f]
-            if not video_candidates:
-                return "Video download failed.", 500
-            video_file = max(video_candidates, key=lambda f: os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f)))
+                final_file_path = artifact.files.get('output')
+                if not final_file_path or not os.path.exists(final_file_path):
+                    return "Download failed (no output file).", 500
+                cacheable = True
 
-            # Download best audio with robust error handling
-            if not best_audio_id:
-                info = get_video_info(url)
-                if info:
-                    best_audio_id = get_best_audio_format(info)
-            
-            if not best_audio_id:
-                logger.warning("No audio format available, checking if video has embedded audio")
-                # Check if video file has embedded audio
-                video_p = os.path.join(DOWNLOAD_FOLDER, video_file)
-                try:
-                    probe_cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'a', video_p]
-                    result = subprocess.run(probe_cmd, capture_output=True, text=True)
-                    
-                    if result.returncode == 0 and result.stdout.strip():
-                        # Video has audio, use it directly
-                        final_file_path = video_p
-                        logger.info("Using video file with embedded audio")
-                    else:
-                        return "No audio available for this video.", 400
-                except Exception as e:
-                    logger.error(f"Audio probe failed: {e}")
-                    return "No audio format available to merge.", 500
             else:
-                # Try to download audio
-                audio_out = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_audio_{session_id}.%(ext)s")
-                try:
-                    with yt_dlp.YoutubeDL({
+                # --- VIDEO ONLY (download video + audio concurrently and merge) ---
+                stream_opts = {
+                    'video': {
+                        'format': f"{format_id}/{fallback_selector}",
+                        'outtmpl': os.path.join(artifact.dir, f"{safe_title}_video.%(ext)s"),
+                        'post_hooks': [artifact.hook('video')],
+                    },
+                }
+                if best_audio_id:
+                    stream_opts['audio'] = {
                         'format': f"{best_audio_id}/{fallback_selector}",
-                        'outtmpl': audio_out,
+                        'outtmpl': os.path.join(artifact.dir, f"{safe_title}_audio.%(ext)s"),
+                        'post_hooks': [artifact.hook('audio')],
                         'ignoreerrors': False,
-                        'http_headers': {
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                        }
-                    }) as ydl:
-                        ydl.download([url])
-                except Exception as e:
-                    logger.error(f"Audio download failed: {e}")
+                    }
+                for opts in stream_opts.values():
+                    opts['http_headers'] = {
+                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+                    }
+                stream_errors = download_streams(url, stream_opts)
+                if stream_errors.get('video'):
+                    raise stream_errors['video']
+
+                video_p = artifact.files.get('video')
+                if not video_p or not os.path.exists(video_p):
+                    return "Video download failed.", 500
+
+                if not best_audio_id:
+                    logger.warning("No audio format available, checking if video has embedded audio")
+                    # Check if video file has embedded audio
+                    try:
+                        probe_cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'a', video_p]
+                        result = subprocess.run(probe_cmd, capture_output=True, text=True)
+                    
+                        if result.returncode == 0 and result.stdout.strip():
+                            # Video has audio, use it directly
+                            final_file_path = video_p
+                            logger.info("Using video file with embedded audio")
+                        else:
+                            return "No audio available for this video.", 400
+                    except Exception as e:
+                        logger.error(f"Audio probe failed: {e}")
+                        return "No audio format available to merge.", 500
+                elif stream_errors.get('audio'):
+                    logger.error(f"Audio download failed: {stream_errors['audio']}")
                     # Fallback to video-only
-                    video_p = os.path.join(DOWNLOAD_FOLDER, video_file)
                     final_file_path = video_p
                     logger.info("Falling back to video-only due to audio download failure")
                 else:
-                    audio_candidates = [f for f in os.listdir(DOWNLOAD_FOLDER) if f"audio_{session_id}" in f]
-                    if not audio_candidates:
+                    audio_p = artifact.files.get('audio')
+                    if not audio_p or not os.path.exists(audio_p):
                         logger.warning("Audio download completed but no file found")
-                        video_p = os.path.join(DOWNLOAD_FOLDER, video_file)
                         final_file_path = video_p
                     else:
-                        audio_file = max(audio_candidates, key=lambda f: os.path.getctime(os.path.join(DOWNLOAD_FOLDER, f)))
-                        video_p = os.path.join(DOWNLOAD_FOLDER, video_file)
-                        audio_p = os.path.join(DOWNLOAD_FOLDER, audio_file)
-                        
+                    
                         # Validate both files before merge
                         if not validate_downloaded_file(video_p, 0.01) or not validate_downloaded_file(audio_p, 0.01):
                             logger.error("Downloaded files validation failed")
                             final_file_path = video_p
-                        
-                        merged_p = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{session_id}.mp4")
-
-                        if merge_video_audio(video_p, audio_p, merged_p):
+                    
+                        merge = merge_video_audio(video_p, audio_p, os.path.join(artifact.dir, safe_title), target_codec)
+                        if merge:
                             try: os.remove(video_p)
                             except: pass
                             try: os.remove(audio_p)
                             except: pass
-                            final_file_path = merged_p
-                            logger.info("Successfully merged video and audio")
+                            final_file_path = merge['path']
+                            cacheable = True
                         else:
                             logger.error(f"Failed to merge {video_p} and {audio_p}, using video-only")
                             try: os.remove(audio_p)
@@ -969,268 +4037,364 @@ def download():
         if not final_file_path:
             return "Download failed.", 500
 
-        final_filename = os.path.basename(final_file_path).replace(f"_{session_id}", "")
-        response = send_from_directory(
-            DOWNLOAD_FOLDER,
-            os.path.basename(final_file_path),
+        if not final_filename:
+            final_filename = os.path.basename(final_file_path)
+        if job_started:
+            observe_job('single', os.path.getsize(final_file_path), time.monotonic() - job_started)
+        if cacheable:
+            final_file_path = cache_finished_download(artifact, cache_key, final_file_path)
+        artifacts.mark_ready(session_id, final_file_path, download_name=final_filename)
+        shared = (final_file_path, final_filename)
+        response = send_file(
+            final_file_path,
             as_attachment=True,
             download_name=final_filename
         )
-
-        @response.call_on_close
-        def cleanup():
-            def delayed_cleanup():
-                time.sleep(5)
-                try:
-                    os.remove(final_file_path)
-                except Exception as e:
-                    print(f"Cleanup error: {e}")
-            threading.Thread(target=delayed_cleanup, daemon=True).start()
-
-        return response
+        if merge:
+            response.headers['X-Merge-Strategy'] = f"{merge['strategy']}/{merge['container']}"
+            response.headers['X-Merge-Seconds'] = str(merge['seconds'])
+        # One-shot job: nothing can come back for this artifact, so it goes at the next sweep
+        return artifacts.track(response, artifact, grace=0)
 
     except Exception as e:
         print(f"Download Error: {e}")
         return f'An unexpected error occurred: {e}', 500
+    finally:
+        if leading:
+            flights.finish(flight, result=shared, abandoned=abandoned)
+        if not handed_off:
+            if ticket:
+                scheduler.release(ticket)
+            scheduler.unregister(session_id)
+        if artifact.state == 'pending':
+            artifacts.remove(session_id)
 
 @app.route('/stream_playlist_download')
 def stream_playlist_download():
     """Handles the entire playlist download process with progress and zipping."""
-    url = request.args.get('url')
-    quality = request.args.get('quality', '1080')
-    start_index = int(request.args.get('start', 1)) - 1
-    end_index = int(request.args.get('end', 9999))
-    
-    if not url: 
+    try:
+        start = int(request.args.get('start', 1))
+        end = int(request.args.get('end', 9999))
+    except ValueError:
+        return Response("Invalid start/end", status=400)
+    if start < 1 or end < start:
+        return Response("Invalid start/end", status=400)
+    try:
+        concurrency = int(request.args.get('concurrency', PLAYLIST_CONCURRENCY))
+    except ValueError:
+        return Response("Invalid concurrency", status=400)
+    max_mb = None
+    if request.args.get('max_mb'):
+        try:
+            max_mb = float(request.args['max_mb'])
+        except ValueError:
+            return Response("Invalid max_mb", status=400)
+        if not math.isfinite(max_mb) or max_mb <= 0:
+            return Response("Invalid max_mb", status=400)
+    params = {
+        'url': request.args.get('url'),
+        'quality': request.args.get('quality', '1080'),
+        'start': start,
+        'end': end,
+        'concurrency': max(1, min(concurrency, MAX_PLAYLIST_CONCURRENCY)),
+        # Optional preferences for each entry, e.g. vcodec=h264&acodec=opus&max_mb=200
+        'vcodec': request.args.get('vcodec'),
+        'acodec': request.args.get('acodec'),
+        'max_mb': max_mb,
+    }
+    if not params['url']:
         return Response("Missing URL parameter.", status=400)
+    return start_job('playlist', params)
+
+def playlist_download_job(params, session_id):
+    """Downloads a playlist range with concurrent workers into one ZIP; yields SSE progress events."""
+    url = params['url']
+    quality = params['quality']
+    start_index = params['start'] - 1
+    end_index = params['end']
+    concurrency = params['concurrency']
 
     def generate():
         nonlocal url, quality, start_index, end_index  # Make variables accessible
-        playlist_info = get_video_info(url)  # Get full info now
+        timeline = JobTimeline(session_id, 'playlist', quality=quality, concurrency=concurrency, zip_mode=PLAYLIST_ZIP_MODE)
+        with timeline.phase('extract', flat=True):
+            # Only the requested range is listed; entries are resolved as they download
+            playlist_info = get_playlist_range(url, start_index + 1, end_index)
         if not playlist_info or 'entries' not in playlist_info:
+            timeline.finish('failed')
             yield f"data: {json.dumps({'status': 'error', 'message': 'Could not fetch full playlist info.'})}\n\n"
             return
 
-        session_id = str(uuid.uuid4())
+        job_started = time.monotonic()
         playlist_title = sanitize_filename(playlist_info.get('title', 'playlist'))
-        playlist_dir = os.path.join(DOWNLOAD_FOLDER, f"{playlist_title}_{session_id}")
+        artifact = artifacts.create(session_id)
+        playlist_dir = os.path.join(artifact.dir, 'entries')
         os.makedirs(playlist_dir, exist_ok=True)
+        artifact.record('entries', playlist_dir)
         
-        format_selector = f'bestvideo[height<={quality}]+bestaudio/best[height<={quality}]/best'
+        # Each entry's formats are chosen from its FormatIndex when it downloads
+        max_bytes = int(params['max_mb'] * 1024 * 1024) if params.get('max_mb') else None
+        selector = format_selector(int(quality) if str(quality).isdigit() else None, params.get('vcodec'), params.get('acodec'), max_bytes)
+        selector_key = f"height<={quality}:{params.get('vcodec')}:{params.get('acodec')}:{max_bytes}"
 
-        entries = [e for e in playlist_info.get('entries', []) if e]
-        
-        # Fix end_index to be inclusive and within bounds
-        actual_end_index = min(end_index, len(entries))
-        videos_to_download = entries[start_index:actual_end_index]
+        videos_to_download = [e for e in playlist_info.get('entries', []) if e]
         total_videos = len(videos_to_download)
         
         if total_videos == 0:
+            artifacts.remove(session_id)
+            timeline.finish('failed')
             yield f"data: {json.dumps({'status': 'error', 'message': 'No videos found in the specified range.'})}\n\n"
             return
         
-        yield f"data: {json.dumps({'status': 'starting', 'total_videos': total_videos, 'message': f'Starting download of {total_videos} videos...'})}\n\n"
+        yield f"data: {json.dumps({'status': 'starting', 'total_videos': total_videos, 'session_id': session_id, 'message': f'Starting download of {total_videos} videos...'})}\n\n"
 
-        completed_videos = []
-        current_video_index = 0
-        current_video_title = ""
-        download_start_time = time.time()
-        total_downloaded_bytes = 0
-        
-        # Progress tracking variables
-        progress_queue = queue.Queue()
-        current_progress = {'should_stop': False}
-        
-        def progress_hook(d):
-            nonlocal current_video_index, current_video_title, total_downloaded_bytes
-            
-            if d.get('status') == 'downloading':
-                downloaded = d.get('downloaded_bytes', 0)
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                speed = d.get('speed', 0)
-                eta = d.get('eta', 0)
-                
-                if total > 0:
-                    percent = (downloaded / total) * 100
-                    speed_str = f"{speed / 1024 / 1024:.1f} MB/s" if speed else "0 MB/s"
-                    size_str = f"{downloaded / 1024 / 1024:.1f} MB / {total / 1024 / 1024:.1f} MB"
-                    
-                    if eta:
-                        eta_mins = int(eta // 60)
-                        eta_secs = int(eta % 60)
-                        eta_str = f"{eta_mins:02d}:{eta_secs:02d}"
-                    else:
-                        eta_str = "N/A"
-                    
-                    # Calculate overall progress
-                    video_progress = (current_video_index / total_videos) * 100
-                    current_video_progress = (percent / 100) * (100 / total_videos)
-                    overall_progress = video_progress + current_video_progress
-                    
-                    # Store progress data in queue for real-time updates
-                    progress_data = {
+        # Per-entry progress state, merged into one aggregate for the client
+        entry_states = [
+            {'fraction': 0.0, 'downloaded': 0, 'total': 0, 'speed': 0, 'files': {}, 'state': 'pending'}
+            for _ in videos_to_download
+        ]
+        state_lock = threading.Lock()
+        channel = ProgressChannel()
+        index_width = len(str(total_videos))
+
+        def aggregate_progress():
+            """Returns (overall percent, speed_str, size_str, eta_str) across all entries."""
+            with state_lock:
+                overall = sum(s['fraction'] for s in entry_states) / total_videos * 100
+                active = [s for s in entry_states if s['state'] == 'downloading']
+                speed = sum(s['speed'] for s in active)
+                downloaded = sum(s['downloaded'] for s in active)
+                total = sum(s['total'] for s in active)
+            speed_str = f"{speed / 1024 / 1024:.1f} MB/s" if speed else "0 MB/s"
+            size_str = f"{downloaded / 1024 / 1024:.1f} MB / {total / 1024 / 1024:.1f} MB"
+            if speed and total > downloaded:
+                eta = (total - downloaded) / speed
+                eta_str = f"{int(eta // 60):02d}:{int(eta % 60):02d}"
+            else:
+                eta_str = "N/A"
+            return overall, speed_str, size_str, eta_str
+
+        def make_progress_hook(i):
+            def progress_hook(d):
+                if scheduler.is_cancelled(session_id):
+                    raise DownloadCancelled("Download cancelled by user")
+                if d.get('status') != 'downloading':
+                    return
+                downloaded = d.get('downloaded_bytes') or 0
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                if total <= 0:
+                    return
+                with state_lock:
+                    state = entry_states[i]
+                    # Separate video/audio streams of one entry are tracked per file
+                    state['files'][d.get('filename')] = (downloaded, total)
+                    state['downloaded'] = sum(f[0] for f in state['files'].values())
+                    state['total'] = sum(f[1] for f in state['files'].values())
+                    state['speed'] = d.get('speed') or 0
+                    state['fraction'] = max(state['fraction'], min(0.99, state['downloaded'] / state['total']))
+                channel.publish(('progress', i, downloaded / total * 100))
+            return progress_hook
+
+        # In file mode entries are appended to the archive as soon as they finish
+        zip_filename = f"{playlist_title}.zip"
+        archive = PlaylistArchive(os.path.join(artifact.dir, zip_filename)) if PLAYLIST_ZIP_MODE != 'stream' else None
+        # A resumed job (see JobQueue) skips the entries an earlier run finished
+        finished_before = job_queue.entries(session_id) if job_queue else {}
+
+        def run_entry(i, video):
+            video_url = video.get('webpage_url') or video.get('url')
+            video_title = video.get('title', f'Video {i + 1}')
+            # Each entry gets its own folder so the archive can keep playlist order
+            entry_dir = os.path.join(playlist_dir, f"{i + 1:0{index_width}d}")
+            if finished_before.get(i) == (video_url, 'done') and not playlist_members(entry_dir):
+                # Its files went into the earlier run's archive, which did not survive: download it again
+                logger.info(f"Entry {i + 1} was archived by an interrupted run, downloading it again")
+                job_queue.forget_entry(session_id, i)
+            elif finished_before.get(i) == (video_url, 'done'):
+                with timeline.phase('entry', index=i + 1, resumed=True), state_lock:
+                    entry_states[i].update(state='done', fraction=1.0)
+                if archive:
+                    archive.entry_finished(i, entry_dir)
+                channel.publish(('done', i, video_title), coalesce=False)
+                return
+            try:
+                with timeline.phase('entry', index=i + 1) as span:
+                    # Validate video URL
+                    if not video_url or not video_url.startswith(('http://', 'https://')):
+                        raise ValueError(f"Invalid URL: {video_url}")
+                    progress_hook = make_progress_hook(i)
+                    entry_started = time.monotonic()
+
+                    def fetch(flight):
+                        with scheduler.slot(session_id, video_url, PLAYLIST_ENTRY_PRIORITY):
+                            span['slot_wait'] = round(time.monotonic() - entry_started, 3)
+                            mark_started()
+                            def hook(d):
+                                progress_hook(d)
+                                flight.publish(d)
+                            download_playlist_entry(video_url, entry_dir, selector, hook)
+                        return entry_dir
+
+                    def mark_started():
+                        with state_lock:
+                            started = entry_states[i]['state'] == 'downloading'
+                            entry_states[i]['state'] = 'downloading'
+                        if not started:
+                            channel.publish(('start', i, video_title), coalesce=False)
+
+                    def follow_hook(d):
+                        mark_started()
+                        progress_hook(d)
+
+                    def take_files(source_dir):
+                        # Runs in the leader's thread before it archives or drops its folder
+                        os.makedirs(entry_dir, exist_ok=True)
+                        try:
+                            for name in os.listdir(source_dir):
+                                if not name.endswith(PARTIAL_DOWNLOAD_SUFFIXES):
+                                    link_file(os.path.join(source_dir, name), os.path.join(entry_dir, name))
+                        except OSError:
+                            shutil.rmtree(entry_dir, ignore_errors=True)
+                            raise
+
+                    # The same entry may be in flight for another playlist job; share its files
+                    source_dir = flights.do(f"entry:{normalize_url(video_url)}:{selector_key}", fetch,
+                                            listener=follow_hook, cancelled=lambda: scheduler.is_cancelled(session_id),
+                                            claim=take_files)
+                    if source_dir != entry_dir:
+                        span['coalesced'] = True
+                    span['bytes'] = folder_size(entry_dir)
+            except Exception as e:
+                logger.error(f"Error downloading video {i + 1}: {e}")
+                with state_lock:
+                    entry_states[i].update(state='failed', fraction=1.0)
+                if job_queue and not scheduler.is_cancelled(session_id):
+                    job_queue.record_entry(session_id, i, video_url, 'failed')
+                if archive:
+                    archive.entry_finished(i, entry_dir if os.path.isdir(entry_dir) else None)
+                channel.publish(('error', i, str(e)), coalesce=False)
+            else:
+                with state_lock:
+                    entry_states[i].update(state='done', fraction=1.0)
+                if job_queue:
+                    job_queue.record_entry(session_id, i, video_url, 'done')
+                logger.info(f"Downloaded {i + 1}/{total_videos}: {video_title}")
+                if archive:
+                    archive.entry_finished(i, entry_dir)
+                channel.publish(('done', i, video_title), coalesce=False)
+
+        scheduler.register(session_id, 'playlist')
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='playlist')
+        futures = []
+        finished_count = 0
+        try:
+            futures = [pool.submit(run_entry, i, video) for i, video in enumerate(videos_to_download)]
+            titles = [video.get('title', f'Video {i + 1}') for i, video in enumerate(videos_to_download)]
+
+            last_position = None
+            last_sent = time.monotonic()
+            while finished_count < total_videos:
+                downloading = any(s['state'] == 'downloading' for s in entry_states)
+                items = channel.get(SSE_HEARTBEAT_INTERVAL if downloading else QUEUE_POSITION_INTERVAL)
+                if not items:
+                    # Nothing running yet: tell the client where it stands in the global queue
+                    position = 0 if downloading else scheduler.job_position(session_id)
+                    if position and position != last_position:
+                        yield f"data: {json.dumps({'status': 'queued', 'position': position, 'total_videos': total_videos, 'phase': 'Queued', 'message': f'Waiting in queue (position {position})...'})}\n\n"
+                        last_sent = time.monotonic()
+                    elif time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                        yield SSE_HEARTBEAT
+                        last_sent = time.monotonic()
+                    last_position = position
+                    continue
+                last_position = None
+                last_sent = time.monotonic()
+
+                for kind, i, detail in items:
+                    if kind == 'progress' and entry_states[i]['state'] != 'downloading':
+                        continue  # stale update for an entry that already finished
+                    overall_progress, speed_str, size_str, eta_str = aggregate_progress()
+                    event_data = {
                         'status': 'downloading',
-                        'current_video': current_video_index + 1,
+                        'current_video': i + 1,
                         'total_videos': total_videos,
-                        'video_title': current_video_title,
-                        'phase': 'Downloading',
+                        'completed_videos': finished_count,
+                        'video_title': titles[i],
                         'progress': overall_progress,
                         'speed': speed_str,
                         'size': size_str,
                         'eta': eta_str,
-                        'message': f'Downloading video {current_video_index + 1}/{total_videos}: {percent:.1f}%'
                     }
-                    try:
-                        progress_queue.put_nowait(progress_data)
-                    except queue.Full:
-                        pass
-                    
-            elif d.get('status') == 'finished' and d.get('info_dict'):
-                video_title = d['info_dict'].get('title', 'Untitled Video')
-                if video_title not in completed_videos:
-                    completed_videos.append(video_title)
-                    current_video_index += 1
-                    logger.info(f"Downloaded {current_video_index}/{total_videos}: {video_title}")
+                    if kind == 'start':
+                        event_data.update(phase='Starting', message=f'Starting video {i + 1}/{total_videos}: {titles[i][:50]}...')
+                    elif kind == 'progress':
+                        event_data.update(phase='Downloading', message=f'Downloading video {i + 1}/{total_videos}: {detail:.1f}%')
+                    elif kind == 'done':
+                        finished_count += 1
+                        event_data.update(phase='Completed', completed_videos=finished_count, message=f'Completed video {i + 1}/{total_videos}')
+                    else:
+                        # Send error update but continue with the remaining entries
+                        finished_count += 1
+                        event_data.update(phase='Error', completed_videos=finished_count, size='Failed', message=f'Failed video {i + 1}, continuing...')
+                    yield f"data: {json.dumps(event_data)}\n\n"
+        finally:
+            # Unregistering makes any entry still queued or running (client went away) stop at its next hook
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+            scheduler.unregister(session_id)
+            if finished_count < total_videos:
+                timeline.finish('cancelled')
+                # Client went away: close any partial archive off the request thread, then drop the job's files
+                def discard():
+                    if archive:
+                        archive.close()
+                    artifacts.remove(session_id)
+                threading.Thread(target=discard, daemon=True).start()
 
-        ydl_opts = {
-            'format': format_selector,
-            'outtmpl': os.path.join(playlist_dir, '%(title)s.%(ext)s'),
-            'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': 'mp4'}],
-            'progress_hooks': [progress_hook],
-            'ignoreerrors': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-        }
-        
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                urls_to_download = [video.get('webpage_url') or video.get('url') for video in videos_to_download]
-                
-                # Download videos one by one to track progress better
-                for i, video_url in enumerate(urls_to_download, 1):
-                    try:
-                        # Get video info for title
-                        video_info = videos_to_download[i-1]
-                        current_video_title = video_info.get('title', f'Video {i}')
-                        current_video_index = i - 1
-                        
-                        # Send start update
-                        start_data = {
-                            'status': 'downloading',
-                            'current_video': i,
-                            'total_videos': total_videos,
-                            'video_title': current_video_title,
-                            'phase': 'Starting',
-                            'progress': 0,
-                            'speed': '0 MB/s',
-                            'size': '0 MB / 0 MB',
-                            'eta': 'N/A',
-                            'message': f'Starting video {i}/{total_videos}: {current_video_title[:50]}...'
-                        }
-                        yield f"data: {json.dumps(start_data)}\n\n"
-                        
-                        # Validate video URL
-                        if not video_url or not video_url.startswith(('http://', 'https://')):
-                            logger.warning(f"Skipping invalid URL: {video_url}")
-                            continue
-                        
-                        # Download in separate thread to allow real-time progress
-                        def download_video():
-                            try:
-                                ydl.download([video_url])
-                            except Exception as e:
-                                logger.error(f"Download error for video {i}: {e}")
-                        
-                        download_thread = threading.Thread(target=download_video)
-                        download_thread.start()
-                        
-                        # Send real-time progress updates while downloading
-                        while download_thread.is_alive():
-                            try:
-                                progress_data = progress_queue.get_nowait()
-                                yield f"data: {json.dumps(progress_data)}\n\n"
-                            except queue.Empty:
-                                pass
-                            time.sleep(0.3)
-                        
-                        download_thread.join()
-                        
-                        # Send any remaining progress updates
-                        while not progress_queue.empty():
-                            try:
-                                progress_data = progress_queue.get_nowait()
-                                yield f"data: {json.dumps(progress_data)}\n\n"
-                            except queue.Empty:
-                                break
-                        
-                        # Send completion update with correct overall progress
-                        overall_progress = (i / total_videos) * 100
-                        completion_data = {
-                            'status': 'downloading',
-                            'current_video': i,
-                            'total_videos': total_videos,
-                            'video_title': current_video_title,
-                            'phase': 'Completed',
-                            'progress': overall_progress,
-                            'speed': '0 MB/s',
-                            'size': 'Complete',
-                            'eta': '00:00',
-                            'message': f'Completed video {i}/{total_videos}'
-                        }
-                        yield f"data: {json.dumps(completion_data)}\n\n"
-                        
-                    except Exception as video_error:
-                        logger.error(f"Error downloading video {i}: {video_error}")
-                        # Send error update but continue
-                        error_data = {
-                            'status': 'downloading',
-                            'current_video': i,
-                            'total_videos': total_videos,
-                            'video_title': current_video_title,
-                            'phase': 'Error',
-                            'progress': 0,
-                            'speed': '0 MB/s',
-                            'size': 'Failed',
-                            'eta': 'N/A',
-                            'message': f'Failed video {i}, continuing...'
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        continue
+            if archive:
+                # Send zipping status
+                zip_data = {
+                    'status': 'zipping',
+                    'current_video': total_videos,
+                    'total_videos': total_videos,
+                    'video_title': 'All Videos',
+                    'phase': 'Zipping',
+                    'progress': 95,
+                    'speed': '0 MB/s',
+                    'size': 'Finalizing ZIP',
+                    'eta': 'N/A',
+                    'message': 'Finalizing ZIP file...'
+                }
+                yield f"data: {json.dumps(zip_data)}\n\n"
 
-            # Send zipping status
-            zip_data = {
-                'status': 'zipping',
-                'current_video': total_videos,
-                'total_videos': total_videos,
-                'video_title': 'All Videos',
-                'phase': 'Zipping',
-                'progress': 95,
-                'speed': '0 MB/s',
-                'size': 'Creating ZIP',
-                'eta': 'N/A',
-                'message': 'Creating ZIP file...'
-            }
-            yield f"data: {json.dumps(zip_data)}\n\n"
-            
-            zip_filename = f"{playlist_title}.zip"
-            unique_zip_name = f"{playlist_title}_{session_id}.zip"
-            zip_filepath = os.path.join(DOWNLOAD_FOLDER, unique_zip_name)
-            
-            with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, _, files in os.walk(playlist_dir):
-                    for file in files: zipf.write(os.path.join(root, file), arcname=file)
-            
-            final_data = {'status': 'finished', 'zip_name': zip_filename, 'session_id': session_id}
+                # Entries were archived as they finished; only the central directory is left
+                with timeline.phase('zip'):
+                    archive.close()
+                artifacts.mark_ready(session_id, archive.zip_filepath, download_name=zip_filename)
+            else:
+                # In stream mode /download_zip assembles the archive while sending it
+                artifacts.mark_ready(session_id, playlist_dir, download_name=zip_filename)
+
+            timeline.attrs.update(entries=total_videos, failed=sum(s['state'] == 'failed' for s in entry_states),
+                                  bytes=folder_size(artifact.dir))
+            observe_job('playlist', timeline.attrs['bytes'], time.monotonic() - job_started)
+            final_data = {'status': 'finished', 'zip_name': zip_filename, 'session_id': session_id, 'timeline': timeline.finish('ready')}
             yield f"data: {json.dumps(final_data)}\n\n"
             yield "data: [DONE]\n\n"
         except Exception as e:
             print(f"Playlist Stream Error: {e}")
             import traceback
             traceback.print_exc()
+            artifacts.remove(session_id)
+            timeline.finish('failed')
             yield f"data: {json.dumps({'status': 'error', 'message': f'Download failed: {str(e)}'})}\n\n"
             
-    return Response(generate(), mimetype='text/event-stream')
+    return generate()
+
+JOB_RUNNERS = {'single': single_download_job, 'playlist': playlist_download_job}
+JOB_PRIORITIES = {'single': SINGLE_DOWNLOAD_PRIORITY, 'playlist': PLAYLIST_ENTRY_PRIORITY}
 
 @app.route('/download_zip')
 def download_zip():
@@ -1238,28 +4402,330 @@ def download_zip():
     session_id = request.args.get('session_id'); zip_name = request.args.get('zip_name')
     if not all([session_id, zip_name]): return "Missing parameters", 400
 
-    playlist_title = sanitize_filename(zip_name.replace('.zip', ''))
-    unique_zip_name = f"{playlist_title}_{session_id}.zip"
-    temp_dir_name = f"{playlist_title}_{session_id}"
+    artifact = find_artifact(session_id)
+    if not artifact or artifact.state == 'pending' or not os.path.exists(artifact.final_path):
+        return "File not found", 404
+
+    # Decided and tracked under the lock, so a finishing materialization can't delete
+    # the entry files between choosing to stream them and counting this transfer
+    with artifact.lock:
+        if os.path.isfile(artifact.final_path):
+            response = send_file(artifact.final_path, as_attachment=True, download_name=zip_name,
+                                 conditional=True, etag=artifact.etag or True)
+        else:
+            if not artifact.etag:
+                artifact.etag = zip_etag(playlist_members(artifact.final_path))
+            if request.range:
+                # Resuming or segmented fetch: write the archive out once so later requests get byte ranges.
+                # This one gets the whole stream (ranges are optional for a server).
+                materialize_in_background(artifact)
+            # Stream mode: build the archive on the fly from the downloaded files (no Content-Length, so no ranges)
+            response = Response(timed(stream_zip(playlist_members(artifact.final_path)), ZIP_BUILD_SECONDS, mode='stream'),
+                                mimetype='application/zip')
+            response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(zip_name)}"
+            response.set_etag(artifact.etag)
+        return artifacts.track(response, artifact)
+
+# ============================================================================== 
+# ASGI SERVING (ANYVIDOW_SERVER=asgi, or any ASGI server: `uvicorn app:asgi_app`)
+# ============================================================================== 
+
+class JobStream:
+    """One client's view of a queued job inside JobEventHub."""
+
+    def __init__(self, job_id, after):
+        self.job_id = job_id
+        self.last_id = after
+        self.position = None
+        self.pending = True         # backlog not read yet
+        self.closed = False
+        self.chunks = asyncio.Queue()
+
+    def push_event(self, event_id, data):
+        if event_id > self.last_id:
+            self.last_id = event_id
+            self.chunks.put_nowait(f"id: {event_id}\n{data}")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.chunks.put_nowait(None)
+
+
+class JobEventHub:
+    """
+    Fans job events out to the progress streams open on the event loop.
+
+    A single poll of the job store per JOB_POLL_INTERVAL serves every stream,
+    so an idle progress connection costs a queue and a coroutine instead of a
+    thread polling SQLite. Produces the same chunks as JobQueue.follow().
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._streams = {}          # job_id -> set of JobStream
+        self._cursor = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-events')
+
+    def subscribe(self, job_id, after=0):
+        stream = JobStream(job_id, after)
+        self._streams.setdefault(job_id, set()).add(stream)
+        if not self._task or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return stream
+
+    def unsubscribe(self, stream):
+        streams = self._streams.get(stream.job_id)
+        if streams:
+            streams.discard(stream)
+            if not streams:
+                del self._streams[stream.job_id]
+
+    def _poll(self, pending):
+        """Runs on the hub's thread. Job states are read before events, so a job seen finished has all its events."""
+        active = self.jobs.active_jobs()
+        if self._cursor is None:
+            self._cursor = self.jobs.last_event_id()
+        backlog = {stream: self.jobs.events(stream.job_id, stream.last_id) for stream in pending}
+        events = self.jobs.events_since(self._cursor)
+        if events:
+            self._cursor = events[-1]['id']
+        return active, backlog, events, self.jobs.live_workers()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._streams:
+            pending = [stream for streams in self._streams.values() for stream in streams if stream.pending]
+            try:
+                active, backlog, events, workers = await loop.run_in_executor(self._executor, self._poll, pending)
+            except sqlite3.Error as e:
+                logger.warning(f"Job event poll failed: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            for stream, rows in backlog.items():
+                for row in rows:
+                    stream.push_event(row['id'], row['data'])
+                stream.pending = False
+            for row in events:
+                for stream in self._streams.get(row['job_id'], ()):
+                    if not stream.pending:
+                        stream.push_event(row['id'], row['data'])
+
+            states = dict(active)
+            positions = {job_id: i + 1 for i, job_id in enumerate(job_id for job_id, state in active if state == 'queued')}
+            for job_id, streams in self._streams.items():
+                for stream in streams:
+                    if stream.pending:
+                        continue
+                    if job_id not in states:
+                        stream.close()      # over (or unknown) and drained
+                    elif positions.get(job_id) != stream.position:
+                        stream.position = positions.get(job_id)
+                        if stream.position:
+                            stream.chunks.put_nowait(self.jobs.queued_event(job_id, stream.position, workers))
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+class AsgiServer:
+    """
+    ASGI front for the Flask app.
+
+    Progress streams of queued jobs are followed on the event loop through
+    JobEventHub, and response bodies (files, ZIPs) are sent as fast as the
+    client reads them, with only the reads themselves in the thread pool.
+    A /download waiting for its job is parked on the loop too (await_job).
+    Every other route runs as a normal Flask request on that pool; downloads
+    run in worker processes.
+    """
+
+    def __init__(self, flask_app, threads=ASGI_THREADS):
+        self.app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+        self.hub = JobEventHub(job_queue) if job_queue else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
 
-    response = send_from_directory(DOWNLOAD_FOLDER, unique_zip_name, as_attachment=True, download_name=zip_name)
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(self.executor, start_janitor)
+                if not job_queue:
+                    logger.warning("ASGI mode without the job queue: every progress stream holds a thread (set ANYVIDOW_JOB_QUEUE=1)")
+                elif WORKER_PROCESSES:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, spawn_workers, WORKER_PROCESSES)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def environ(self, scope, body):
+        """WSGI environ for an ASGI HTTP scope."""
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            # send_file reads through this; bigger blocks mean fewer hops to the thread pool
+            'wsgi.file_wrapper': lambda file, buffer_size=ASGI_CHUNK_SIZE: FileWrapper(file, ASGI_CHUNK_SIZE),
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        environ['CONTENT_LENGTH'] = str(len(body))     # the body is fully read, chunked or not
+        return environ
 
-    @response.call_on_close
-    def cleanup():
-        def delayed_cleanup():
-            time.sleep(5)
+    def dispatch(self, environ):
+        """Runs one Flask request on a pool thread; returns (response, body iterator, status, headers)."""
+        with self.app.request_context(environ):
             try:
-                zip_path = os.path.join(DOWNLOAD_FOLDER, unique_zip_name)
-                dir_path = os.path.join(DOWNLOAD_FOLDER, temp_dir_name)
-                if os.path.exists(zip_path): os.remove(zip_path)
-                if os.path.exists(dir_path): shutil.rmtree(dir_path)
+                response = self.app.full_dispatch_request()
             except Exception as e:
-                print(f"Cleanup error: {e}")
-        threading.Thread(target=delayed_cleanup, daemon=True).start()
-    return response
+                response = self.app.handle_exception(e)
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        return response, app_iter, status, headers
+
+    async def http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, bytes(body))
+        # Watched from the start so routes that block (disconnect_probe) can give up early
+        environ['anyvidow.disconnected'] = gone = threading.Event()
+        environ['anyvidow.await_job'] = bool(self.hub)
+        disconnected = loop.create_task(self.wait_disconnect(receive))
+        disconnected.add_done_callback(lambda task: gone.set())
+        try:
+            response, app_iter, status, headers = await loop.run_in_executor(self.executor, self.dispatch, environ)
+            awaited = getattr(response, 'await_job', None) if self.hub else None
+            if awaited and await self.await_job(awaited, disconnected):
+                # The job is over: run the route again to send its file instead of the 202
+                if hasattr(app_iter, 'close'):
+                    await loop.run_in_executor(self.executor, app_iter.close)
+                environ = dict(self.environ(scope, bytes(body)), **{'anyvidow.disconnected': gone, 'anyvidow.finished_job': awaited})
+                response, app_iter, status, headers = await loop.run_in_executor(self.executor, self.dispatch, environ)
+            elif awaited and disconnected.done():
+                await loop.run_in_executor(self.executor, job_queue.request_cancel, awaited)
+        except BaseException:
+            disconnected.cancel()
+            raise
+        follow = getattr(response, 'follow_job', None) if self.hub else None
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+            if follow:
+                await self.send_job_stream(send, *follow, disconnected)
+            else:
+                await self.send_body(send, app_iter, disconnected)
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass        # client went away mid-send
+        finally:
+            disconnected.cancel()
+            if hasattr(app_iter, 'close'):
+                # Runs the response's close callbacks (artifact tracking) and stops unread generators
+                await loop.run_in_executor(self.executor, app_iter.close)
+
+    async def await_job(self, job_id, disconnected):
+        """Waits on the event loop for a queued job to end. False after JOB_WAIT_TIMEOUT or a client disconnect."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + JOB_WAIT_TIMEOUT
+        stream = self.hub.subscribe(job_id)
+        try:
+            while not disconnected.done() and loop.time() < deadline:
+                try:
+                    # The hub closes the stream once the job is over and its events are drained
+                    if await asyncio.wait_for(stream.chunks.get(), 1.0) is None:
+                        return True
+                except asyncio.TimeoutError:
+                    pass
+            return False
+        finally:
+            self.hub.unsubscribe(stream)
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def send_body(self, send, app_iter, disconnected):
+        loop = asyncio.get_running_loop()
+        chunks = iter(app_iter)
+        while not disconnected.done():
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            if chunk is None:
+                return
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk.encode() if isinstance(chunk, str) else chunk,
+                            'more_body': True})
+
+    async def send_job_stream(self, send, job_id, after, disconnected):
+        stream = self.hub.subscribe(job_id, after)
+        SSE_CONNECTIONS.inc()
+        try:
+            while not disconnected.done():
+                try:
+                    chunk = await asyncio.wait_for(stream.chunks.get(), SSE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    chunk = SSE_HEARTBEAT
+                if chunk is None:
+                    return
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        finally:
+            self.hub.unsubscribe(stream)
+            SSE_CONNECTIONS.dec()
+
+asgi_app = AsgiServer(app)
 
 # ============================================================================== 
 # RUN APPLICATION
 # ============================================================================== 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
+    if PROCESS_ROLE == 'worker':
+        # python app.py worker [--processes N]
+        processes = int(sys.argv[3]) if sys.argv[2:3] == ['--processes'] and len(sys.argv) > 3 else os.cpu_count() or 1
+        run_workers(processes)
+    elif SERVER_MODE == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit("ANYVIDOW_SERVER=asgi needs an ASGI server: pip install uvicorn")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=8000)    # starts the janitor and the workers itself (lifespan)
+    else:
+        # The debug reloader re-runs this block in a child process; start workers only once
+        if WORKER_PROCESSES and os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+            spawn_workers(WORKER_PROCESSES)
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_janitor()     # the serving child; the parent only watches files
+        app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -0,0 +1,528 @@
+"""
+Offline benchmark harness for AnyviDow.
+
+Fixture media is served from a local HTTP server and downloaded through yt-dlp's
+generic extractor (a direct file for combined downloads, a DASH manifest with
+separate video/audio representations for video_only, an RSS feed for playlists),
+so no network access is needed. Pure functions (FormatIndex, merge, ZIP) are
+called directly. The job queue runs against a throwaway SQLite file, and its
+claim/requeue/cancel/retry rules are checked before it is timed.
+
+    python benchmarks/bench.py                      # full run, results/<timestamp>.json
+    python benchmarks/bench.py --quick              # smaller fixtures, fewer repeats
+    python benchmarks/bench.py --only zip merge     # a subset
+    python benchmarks/bench.py --baseline old.json  # exit 1 on regressions
+
+Merge benchmarks and real media fixtures need ffmpeg on PATH; without it the
+downloads use random bytes and merge benchmarks are reported as skipped.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import threading
+from datetime import datetime
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ('single', 'merge', 'formats', 'playlist', 'zip', 'queue')
+
+
+# ==============================================================================
+# FIXTURES
+# ==============================================================================
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Static file handler that ignores clients hanging up early (yt-dlp probes then closes)."""
+
+    extensions_map = {**SimpleHTTPRequestHandler.extensions_map, '.mpd': 'application/dash+xml',
+                      '.m4a': 'audio/mp4', '.xml': 'application/rss+xml'}
+
+    def copyfile(self, source, outputfile):
+        try:
+            super().copyfile(source, outputfile)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def has_ffmpeg():
+    return bool(shutil.which('ffmpeg') and shutil.which('ffprobe'))
+
+def ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-y', '-v', 'error', *args], check=True)
+
+def write_random(path, size):
+    rng = random.Random(size)
+    with open(path, 'wb') as fh:
+        remaining = size
+        while remaining:
+            block = min(remaining, 1024 * 1024)
+            fh.write(rng.randbytes(block))
+            remaining -= block
+
+def make_fixtures(directory, size_mb, duration, real_media):
+    """Writes video.mp4 (video only), audio.m4a, combined.mp4 and manifest.mpd into `directory`."""
+    video, audio, combined = (os.path.join(directory, n) for n in ('video.mp4', 'audio.m4a', 'combined.mp4'))
+    if real_media:
+        # mpeg4 video so the h264 transcode benchmark really re-encodes
+        bitrate = f"{max(1, size_mb * 8 // duration)}M"
+        ffmpeg('-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={duration}',
+               '-c:v', 'mpeg4', '-b:v', bitrate, '-an', video)
+        ffmpeg('-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}', '-c:a', 'aac', '-b:a', '128k', audio)
+        ffmpeg('-i', video, '-i', audio, '-c', 'copy', combined)
+    else:
+        write_random(video, size_mb * 1024 * 1024)
+        write_random(audio, max(1, size_mb // 16) * 1024 * 1024)
+        write_random(combined, size_mb * 1024 * 1024)
+    with open(os.path.join(directory, 'manifest.mpd'), 'w') as fh:
+        fh.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{duration}S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-on-demand:2011">
+  <Period>
+    <AdaptationSet mimeType="video/mp4" contentType="video">
+      <Representation id="video" codecs="mp4v.20.9" bandwidth="{size_mb * 8 * 1024 * 1024 // duration}" width="1280" height="720"><BaseURL>video.mp4</BaseURL></Representation>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4" contentType="audio">
+      <Representation id="audio" codecs="mp4a.40.2" bandwidth="128000" audioSamplingRate="44100"><BaseURL>audio.m4a</BaseURL></Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+""")
+    return {'video': video, 'audio': audio, 'combined': combined}
+
+def write_feed(directory, base_url, entries):
+    """RSS feed of `entries` distinct URLs for the combined fixture (distinct so single-flight does not merge them)."""
+    name = f"feed_{entries}.xml"
+    items = ''.join(
+        f'<item><title>Entry {i}</title><link>{base_url}/combined.mp4?entry={i}</link>'
+        f'<enclosure url="{base_url}/combined.mp4?entry={i}" type="video/mp4"/></item>'
+        for i in range(1, entries + 1)
+    )
+    with open(os.path.join(directory, name), 'w') as fh:
+        fh.write(f'<?xml version="1.0"?><rss version="2.0"><channel><title>Bench {entries}</title>'
+                 f'<link>{base_url}/</link><description>benchmark</description>{items}</channel></rss>')
+    return f"{base_url}/{name}"
+
+
+# ==============================================================================
+# MEASUREMENT HELPERS
+# ==============================================================================
+
+def summarize(samples):
+    return {
+        'min': round(min(samples), 4),
+        'median': round(statistics.median(samples), 4),
+        'mean': round(statistics.fmean(samples), 4),
+        'max': round(max(samples), 4),
+    }
+
+def result(seconds, nbytes=None, **extra):
+    """One benchmark entry: timing stats over all runs plus optional throughput."""
+    out = {'runs': len(seconds), 'seconds': summarize(seconds)}
+    if nbytes:
+        out['bytes'] = nbytes
+        out['throughput_mb_s'] = round(nbytes / 1024 / 1024 / statistics.median(seconds), 2)
+    out.update(extra)
+    return out
+
+def phase_medians(timelines):
+    """Median time per phase name across job timelines (overlapping phases of one name are summed)."""
+    per_phase = {}
+    for timeline in timelines:
+        totals = {}
+        for phase in timeline.get('phases', []):
+            if phase.get('end') is not None:
+                totals[phase['name']] = totals.get(phase['name'], 0) + phase['end'] - phase['start']
+        for name, seconds in totals.items():
+            per_phase.setdefault(name, []).append(seconds)
+    return {name: round(statistics.median(values), 4) for name, values in per_phase.items()}
+
+def read_events(response):
+    """Decodes an SSE response body into its JSON events."""
+    events = []
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith('data: {'):
+            events.append(json.loads(line[6:]))
+    return events
+
+
+# ==============================================================================
+# BENCHMARKS
+# ==============================================================================
+
+def bench_single(app, client, base_url, fixtures, repeat, real_media):
+    results = {}
+    cases = {
+        'combined': (f"{base_url}/combined.mp4", 'combined', os.path.getsize(fixtures['combined'])),
+        'video_only': (f"{base_url}/manifest.mpd", 'video_only', None),
+    }
+    for name, (url, file_type, nbytes) in cases.items():
+        info = app.get_video_info(url, use_cache=False)
+        formats = info.get('formats', [])
+        format_id = next((f['format_id'] for f in formats if f.get('vcodec') != 'none'), formats[0]['format_id'])
+        seconds, timelines, sizes = [], [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = client.get('/stream_single_download', query_string={
+                'url': url, 'format_id': format_id, 'title': f'bench_{name}', 'type': file_type})
+            events = read_events(response)
+            elapsed = time.perf_counter() - started
+            ready = next((e for e in events if e.get('status') == 'ready'), None)
+            if not ready:
+                raise RuntimeError(f"single {name} did not finish: {events[-1:] or 'no events'}")
+            seconds.append(elapsed)
+            timelines.append(ready.get('timeline') or {})
+            sizes.append((ready.get('timeline') or {}).get('bytes') or nbytes or 0)
+            client.get('/download_file', query_string={'session_id': ready['session_id'], 'filename': ready['filename']}).close()
+        merge = next((p for p in timelines[-1].get('phases', []) if p['name'] == 'merge'), None)
+        results[f"single[{name}]"] = result(
+            seconds, statistics.median(sizes), phases=phase_medians(timelines),
+            **({'merge_strategy': merge.get('strategy')} if merge else {}),
+            **({} if real_media or name == 'combined' else {'note': 'random-byte fixtures: merge falls back to video only'}))
+    return results
+
+def bench_merge(app, fixtures, repeat, codecs, workdir):
+    if not has_ffmpeg():
+        return {'merge': {'skipped': 'ffmpeg/ffprobe not on PATH'}}
+    results = {}
+    for codec in [None, *codecs]:
+        seconds, probes, strategy = [], [], None
+        for i in range(repeat):
+            merge = app.merge_video_audio(fixtures['video'], fixtures['audio'], os.path.join(workdir, f'merge_{codec}_{i}'), codec)
+            if not merge:
+                raise RuntimeError(f"merge with codec={codec} failed")
+            seconds.append(merge['seconds'])
+            probes.append(merge['probe_seconds'])
+            strategy = f"{merge['strategy']}/{merge['container']}"
+            os.remove(merge['path'])
+        nbytes = os.path.getsize(fixtures['video']) + os.path.getsize(fixtures['audio'])
+        results[f"merge[{codec or 'copy'}]"] = result(seconds, nbytes, strategy=strategy, probe_seconds=summarize(probes))
+    return results
+
+def synthetic_formats(count, seed=0):
+    """A yt-dlp-like format list with the mix of combined, video-only and audio-only formats sites return."""
+    rng = random.Random(seed)
+    heights = [144, 240, 360, 480, 720, 1080, 1440, 2160]
+    formats = []
+    for i in range(count):
+        kind = rng.choice(('video', 'video', 'audio', 'combined'))
+        height = rng.choice(heights)
+        formats.append({
+            'format_id': f"{kind[0]}{i}",
+            'ext': rng.choice(('mp4', 'webm', 'm4a')),
+            'vcodec': 'none' if kind == 'audio' else rng.choice(('avc1.640028', 'vp9', 'av01.0.08M.08')),
+            'acodec': 'none' if kind == 'video' else rng.choice(('mp4a.40.2', 'opus')),
+            'height': None if kind == 'audio' else height,
+            'format_note': None if rng.random() < 0.3 else (f"{height}p" if kind != 'audio' else f"{rng.choice((48, 64, 128, 160))}k"),
+            'abr': rng.choice((48, 64, 128, 160)) if kind != 'video' else None,
+            'filesize': rng.randint(10 ** 5, 10 ** 9) if rng.random() < 0.7 else None,
+            'filesize_approx': rng.randint(10 ** 5, 10 ** 9),
+        })
+    return formats
+
+def bench_formats(app, sizes, repeat):
+    results = {}
+    for count in sizes:
+        formats = synthetic_formats(count)
+        # Scale inner iterations so every size is timed over a comparable wall time
+        inner = max(1, 20000 // count)
+        seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(inner):
+                app.FormatIndex(formats).listing()
+            seconds.append((time.perf_counter() - started) / inner)
+        results[f"format_index[n={count}]"] = result(seconds, formats_per_s=round(count / statistics.median(seconds)))
+    return results
+
+def bench_playlist(app, client, fixture_dir, base_url, sizes, concurrencies, repeat):
+    results = {}
+    for entries in sizes:
+        url = write_feed(fixture_dir, base_url, entries)
+        for concurrency in concurrencies:
+            seconds, zip_seconds, timelines, sizes_ = [], [], [], []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = client.get('/stream_playlist_download', query_string={
+                    'url': url, 'quality': '1080', 'concurrency': concurrency})
+                events = read_events(response)
+                seconds.append(time.perf_counter() - started)
+                finished = next((e for e in events if e.get('status') == 'finished'), None)
+                if not finished:
+                    raise RuntimeError(f"playlist n={entries} did not finish: {events[-1:] or 'no events'}")
+                timelines.append(finished.get('timeline') or {})
+                started = time.perf_counter()
+                archive = client.get('/download_zip', query_string={'session_id': finished['session_id'], 'zip_name': finished['zip_name']})
+                sizes_.append(len(archive.get_data()))
+                archive.close()
+                zip_seconds.append(time.perf_counter() - started)
+            results[f"playlist[entries={entries},concurrency={concurrency}]"] = result(
+                seconds, statistics.median(sizes_), phases=phase_medians(timelines), zip_fetch_seconds=summarize(zip_seconds))
+    return results
+
+def bench_zip(app, fixtures, workdir, entries, repeat):
+    """Archives `entries` links of the combined fixture with each ZIP strategy."""
+    def make_playlist_dir(root):
+        os.makedirs(root)
+        for i in range(entries):
+            entry_dir = os.path.join(root, f"{i + 1:03d}")
+            os.makedirs(entry_dir)
+            app.link_file(fixtures['combined'], os.path.join(entry_dir, f"entry_{i + 1}.mp4"))
+        return root
+
+    nbytes = os.path.getsize(fixtures['combined']) * entries
+    timings = {'stream': [], 'materialize': [], 'file': []}
+    for run in range(repeat):
+        playlist_dir = make_playlist_dir(os.path.join(workdir, f'zip_stream_{run}'))
+        started = time.perf_counter()
+        for _ in app.stream_zip(app.playlist_members(playlist_dir)):
+            pass
+        timings['stream'].append(time.perf_counter() - started)
+        shutil.rmtree(playlist_dir)
+
+        playlist_dir = make_playlist_dir(os.path.join(workdir, f'zip_materialize_{run}'))
+        started = time.perf_counter()
+        app.materialize_zip(playlist_dir, playlist_dir + '.zip')
+        timings['materialize'].append(time.perf_counter() - started)
+        os.remove(playlist_dir + '.zip')
+
+        playlist_dir = make_playlist_dir(os.path.join(workdir, f'zip_file_{run}'))
+        archive = app.PlaylistArchive(playlist_dir + '.zip')
+        started = time.perf_counter()
+        for i in range(entries):
+            archive.entry_finished(i, os.path.join(playlist_dir, f"{i + 1:03d}"))
+        archive.close()
+        timings['file'].append(time.perf_counter() - started)
+        os.remove(playlist_dir + '.zip')
+        shutil.rmtree(playlist_dir, ignore_errors=True)
+    return {f"zip[{mode},entries={entries}]": result(seconds, nbytes) for mode, seconds in timings.items()}
+
+def check_job_queue(app, queue):
+    """Walks the job queue through its state machine; raises RuntimeError on the first wrong transition. Returns the checks run."""
+    checks = []
+
+    def expect(what, job_id, state, attempts=None):
+        job = queue.get(job_id)
+        if job['state'] != state or (attempts is not None and job['attempts'] != attempts):
+            raise RuntimeError(f"queue {what}: expected {state}/{attempts} attempts, got {job['state']}/{job['attempts']}")
+        checks.append(what)
+        return job
+
+    def age_worker(worker_id):
+        # A heartbeat from before the stale cutoff, as if the worker froze that long ago
+        queue._db().execute('UPDATE workers SET heartbeat = ? WHERE id = ?',
+                            (time.time() - app.WORKER_STALE_AFTER - 1, worker_id))
+
+    # enqueue -> claim -> finish
+    job_id = queue.enqueue('download', {'url': 'bench'})
+    claimed = queue.claim('w1')
+    if not claimed or claimed['id'] != job_id or queue.claim('w1') is not None:
+        raise RuntimeError(f"queue claim: expected {job_id} once, got {claimed and claimed['id']}")
+    expect('claim', job_id, 'running', attempts=1)
+    queue.finish(job_id, 'done', {'final_path': 'bench.mp4'})
+    if expect('finish', job_id, 'done')['result'] != {'final_path': 'bench.mp4'}:
+        raise RuntimeError("queue finish: result not stored")
+
+    # A worker with a fresh heartbeat keeps its job; one silent for WORKER_STALE_AFTER loses it
+    job_id = queue.enqueue('download', {'url': 'bench'})
+    queue.heartbeat('w1')
+    queue.claim('w1')
+    queue.reap_stale()
+    expect('live worker kept', job_id, 'running', attempts=1)
+    age_worker('w1')
+    queue.reap_stale()
+    expect('stale worker requeued', job_id, 'queued', attempts=1)
+    if queue.live_workers() != 0:
+        raise RuntimeError("queue reap: stale worker still counted as live")
+    queue.claim('w2')
+    expect('requeued job reclaimed', job_id, 'running', attempts=2)
+    queue.finish(job_id, 'done')
+
+    # Cancelling a queued job ends it at once; a running one only flags it for its worker
+    job_id = queue.enqueue('download', {'url': 'bench'})
+    queue.request_cancel(job_id)
+    expect('cancel queued', job_id, 'cancelled')
+    if queue.request_cancel(job_id):
+        raise RuntimeError("queue cancel: a cancelled job accepted another cancel")
+    job_id = queue.enqueue('download', {'url': 'bench'})
+    queue.claim('w2')
+    queue.request_cancel(job_id)
+    expect('cancel running', job_id, 'running')
+    if queue.cancel_requests('w2') != [job_id]:
+        raise RuntimeError("queue cancel: running job not reported to its worker")
+    queue.release(job_id)
+    expect('cancel running released', job_id, 'cancelled')
+
+    # A clean worker shutdown is not an attempt; JOB_MAX_ATTEMPTS crashed runs fail the job
+    job_id = queue.enqueue('download', {'url': 'bench'})
+    queue.claim('w3')
+    queue.release(job_id)
+    expect('release', job_id, 'queued', attempts=0)
+    for run in range(1, app.JOB_MAX_ATTEMPTS + 1):
+        worker_id = f'crash{run}'
+        queue.heartbeat(worker_id)
+        queue.claim(worker_id)
+        age_worker(worker_id)
+        queue.reap_stale()
+        expect(f'crash {run}', job_id, 'failed' if run == app.JOB_MAX_ATTEMPTS else 'queued', attempts=run)
+    if queue.events_since(0)[-1]['data'] != "data: [DONE]\n\n":
+        raise RuntimeError("queue fail: event stream of the failed job not closed")
+    return checks
+
+def bench_queue(app, workdir, jobs, repeat):
+    """Enqueue -> claim -> finish throughput of the SQLite job queue, after checking its state machine."""
+    queue = app.JobQueue(os.path.join(workdir, 'queue', 'jobs.sqlite3'))
+    checks = check_job_queue(app, queue)
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for i in range(jobs):
+            queue.enqueue('download', {'url': f'bench{i}'})
+        while (job := queue.claim('bench')) is not None:
+            queue.finish(job['id'], 'done', {'final_path': 'bench.mp4'})
+        seconds.append(time.perf_counter() - started)
+    return {f"queue[jobs={jobs}]": result(seconds, jobs_per_s=round(jobs / statistics.median(seconds)), checks=len(checks))}
+
+
+# ==============================================================================
+# REGRESSION CHECK
+# ==============================================================================
+
+def compare(results, baseline, tolerance):
+    """Returns (name, baseline median, current median) for every benchmark slower than baseline by more than `tolerance`."""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or 'seconds' not in current or 'seconds' not in previous:
+            continue
+        if current['seconds']['median'] > previous['seconds']['median'] * (1 + tolerance):
+            regressions.append((name, previous['seconds']['median'], current['seconds']['median']))
+    return regressions
+
+
+# ==============================================================================
+# MAIN
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='run only these benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small fixtures and one repeat (smoke run)')
+    parser.add_argument('--repeat', type=int, help='runs per benchmark (default 5, 1 with --quick)')
+    parser.add_argument('--size-mb', type=int, help='fixture size (default 64, 4 with --quick)')
+    parser.add_argument('--duration', type=int, default=20, help='fixture duration in seconds when ffmpeg is available')
+    parser.add_argument('--playlist-sizes', type=int, nargs='+', help='playlist entry counts (default 5 20)')
+    parser.add_argument('--concurrency', type=int, nargs='+', help='playlist worker counts (default 1 4)')
+    parser.add_argument('--codecs', nargs='*', default=['h264'], help='transcode targets for the merge benchmark')
+    parser.add_argument('--output', help='result file (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier result file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs baseline (0.25 = 25%%)')
+    parser.add_argument('--verbose', action='store_true', help='show application logs')
+    args = parser.parse_args()
+
+    repeat = args.repeat or (1 if args.quick else 5)
+    size_mb = args.size_mb or (4 if args.quick else 64)
+    playlist_sizes = args.playlist_sizes or ([3] if args.quick else [5, 20])
+    concurrencies = args.concurrency or ([2] if args.quick else [1, 4])
+    selected = args.only or BENCHMARKS
+    real_media = has_ffmpeg()
+
+    workdir = tempfile.mkdtemp(prefix='anyvidow-bench-')
+    fixture_dir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixture_dir)
+    # The app keeps downloads/ and cache/ under the working directory; measure cold paths only
+    os.chdir(workdir)
+    os.environ.update(ANYVIDOW_DOWNLOAD_CACHE='0', ANYVIDOW_INFO_CACHE_TTL='0', ANYVIDOW_INFO_CACHE_DISK='0')
+    sys.path.insert(0, REPO_ROOT)
+    import app
+    import yt_dlp
+    if not args.verbose:
+        logging.getLogger('app').setLevel(logging.WARNING)
+
+    server = None
+    try:
+        print(f"Preparing {size_mb} MB fixtures ({'ffmpeg' if real_media else 'random bytes'}) in {workdir}")
+        fixtures = make_fixtures(fixture_dir, size_mb, args.duration, real_media)
+        server, base_url = start_server(fixture_dir)
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+
+        results = {}
+        for name in selected:
+            print(f"Running {name}...")
+            started = time.perf_counter()
+            if name == 'single':
+                results.update(bench_single(app, client, base_url, fixtures, repeat, real_media))
+            elif name == 'merge':
+                results.update(bench_merge(app, fixtures, repeat, args.codecs, workdir))
+            elif name == 'formats':
+                results.update(bench_formats(app, [50, 500, 5000], max(repeat, 3)))
+            elif name == 'playlist':
+                results.update(bench_playlist(app, client, fixture_dir, base_url, playlist_sizes, concurrencies, repeat))
+            elif name == 'zip':
+                results.update(bench_zip(app, fixtures, workdir, max(playlist_sizes), repeat))
+            elif name == 'queue':
+                results.update(bench_queue(app, workdir, 50 if args.quick else 500, repeat))
+            print(f"  done in {time.perf_counter() - started:.1f}s")
+    finally:
+        if server:
+            server.shutdown()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                           capture_output=True, text=True).stdout.strip() or None,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'yt_dlp': yt_dlp.version.__version__,
+            'ffmpeg': real_media,
+            'fixture_mb': size_mb,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Wrote {output}")
+
+    for name, entry in results.items():
+        if 'seconds' in entry:
+            throughput = f"  {entry['throughput_mb_s']:.1f} MB/s" if 'throughput_mb_s' in entry else ''
+            print(f"  {name:45s} median {entry['seconds']['median']:.4f}s{throughput}")
+        else:
+            print(f"  {name:45s} {entry}")
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.4f}s -> {after:.4f}s")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,9 @@ document.addEventListener('DOMContentLoaded', () => {
             toastContainer: document.querySelector('.toast-container'),
             singleVideoResult: document.getElementById('singleVideoResult'),
             playlistResult: document.getElementById('playlistResult'),
+            batchResult: document.getElementById('batchResult'),
+            batchList: document.getElementById('batchList'),
+            batchSummary: document.getElementById('batchSummary'),
             videoPlayerModal: document.getElementById('videoPlayerModal'),
             videoPlayerIframe: document.getElementById('videoPlayerIframe'),
             singleProgressModal: document.getElementById('singleProgressModal'),
@@ -43,6 +46,7 @@ document.addEventListener('DOMContentLoaded', () => {
         state: {
             lastVideoData: null,
             lastPlaylistData: null,
+            batchResults: [],
             videoPlayerModalInstance: null,
             singleProgressModalInstance: null,
             audioProgressModalInstance: null,
@@ -50,6 +54,9 @@ document.addEventListener('DOMContentLoaded', () => {
             sseConnection: null,
             singleSseConnection: null,
             currentSessionId: null,
+            singleLastEventId: '',
+            playlistSessionId: null,
+            playlistLastEventId: '',
         },
 
         // --- Initialize ---
@@ -195,8 +202,14 @@ document.addEventListener('DOMContentLoaded', () => {
                 e.preventDefault();
                 console.log('Form submitted');
                 
-                const url = this.els.videoURLInput.value.trim();
-                if (!url) return;
+                const urls = this.parseUrls(this.els.videoURLInput.value);
+                if (!urls.length) return;
+                if (urls.length > 1) {
+                    this.fetchBatchInfo(urls);
+                    return;
+                }
+                const url = urls[0];
+                if (this.els.batchResult) this.els.batchResult.classList.add('d-none');
                 
                 this.showLoadingState(true);
                 
@@ -239,6 +252,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 const btn = e.target.closest('.download-btn');
                 const playBtn = e.target.closest('.play-icon-overlay, .thumbnail-container');
                 const shareBtn = e.target.closest('#shareLink');
+                const batchBtn = e.target.closest('.batch-open-btn');
                 
                 if (btn) {
                     e.preventDefault();
@@ -254,6 +268,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     e.preventDefault();
                     this.shareVideo();
                 }
+
+                if (batchBtn) {
+                    e.preventDefault();
+                    this.openBatchItem(parseInt(batchBtn.dataset.index, 10));
+                }
             });
             
             // Check for redownload URL and auto-fetch
@@ -303,6 +322,124 @@ document.addEventListener('DOMContentLoaded', () => {
             });
         },
 
+        parseUrls(text) {
+            // Links may be separated by whitespace/commas or pasted back to back
+            return text.split(/[\s,]+|(?=https?:\/\/)/).map(u => u.trim()).filter(Boolean);
+        },
+
+        async fetchBatchInfo(urls) {
+            const list = this.els.batchList;
+            if (!list) return;
+            this.state.batchResults = new Array(urls.length).fill(null);
+            list.innerHTML = urls.map((url, index) => `
+                <div class="list-group-item d-flex align-items-center gap-3" id="batchItem${index}">
+                    <div class="spinner-border spinner-border-sm text-primary flex-shrink-0"></div>
+                    <div class="text-truncate text-body-secondary small">${this.escapeHtml(url)}</div>
+                </div>`).join('');
+            if (this.els.batchSummary) this.els.batchSummary.textContent = `0 / ${urls.length}`;
+            if (this.els.singleVideoResult) this.els.singleVideoResult.classList.add('d-none');
+            if (this.els.playlistResult) this.els.playlistResult.classList.add('d-none');
+            this.els.batchResult.classList.remove('d-none');
+            this.els.resultsSection.classList.remove('d-none');
+            this.els.contentWrapper.classList.remove('d-none');
+            this.els.fetchBtn.disabled = true;
+
+            let finished = 0;
+            try {
+                const res = await fetch('/api/fetch_info_batch', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
+                    body: JSON.stringify({ urls })
+                });
+                if (!res.ok) {
+                    const data = await res.json().catch(() => ({}));
+                    this.showToast(data.error || 'Failed to fetch info.', 'danger');
+                    this.els.batchResult.classList.add('d-none');
+                    return;
+                }
+                // Results arrive one JSON object per line, in the order they finish
+                const reader = res.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    lines.filter(Boolean).forEach(line => {
+                        const result = JSON.parse(line);
+                        if (result.done) {
+                            if (result.failed) this.showToast(`${result.failed} of ${result.total} links could not be fetched.`, 'warning');
+                            return;
+                        }
+                        this.renderBatchItem(result);
+                        finished++;
+                        if (this.els.batchSummary) this.els.batchSummary.textContent = `${finished} / ${urls.length}`;
+                    });
+                }
+            } catch (error) {
+                console.error('Batch fetch error:', error);
+                this.showToast('Network error occurred.', 'danger');
+            } finally {
+                this.els.fetchBtn.disabled = false;
+            }
+        },
+
+        renderBatchItem(result) {
+            const item = document.getElementById(`batchItem${result.index}`);
+            if (!item) return;
+            const url = this.escapeHtml(result.url);
+            if (result.error) {
+                item.innerHTML = `
+                    <i class="bi bi-exclamation-triangle-fill text-danger fs-4 flex-shrink-0"></i>
+                    <div class="flex-grow-1 overflow-hidden">
+                        <div class="text-truncate small">${url}</div>
+                        <div class="text-danger small">${this.escapeHtml(result.error)}</div>
+                    </div>`;
+                return;
+            }
+            const data = result.info;
+            this.state.batchResults[result.index] = data;
+            const isPlaylist = data.type === 'playlist';
+            const meta = isPlaylist ? `${data.video_count} videos` : (data.duration || '');
+            const thumb = data.thumbnail
+                ? `<img src="${this.escapeHtml(this.thumbSrc(data.thumbnail, 160))}" class="rounded flex-shrink-0" style="width: 80px; height: 45px; object-fit: cover;" alt="">`
+                : `<div class="bg-secondary rounded flex-shrink-0" style="width: 80px; height: 45px;"></div>`;
+            item.innerHTML = `
+                ${thumb}
+                <div class="flex-grow-1 overflow-hidden">
+                    <div class="text-truncate fw-semibold" title="${this.escapeHtml(data.title)}">${this.escapeHtml(data.title)}</div>
+                    <div class="small text-body-secondary">
+                        <span class="badge ${isPlaylist ? 'bg-info' : 'bg-primary'} me-1">${isPlaylist ? 'Playlist' : 'Video'}</span>${this.escapeHtml(meta)}
+                    </div>
+                </div>
+                <button class="btn btn-sm btn-outline-primary batch-open-btn flex-shrink-0" data-index="${result.index}">Open</button>`;
+        },
+
+        openBatchItem(index) {
+            const data = this.state.batchResults[index];
+            if (!data) return;
+            if (data.type === 'playlist') {
+                this.state.lastPlaylistData = data;
+                this.displayPlaylistInfo(data);
+            } else {
+                this.state.lastVideoData = data;
+                this.displaySingleVideoInfo(data);
+            }
+        },
+
+        thumbSrc(url, width) {
+            // Proxied thumbnails (/thumb/...) can be requested at the size they are shown
+            return url && url.startsWith('/thumb/') ? `${url}?w=${width}` : url;
+        },
+
+        escapeHtml(text) {
+            const div = document.createElement('div');
+            div.textContent = text == null ? '' : String(text);
+            return div.innerHTML.replace(/"/g, '&quot;');
+        },
+
         showLoadingState(isLoading) {
             if (!this.els.fetchBtn) return;
             
@@ -338,7 +475,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (elements.videoDate) elements.videoDate.textContent = data.upload_date;
             if (elements.videoDuration) elements.videoDuration.textContent = data.duration;
             if (elements.videoLikes) elements.videoLikes.textContent = data.like_count;
-            if (elements.videoThumbnail) elements.videoThumbnail.src = data.thumbnail || 'static/placeholder.png';
+            if (elements.videoThumbnail) elements.videoThumbnail.src = this.thumbSrc(data.thumbnail, 640) || 'static/placeholder.png';
             
             if (elements.videoPlatform) {
                 const platform = data.platform.charAt(0).toUpperCase() + data.platform.slice(1);
@@ -370,7 +507,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 videoTable.innerHTML = '';
                 videoFormats.forEach(vf => {
                     const row = `<tr>
-                        <td>${vf.resolution}</td>
+                        <td>${vf.resolution}${vf.vcodec ? ` <small class="text-body-secondary">${vf.vcodec.toUpperCase()}</small>` : ''}</td>
                         <td>${vf.filesize}</td>
                         <td><span class="badge bg-secondary">${vf.type.replace('_', ' ')}</span></td>
                         <td><button class="btn btn-sm btn-success download-btn" data-type="${vf.type}" data-format="${vf.format_id}">
@@ -385,7 +522,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 audioTable.innerHTML = '';
                 audioFormats.forEach(af => {
                     const row = `<tr>
-                        <td>${af.quality}</td>
+                        <td>${af.quality}${af.acodec ? ` <small class="text-body-secondary">${af.acodec.toUpperCase()}</small>` : ''}</td>
                         <td>${af.filesize}</td>
                         <td><button class="btn btn-sm btn-success download-btn" data-type="audio" data-format="${af.format_id}">
                             <i class="bi bi-download"></i>
@@ -410,7 +547,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             if (elements.playlistTitle) elements.playlistTitle.textContent = data.title;
             if (elements.playlistThumbnail) {
-                elements.playlistThumbnail.src = data.thumbnail || 'static/placeholder.png';
+                elements.playlistThumbnail.src = this.thumbSrc(data.thumbnail, 480) || 'static/placeholder.png';
             }
             if (elements.playlistMeta) {
                 const totalDuration = this.calculateTotalDuration(data.videos);
@@ -441,9 +578,11 @@ document.addEventListener('DOMContentLoaded', () => {
                         <td><span class="badge bg-primary">${index + 1}</span></td>
                         <td>
                             <div class="position-relative">
-                                <div class="bg-secondary rounded d-flex align-items-center justify-content-center" style="width: 80px; height: 45px;">
+                                ${video.thumbnail
+                                    ? `<img src="${this.thumbSrc(video.thumbnail, 160)}" class="rounded" style="width: 80px; height: 45px; object-fit: cover;" alt="" loading="lazy">`
+                                    : `<div class="bg-secondary rounded d-flex align-items-center justify-content-center" style="width: 80px; height: 45px;">
                                     <i class="bi bi-play-fill text-white fs-5"></i>
-                                </div>
+                                </div>`}
                                 <div class="position-absolute bottom-0 end-0 bg-dark text-white px-1 rounded" style="font-size: 0.7rem;">
                                     ${duration}
                                 </div>
@@ -519,7 +658,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             }
             
-            this.state.singleSseConnection = new EventSource(`/stream_single_download?${params.toString()}`);
+            this.state.singleLastEventId = '';
+            this.attachSingleStream(new EventSource(`/stream_single_download?${params.toString()}`), type);
+        },
+
+        attachSingleStream(source, type) {
+            this.state.singleSseConnection = source;
             
             this.state.singleSseConnection.onmessage = (event) => {
                 if (event.data === '[DONE]') {
@@ -531,6 +675,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     this.state.currentSessionId = null;
                     return;
                 }
+                this.state.singleLastEventId = event.lastEventId;
                 try {
                     const data = JSON.parse(event.data);
                     // Store session ID for cancellation
@@ -548,15 +693,42 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             };
             
-            this.state.singleSseConnection.onerror = () => {
-                // Only show error if download wasn't completed
-                if (this.state.singleSseConnection && this.state.singleSseConnection.readyState !== EventSource.CLOSED) {
-                    this.showToast('Connection to server lost.', 'danger');
+            this.state.singleSseConnection.onerror = async () => {
+                if (this.state.singleSseConnection !== source) return;
+                // Queued jobs keep running without us: follow the same job again
+                source.close();
+                const resumed = await this.reattachJob(this.state.currentSessionId, this.state.singleLastEventId);
+                if (this.state.singleSseConnection !== source) {
+                    if (resumed) resumed.close();
+                    return;
                 }
+                if (resumed) {
+                    this.attachSingleStream(resumed, type);
+                    return;
+                }
+                this.showToast('Connection to server lost.', 'danger');
                 this.closeSingleSseConnection();
             };
         },
 
+        async reattachJob(sessionId, lastEventId) {
+            // Returns a new stream for the job's remaining events, or null if it can't be followed
+            if (!sessionId) return null;
+            for (let attempt = 0; attempt < 5; attempt++) {
+                try {
+                    const response = await fetch(`/api/jobs/${sessionId}`);
+                    if (response.ok) {
+                        return new EventSource(`/api/jobs/${sessionId}/events?after=${lastEventId || 0}`);
+                    }
+                    if (response.status === 404) return null;
+                } catch (e) {
+                    // Server restarting; try again shortly
+                }
+                await new Promise(resolve => setTimeout(resolve, 2000));
+            }
+            return null;
+        },
+
         resetSingleProgressModal(type) {
             if (this.els.singleProgressPhase) this.els.singleProgressPhase.textContent = 'Initializing...';
             const phaseMobile = document.getElementById('singleProgressPhaseMobile');
@@ -659,6 +831,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (this.els.stepVideo) this.els.stepVideo.classList.add('active');
                     this.updateTimelineProgress(33);
                     break;
+
+                case 'queued':
+                    if (this.els.singleProgressPhase) this.els.singleProgressPhase.textContent = data.message || 'Waiting in queue...';
+                    if (this.els.singleProgressStatus) this.els.singleProgressStatus.textContent = `Queued #${data.position}`;
+                    break;
                     
                 case 'downloading':
                     const progress = Math.round(data.progress || 0);
@@ -690,6 +867,11 @@ document.addEventListener('DOMContentLoaded', () => {
                         if (this.els.stepAudio) this.els.stepAudio.classList.add('active');
                         if (this.els.singleProgressStatus) this.els.singleProgressStatus.textContent = 'Audio';
                         this.updateTimelineProgress(66);
+                    } else if (data.phase === 'video+audio') {
+                        if (this.els.stepVideo) this.els.stepVideo.classList.add('active');
+                        if (this.els.stepAudio) this.els.stepAudio.classList.add('active');
+                        if (this.els.singleProgressStatus) this.els.singleProgressStatus.textContent = 'Video + Audio';
+                        this.updateTimelineProgress(33 + Math.round(progress / 100 * 33));
                     }
                     break;
                     
@@ -778,6 +960,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (audioProgressPhase) audioProgressPhase.textContent = 'Starting download...';
                     if (audioProgressPhaseMobile) audioProgressPhaseMobile.textContent = 'Starting...';
                     break;
+
+                case 'queued':
+                    if (audioProgressPhase) audioProgressPhase.textContent = data.message || 'Waiting in queue...';
+                    if (audioProgressPhaseMobile) audioProgressPhaseMobile.textContent = `Queued #${data.position}`;
+                    if (audioProgressStatus) audioProgressStatus.textContent = 'Queued';
+                    break;
                     
                 case 'downloading':
                     const progress = Math.round(data.progress || 0);
@@ -853,6 +1041,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 this.state.sseConnection.close();
                 this.state.sseConnection = null;
             }
+            // Queued jobs don't stop when the stream closes
+            if (this.state.playlistSessionId) {
+                fetch('/cancel_download', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ session_id: this.state.playlistSessionId })
+                }).catch(e => console.error('Failed to cancel download:', e));
+                this.state.playlistSessionId = null;
+            }
             if (this.state.progressModalInstance) {
                 this.state.progressModalInstance.hide();
             }
@@ -1042,7 +1239,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 this.state.progressModalInstance.show();
             }
 
-            this.state.sseConnection = new EventSource(`/stream_playlist_download?${params.toString()}`);
+            this.state.playlistSessionId = null;
+            this.state.playlistLastEventId = '';
+            this.attachPlaylistStream(new EventSource(`/stream_playlist_download?${params.toString()}`));
+        },
+
+        attachPlaylistStream(source) {
+            this.state.sseConnection = source;
 
             this.state.sseConnection.onmessage = (event) => {
                 if (event.data === '[DONE]') {
@@ -1053,21 +1256,33 @@ document.addEventListener('DOMContentLoaded', () => {
                     }
                     return;
                 }
+                this.state.playlistLastEventId = event.lastEventId;
                 try {
                     const data = JSON.parse(event.data);
                     console.log('Received playlist data:', data); // Debug log
+                    if (data.session_id) {
+                        this.state.playlistSessionId = data.session_id;
+                    }
                     this.updatePlaylistProgress(data);
                 } catch (e) {
                     console.error('Error parsing playlist SSE data:', e, 'Raw data:', event.data);
                 }
             };
 
-            this.state.sseConnection.onerror = (error) => {
+            this.state.sseConnection.onerror = async (error) => {
                 console.error('SSE Connection error:', error);
-                // Only show error if connection wasn't completed successfully
-                if (this.state.sseConnection && this.state.sseConnection.readyState !== EventSource.CLOSED) {
-                    this.showToast('Connection to server lost.', 'danger');
+                if (this.state.sseConnection !== source) return;
+                source.close();
+                const resumed = await this.reattachJob(this.state.playlistSessionId, this.state.playlistLastEventId);
+                if (this.state.sseConnection !== source) {
+                    if (resumed) resumed.close();
+                    return;
+                }
+                if (resumed) {
+                    this.attachPlaylistStream(resumed);
+                    return;
                 }
+                this.showToast('Connection to server lost.', 'danger');
                 this.closeSseConnection();
             };
         },
@@ -1135,6 +1350,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 playlistPhase.textContent = data.phase;
                 // Update phase color based on status
                 const phaseColors = {
+                    'Queued': 'var(--secondary-color)',
                     'Starting': 'var(--primary-color)',
                     'Video': 'var(--primary-color)',
                     'Audio': 'var(--secondary-color)',
@@ -1165,6 +1381,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     this.addToProgressLog(`Starting download of ${data.total_videos} videos`, 'info');
                     break;
 
+                case 'queued':
+                    if (progressStatusText) {
+                        progressStatusText.textContent = data.message || 'Waiting in queue...';
+                    }
+                    break;
+
                 case 'downloading':
                     if (data.current_video && data.total_videos) {
                         // Use the overall progress from backend if available, otherwise calculate
@@ -1307,7 +1529,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (this.els.clearHistoryBtn) this.els.clearHistoryBtn.classList.remove('d-none');
                 this.els.historyTableBody.innerHTML = history.map((item, index) => `
                     <tr>
-                        <td><img src="${item.thumbnail}" class="history-thumbnail" alt="Thumbnail"></td>
+                        <td><img src="${this.thumbSrc(item.thumbnail, 160) || 'static/placeholder.png'}" class="history-thumbnail" alt="Thumbnail" loading="lazy"></td>
                         <td>${item.title}</td>
                         <td><i class="bi bi-${this.getPlatformIcon(item.platform)}"></i> ${item.platform.charAt(0).toUpperCase() + item.platform.slice(1)}</td>
                         <td>${new Date(item.date).toLocaleDateString()}</td>